@@ -8,14 +8,43 @@
 """
 
 import os
+import re
+import abc
+import ssl
+import ast
 import sys
+import gzip
 import json
 import time
+import queue
+import heapq
+import base64
+import struct
+import selectors
+import socket
+import atexit
+import shutil
+import sqlite3
+import tempfile
+import zlib
+import math
+import codecs
+import copy
+import hashlib
+import hmac
+import functools
 import logging
+import random
+import mimetypes
 import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as futures_wait
+from contextlib import closing, contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 from datetime import datetime
 from typing import Generator
+from urllib.parse import urlsplit
 
 # ── Cargar .env antes que todo ────────────────────────────────────
 try:
@@ -24,52 +53,681 @@ try:
 except ImportError:
     pass
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
 import requests
 from flask import (
-    Flask, Response, request, jsonify,
-    send_from_directory, stream_with_context
+    Flask, Response, request, jsonify, g,
+    send_from_directory, stream_with_context, has_request_context
 )
 from flask_cors import CORS
+from werkzeug.serving import ThreadedWSGIServer
+from werkzeug.wsgi import ClosingIterator
 
 # ── Configuración ─────────────────────────────────────────────────
 BASE_DIR    = Path(__file__).parent
 LOG_DIR     = BASE_DIR / "logs"
 LOG_DIR.mkdir(exist_ok=True)
+DATA_DIR    = BASE_DIR / "data"
+DATA_DIR.mkdir(exist_ok=True)
 
 HOST        = os.getenv("HOST", "0.0.0.0")
 PORT        = int(os.getenv("PORT", 5000))
 DEBUG       = os.getenv("DEBUG", "false").lower() == "true"
 API_KEY     = os.getenv("ANTHROPIC_API_KEY", "")
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_HOSTS = [h.strip().rstrip("/") for h in os.getenv("OLLAMA_HOSTS", OLLAMA_HOST).split(",") if h.strip()]
 MAX_TOKENS  = int(os.getenv("MAX_TOKENS", 8192))
+
+OLLAMA_PRELOAD           = os.getenv("OLLAMA_PRELOAD", "")            # modelos a cargar al arrancar (coma)
+OLLAMA_KEEP_ALIVE        = os.getenv("OLLAMA_KEEP_ALIVE", "30m")      # keep_alive por defecto
+OLLAMA_KEEP_ALIVE_MODELS = os.getenv("OLLAMA_KEEP_ALIVE_MODELS", "")  # "llama3.2=1h,qwen2.5-coder=10m"
+OLLAMA_MEM_BUDGET_MB     = int(os.getenv("OLLAMA_MEM_BUDGET_MB", 0))  # 0 = sin límite (lo gestiona Ollama)
+OLLAMA_POLL_SECONDS      = float(os.getenv("OLLAMA_POLL_SECONDS", 30))   # también intervalo de health check
+OLLAMA_EJECT_FAILURES    = int(os.getenv("OLLAMA_EJECT_FAILURES", 2))    # fallos seguidos para expulsar un nodo
+OLLAMA_EJECT_SECONDS     = float(os.getenv("OLLAMA_EJECT_SECONDS", 30))
 CORS_ORIG   = os.getenv("CORS_ORIGINS", "*")
 LOG_LEVEL   = os.getenv("LOG_LEVEL", "INFO")
 
-ANTHROPIC_URL = "https://api.anthropic.com/v1/messages"
+LOG_FORMAT       = os.getenv("LOG_FORMAT", "json").lower()      # json | text (fichero)
+LOG_MAX_BYTES    = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_HOURS = float(os.getenv("LOG_ROTATE_HOURS", 24))   # 0 = sólo por tamaño
+LOG_BACKUPS      = int(os.getenv("LOG_BACKUPS", 10))          # ficheros .gz conservados
+LOG_QUEUE_SIZE   = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_RATE_LIMIT   = float(os.getenv("LOG_RATE_LIMIT", 20))     # líneas/s por plantilla (0 = sin límite)
+LOG_RATE_BURST   = float(os.getenv("LOG_RATE_BURST", 50))
+
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", 2))  # lote máx. de espera
+USAGE_BATCH         = int(os.getenv("USAGE_BATCH", 500))
+
+BUDGET_KEY_USD          = float(os.getenv("BUDGET_KEY_USD", 0))           # por API key y ventana (0 = sin límite)
+BUDGET_CONVERSATION_USD = float(os.getenv("BUDGET_CONVERSATION_USD", 0))  # por conversation_id
+BUDGET_WINDOW_HOURS     = float(os.getenv("BUDGET_WINDOW_HOURS", 24))
+BUDGET_MODE             = os.getenv("BUDGET_MODE", "reject").lower()     # reject | downgrade
+BUDGET_MIN_TOKENS       = int(os.getenv("BUDGET_MIN_TOKENS", 256))       # suelo al recortar max_tokens
+BUDGET_PERSIST_SECONDS  = float(os.getenv("BUDGET_PERSIST_SECONDS", 30))
+
+UPSTREAM_MODE  = os.getenv("UPSTREAM_MODE", "live").lower()          # live | record | replay
+CASSETTE_DIR   = Path(os.getenv("CASSETTE_DIR", str(DATA_DIR / "cassettes")))
+CASSETTE_SPEED = float(os.getenv("CASSETTE_SPEED", 1.0))               # 0 = sin esperas, 10 = 10x
+CASSETTE_MISS  = os.getenv("CASSETTE_MISS", "error").lower()           # error | live
+
+SSE_DISCONNECT_POLL_MS = float(os.getenv("SSE_DISCONNECT_POLL_MS", 50))  # 0 = sin monitor
+SSE_RESUME_GRACE       = float(os.getenv("SSE_RESUME_GRACE", 60))        # s que sigue un stream sin cliente
+SSE_REPLAY_BUFFER      = int(os.getenv("SSE_REPLAY_BUFFER", 10000))      # eventos guardados por stream
+SSE_KEEPALIVE_SECONDS  = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+MUX_MAX_CHANNELS       = int(os.getenv("MUX_MAX_CHANNELS", 8))            # canales por /api/stream/multi
+WS_SESSION_TTL         = float(os.getenv("WS_SESSION_TTL", 3600))         # s sin actividad antes de olvidar la sesión
+WS_MAX_MESSAGE_BYTES   = int(os.getenv("WS_MAX_MESSAGE_BYTES", 16 * 1024 * 1024))
+BLOB_DIR               = Path(os.getenv("BLOB_DIR", str(DATA_DIR / "blobs")))
+BLOB_MAX_BYTES         = int(os.getenv("BLOB_MAX_BYTES", 32 * 1024 * 1024))   # tamaño máximo de un blob
+BLOB_CACHE_MB          = int(os.getenv("BLOB_CACHE_MB", 64))                  # nivel en memoria (LRU)
+BLOB_KEY_QUOTA_MB      = int(os.getenv("BLOB_KEY_QUOTA_MB", 1024))            # bytes nuevos por API key (0 = sin límite)
+SSE_RESUMABLE          = os.getenv("SSE_RESUMABLE", "false").lower() == "true"  # por defecto si el body no dice nada
+
+ROUTER_TIERS        = os.getenv("ROUTER_TIERS", "")        # ids de barato a capaz; vacío → AVAILABLE_MODELS por precio
+ROUTER_THRESHOLDS   = [float(x) for x in os.getenv("ROUTER_THRESHOLDS", "1.0,3.0").split(",")]
+ROUTER_MIN_SAMPLES  = int(os.getenv("ROUTER_MIN_SAMPLES", 5))      # observaciones antes de corregir al clasificador
+ROUTER_MIN_QUALITY  = float(os.getenv("ROUTER_MIN_QUALITY", 0.8))  # EWMA de calidad aceptable (0-1)
+ROUTER_MARGIN       = float(os.getenv("ROUTER_MARGIN", 0.5))       # score "en el límite" entre dos tiers
+ROUTER_EWMA_ALPHA   = float(os.getenv("ROUTER_EWMA_ALPHA", 0.2))
+
+AGENT_MAX_TURNS     = int(os.getenv("AGENT_MAX_TURNS", 10))     # turnos modelo ↔ herramientas por /api/agent
+TOOL_WORKERS        = int(os.getenv("TOOL_WORKERS", 8))         # herramientas ejecutándose a la vez
+TOOL_TIMEOUT        = float(os.getenv("TOOL_TIMEOUT", 20))      # s por llamada (salvo que la herramienta fije otro)
+
+ENHANCE_MODEL       = os.getenv("ENHANCE_MODEL", "claude-haiku-4-5-20251001")  # modelo rápido por defecto
+ENHANCE_DEBOUNCE_MS = float(os.getenv("ENHANCE_DEBOUNCE_MS", 300))  # espera antes de llamar upstream
+
+REVIEW_CHUNK_CHARS      = int(os.getenv("REVIEW_CHUNK_CHARS", 12000))   # más grande → review por fragmentos
+REVIEW_CHUNK_MAX_TOKENS = int(os.getenv("REVIEW_CHUNK_MAX_TOKENS", 1024))
+REVIEW_CONCURRENCY      = int(os.getenv("REVIEW_CONCURRENCY", 4))        # fragmentos revisados a la vez
+REVIEW_CACHE_SIZE       = int(os.getenv("REVIEW_CACHE_SIZE", 512))       # reviews de fragmento en caché (LRU)
+
+UPSTREAM_CONCURRENCY       = int(os.getenv("UPSTREAM_CONCURRENCY", 16))     # llamadas a Anthropic simultáneas
+OLLAMA_CONCURRENCY         = int(os.getenv("OLLAMA_CONCURRENCY", 8))        # llamadas a Ollama simultáneas
+SCHED_DEADLINE_INTERACTIVE = float(os.getenv("SCHED_DEADLINE_INTERACTIVE", 30))  # s máximos en cola
+SCHED_DEADLINE_BATCH       = float(os.getenv("SCHED_DEADLINE_BATCH", 120))
+SCHED_DEADLINE_BACKGROUND  = float(os.getenv("SCHED_DEADLINE_BACKGROUND", 600))
+SCHED_WEIGHTS              = os.getenv("SCHED_WEIGHTS", "")   # key_id=peso,… (más peso → más cuota; por defecto 1)
+
+SERVER_MAX_THREADS    = int(os.getenv("SERVER_MAX_THREADS", 320))         # hilos de conexión (0 = sin límite)
+ADMISSION_ENABLED     = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_TARGET_MS   = float(os.getenv("ADMISSION_TARGET_MS", 100))      # espera máxima en cola con sobrecarga
+ADMISSION_INTERVAL_MS = float(os.getenv("ADMISSION_INTERVAL_MS", 1000))   # cola sin vaciarse este tiempo = sobrecarga
+ADMISSION_MAX_WAIT_MS = float(os.getenv("ADMISSION_MAX_WAIT_MS", 10000))  # espera máxima en condiciones normales
+
+MAX_BODY_BYTES         = int(os.getenv("MAX_BODY_BYTES", 32 * 1024 * 1024))          # body en la red (comprimido)
+MAX_BODY_DECODED_BYTES = int(os.getenv("MAX_BODY_DECODED_BYTES", 128 * 1024 * 1024))  # tras descomprimir
+
+STATIC_MAX_BYTES = int(os.getenv("STATIC_MAX_BYTES", 2 * 1024 * 1024))  # mayores → desde disco
+
+STATE_URL       = os.getenv("STATE_URL", "memory://")               # memory:// | sqlite:///data/state.db | redis://host:6379/0
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", 86400))        # s de vida de las cachés compartidas
+
+DIFF_CONTEXT        = int(os.getenv("DIFF_CONTEXT", 3))               # líneas de contexto por hunk
+DIFF_MAX_EDITS      = int(os.getenv("DIFF_MAX_EDITS", 2000))          # más ediciones → sustitución completa
+DIFF_VERSIONS       = int(os.getenv("DIFF_VERSIONS", 5))              # versiones guardadas por artefacto
+DIFF_TTL            = float(os.getenv("DIFF_TTL", 7 * 86400))         # s que se conservan las versiones
+DIFF_PROGRESS_LINES = int(os.getenv("DIFF_PROGRESS_LINES", 50))       # evento progress cada N líneas generadas
+
+TRACE_CAPACITY = int(os.getenv("TRACE_CAPACITY", 500))       # trazas en el ring buffer
+TRACE_SAMPLE   = float(os.getenv("TRACE_SAMPLE", 1.0))       # fracción muestreada (0-1)
+TRACE_SLOW_MS  = float(os.getenv("TRACE_SLOW_MS", 5000))     # las lentas se guardan siempre
+
+ADMIN_TOKEN         = os.getenv("ADMIN_TOKEN", "")                  # vacío → endpoints /api/admin desactivados
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 10))   # periodo de muestreo del profiler
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 120))  # duración máxima de un perfilado
+
+ANTHROPIC_URL = os.getenv("ANTHROPIC_URL", "https://api.anthropic.com/v1/messages")
 ANTHROPIC_VER = "2023-06-01"
 DEFAULT_MODEL = "claude-sonnet-4-20250514"
 
+# price: USD por millón de tokens (entrada / salida)
 AVAILABLE_MODELS = [
-    {"id": "claude-sonnet-4-20250514",   "name": "Claude Sonnet 4",  "provider": "anthropic", "ctx": 200000},
-    {"id": "claude-opus-4-20250514",     "name": "Claude Opus 4",    "provider": "anthropic", "ctx": 200000},
-    {"id": "claude-haiku-4-5-20251001",  "name": "Claude Haiku 4.5", "provider": "anthropic", "ctx": 200000},
+    {"id": "claude-sonnet-4-20250514",   "name": "Claude Sonnet 4",  "provider": "anthropic", "ctx": 200000,
+     "price": {"input": 3.0,  "output": 15.0}},
+    {"id": "claude-opus-4-20250514",     "name": "Claude Opus 4",    "provider": "anthropic", "ctx": 200000,
+     "price": {"input": 15.0, "output": 75.0}},
+    {"id": "claude-haiku-4-5-20251001",  "name": "Claude Haiku 4.5", "provider": "anthropic", "ctx": 200000,
+     "price": {"input": 1.0,  "output": 5.0}},
 ]
 
 # ── Logging ───────────────────────────────────────────────────────
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL.upper(), logging.INFO),
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(LOG_DIR / "agent_studio.log", encoding="utf-8"),
-    ]
-)
-log = logging.getLogger("AgentStudio")
+# Pipeline asíncrono: los hilos de petición sólo encolan el registro
+# (QueueHandler); un QueueListener escribe a consola y a fichero JSON
+# con rotación por tamaño/tiempo y compresión gzip en segundo plano.
+_LOG_FIELDS = ("request_id", "endpoint", "model", "tokens", "latency_ms", "status")
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por registro, con los campos estructurados de `extra=`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {
+            "ts":     time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level":  record.levelname,
+            "logger": record.name,
+            "msg":    record.getMessage(),
+        }
+        for field in _LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                doc[field] = value
+        if getattr(record, "suppressed", 0):
+            doc["suppressed"] = record.suppressed
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            doc["exc"] = record.exc_text
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+class RequestContextFilter(logging.Filter):
+    """Añade el request_id de la traza activa (corre en el hilo que loguea)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "request_id", None) is None and has_request_context():
+            trace = g.get("trace")
+            if trace is not None:
+                record.request_id = trace.trace_id
+        return True
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket por punto de llamada (fichero:línea); WARNING o superior nunca se descarta.
+
+    Las líneas descartadas se contabilizan en el siguiente registro admitido
+    del mismo punto (campo `suppressed`). Los buckets inactivos se purgan.
+    """
+    PRUNE_SECONDS = 60
+
+    def __init__(self, rate: float, burst: float):
+        super().__init__()
+        self.rate    = rate
+        self.burst   = burst
+        self._bucket = {}
+        self._lock   = threading.Lock()
+        self._pruned = time.monotonic()
+
+    def _prune(self, now: float):
+        # Un bucket lleno y sin descartes pendientes equivale a uno nuevo
+        idle = max(self.burst / self.rate, self.PRUNE_SECONDS)
+        for key in [k for k, (_, last, dropped) in self._bucket.items()
+                    if now - last > idle and (not dropped or now - last > 10 * idle)]:
+            del self._bucket[key]
+        self._pruned = now
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        # Los mensajes son f-strings ya formateadas: la plantilla es el punto de llamada
+        key = (record.pathname, record.lineno, record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            if now - self._pruned > self.PRUNE_SECONDS:
+                self._prune(now)
+            tokens, last, dropped = self._bucket.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._bucket[key] = (tokens, now, dropped + 1)
+                return False
+            self._bucket[key] = (tokens - 1, now, 0)
+        record.suppressed = dropped
+        return True
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler que nunca bloquea: si la cola está llena, descarta y cuenta."""
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Como QueueHandler.prepare pero sin meter la traza en `msg`: se
+        formatea aquí a `exc_text` y los formatters la añaden (o la ponen en `exc`)."""
+        record = copy.copy(record)
+        record.msg  = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info) if self.formatter \
+                else logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class RotatingCompressingFileHandler(RotatingFileHandler):
+    """Rota por tamaño o por antigüedad y comprime el fichero rotado en otro hilo."""
+
+    def __init__(self, filename, max_bytes: int, rotate_seconds: float, backups: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self.rotate_seconds = rotate_seconds
+        self._opened_at     = time.time()
+        self._gzip_queue    = queue.Queue()
+        threading.Thread(target=self._compress_worker, name="log-gzip", daemon=True).start()
+
+    def shouldRollover(self, record) -> int:
+        if self.rotate_seconds and time.time() - self._opened_at >= self.rotate_seconds:
+            return 1
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        base = Path(self.baseFilename)
+        if base.exists() and base.stat().st_size:
+            rotated = base.with_name(f"{base.name}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+            base.rename(rotated)
+            self._gzip_queue.put(rotated)
+        self._opened_at = time.time()
+        self.stream = self._open()
+
+    def _compress_worker(self):
+        while True:
+            path = self._gzip_queue.get()
+            try:
+                with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                path.unlink()
+                self._prune()
+            except OSError as e:
+                sys.stderr.write(f"log-gzip: {e}\n")
+
+    def _prune(self):
+        base = Path(self.baseFilename)
+        old  = sorted(base.parent.glob(f"{base.name}.*.gz"))
+        for path in old[:max(0, len(old) - self.backupCount)]:
+            path.unlink(missing_ok=True)
+
+def setup_logging() -> logging.Logger:
+    level   = getattr(logging, LOG_LEVEL.upper(), logging.INFO)
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+    logfile = RotatingCompressingFileHandler(
+        LOG_DIR / "agent_studio.log", LOG_MAX_BYTES, LOG_ROTATE_HOURS * 3600, LOG_BACKUPS,
+    )
+    logfile.setFormatter(JsonFormatter() if LOG_FORMAT == "json"
+                         else logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+
+    handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_BURST))
+    handler.addFilter(RequestContextFilter())
+    listener = QueueListener(handler.queue, console, logfile, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers[:] = [handler]
+    return logging.getLogger("AgentStudio")
+
+log = setup_logging()
 
 # ── App ───────────────────────────────────────────────────────────
 app = Flask(__name__, static_folder=str(BASE_DIR))
+app.config["MAX_CONTENT_LENGTH"] = MAX_BODY_BYTES
 CORS(app, origins=CORS_ORIG)
 
+# ── Tracing ───────────────────────────────────────────────────────
+class Span:
+    """Tramo temporal dentro de una traza (nanosegundos de reloj de pared)."""
+    __slots__ = ("name", "span_id", "parent_id", "kind", "start_ns", "end_ns", "attrs", "error")
+
+    def __init__(self, name: str, parent_id: str | None, kind: str = "internal", **attrs):
+        self.name      = name
+        self.span_id   = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind      = kind
+        self.start_ns  = time.time_ns()
+        self.end_ns    = 0
+        self.attrs     = attrs
+        self.error     = None
+
+    def end(self):
+        if not self.end_ns:
+            self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "name":        self.name,
+            "span_id":     self.span_id,
+            "parent_id":   self.parent_id,
+            "kind":        self.kind,
+            "start":       self.start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 3),
+            "attrs":       self.attrs,
+            "error":       self.error,
+        }
+
+class Trace:
+    """Traza de una petición: un span raíz (server) y spans hijos por fase."""
+
+    def __init__(self, name: str, trace_id: str | None = None, parent_id: str | None = None, **attrs):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.sampled  = random.random() < TRACE_SAMPLE
+        self.root     = Span(name, parent_id, kind="server", **attrs)
+        self.spans    = [self.root]
+        self._stacks  = {}      # pila de spans abiertos por hilo (productores concurrentes)
+        self._lock    = threading.Lock()
+        self.finished = False
+
+    def start_span(self, name: str, kind: str = "internal", **attrs) -> Span:
+        with self._lock:
+            stack  = self._stacks.setdefault(threading.get_ident(), [])
+            parent = stack[-1] if stack else self.root
+            sp = Span(name, parent.span_id, kind=kind, **attrs)
+            self.spans.append(sp)
+            stack.append(sp)
+        return sp
+
+    def end_span(self, sp: Span):
+        sp.end()
+        with self._lock:
+            for stack in self._stacks.values():
+                if sp in stack:
+                    stack.remove(sp)
+
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", **attrs):
+        sp = self.start_span(name, kind=kind, **attrs)
+        try:
+            yield sp
+        except GeneratorExit:
+            sp.attrs["cancelled"] = True
+            raise
+        except BaseException as e:
+            sp.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.end_span(sp)
+
+    def annotate(self, **attrs):
+        self.root.attrs.update(attrs)
+
+    def finish(self, **attrs):
+        if self.finished:
+            return
+        self.finished = True
+        self.root.attrs.update(attrs)
+        self.root.end()
+        for sp in self.spans:
+            sp.end()
+        if self.sampled or self.root.duration_ms >= TRACE_SLOW_MS:
+            TRACES.add(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return self.root.duration_ms
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id":    self.trace_id,
+            "name":        self.root.name,
+            "duration_ms": round(self.duration_ms, 3),
+            "attrs":       self.root.attrs,
+            "spans":       [s.to_dict() for s in self.spans],
+        }
+
+class _NullTrace:
+    """Sustituto cuando no hay petición activa (hilos de fondo, scripts)."""
+    trace_id = None
+
+    def start_span(self, name: str, kind: str = "internal", **attrs) -> Span:
+        return Span(name, None, kind=kind, **attrs)
+
+    def end_span(self, sp: Span):
+        sp.end()
+
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", **attrs):
+        yield self.start_span(name, kind=kind, **attrs)
+
+    def annotate(self, **attrs):
+        pass
+
+    def finish(self, **attrs):
+        pass
+
+NULL_TRACE = _NullTrace()
+
+class TraceBuffer:
+    """Ring buffer acotado de trazas terminadas."""
+
+    def __init__(self, capacity: int):
+        self._items = deque(maxlen=max(1, capacity))
+        self._lock  = threading.Lock()
+
+    def add(self, trace: Trace):
+        with self._lock:
+            self._items.append(trace)
+
+    def query(self, slow_ms: float = 0, name: str | None = None, limit: int = 100) -> list:
+        with self._lock:
+            items = list(self._items)
+        out = [t for t in reversed(items)
+               if t.duration_ms >= slow_ms and (not name or name in t.root.name)]
+        return out[:limit]
+
+    def get(self, trace_id: str) -> Trace | None:
+        with self._lock:
+            return next((t for t in self._items if t.trace_id == trace_id), None)
+
+TRACES = TraceBuffer(TRACE_CAPACITY)
+
+def current_trace():
+    if has_request_context():
+        return g.get("trace") or NULL_TRACE
+    return NULL_TRACE
+
+def span(name: str, kind: str = "internal", **attrs):
+    """Abre un span en la traza de la petición actual (no-op fuera de petición)."""
+    return current_trace().span(name, kind=kind, **attrs)
+
+_OTLP_KIND = {"internal": 1, "server": 2, "client": 3}
+
+def _otlp_value(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+def traces_to_otlp(traces: list) -> dict:
+    """Exporta trazas al formato OTLP/JSON (ExportTraceServiceRequest)."""
+    spans = []
+    for t in traces:
+        for s in t.spans:
+            spans.append({
+                "traceId":           t.trace_id,
+                "spanId":            s.span_id,
+                "parentSpanId":      s.parent_id or "",
+                "name":              s.name,
+                "kind":              _OTLP_KIND.get(s.kind, 1),
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano":   str(s.end_ns or s.start_ns),
+                "attributes":        [{"key": k, "value": _otlp_value(v)} for k, v in s.attrs.items()],
+                "status":            {"code": 2, "message": s.error} if s.error else {"code": 1},
+            })
+    return {"resourceSpans": [{
+        "resource":   {"attributes": [
+            {"key": "service.name",    "value": {"stringValue": "agent-studio"}},
+            {"key": "service.version", "value": {"stringValue": "2.0.0"}},
+        ]},
+        "scopeSpans": [{"scope": {"name": "agent_studio.tracing"}, "spans": spans}],
+    }]}
+
+def _parse_traceparent(header: str | None) -> tuple:
+    """W3C traceparent → (trace_id, parent_span_id) o (None, None)."""
+    parts = (header or "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None, None
+
+@app.before_request
+def _start_trace():
+    if not request.path.startswith("/api/") or request.path.startswith("/api/traces"):
+        return
+    trace_id, parent = _parse_traceparent(request.headers.get("traceparent"))
+    g.trace = Trace(f"{request.method} {request.path}", trace_id, parent,
+                    method=request.method, path=request.path)
+
+@app.after_request
+def _finish_trace(response):
+    trace = g.get("trace")
+    if trace is not None:
+        response.headers["X-Request-ID"] = trace.trace_id
+        status = response.status_code
+
+        def _close():
+            trace.finish(status=status)
+            log.debug(f"{trace.root.name} {status} {trace.duration_ms:.1f}ms",
+                      extra={"request_id": trace.trace_id, "status": status,
+                             "latency_ms": round(trace.duration_ms, 1)})
+        response.call_on_close(_close)
+    return response
+
+# ── Usage analytics ───────────────────────────────────────────────
+# Cada respuesta con `usage` se encola y un hilo escritor la persiste en
+# SQLite por lotes: tabla append-only de eventos + rollups pre-agregados
+# por minuto/hora/día × modelo × endpoint × key, para que /api/analytics
+# responda en milisegundos aunque haya meses de datos.
+_ROLLUPS = {"minute": 60, "hour": 3600, "day": 86400}
+
+def key_id(api_key: str | None) -> str:
+    """Identificador estable y no reversible de una API key."""
+    if not api_key:
+        return "anon"
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+class UsageStore:
+    def __init__(self, path: Path, flush_seconds: float, batch: int):
+        self.path    = path
+        self.flush_s = flush_seconds
+        self.batch   = batch
+        self._queue  = queue.Queue()
+        self._init_schema()
+        threading.Thread(target=self._writer, name="usage-writer", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_schema(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS usage_events (
+                ts REAL NOT NULL, endpoint TEXT, model TEXT, key_id TEXT,
+                input_tokens INTEGER, output_tokens INTEGER, latency_ms REAL, error INTEGER)""")
+            for name in _ROLLUPS:
+                conn.execute(f"""CREATE TABLE IF NOT EXISTS usage_{name} (
+                    bucket INTEGER NOT NULL, model TEXT NOT NULL, endpoint TEXT NOT NULL, key_id TEXT NOT NULL,
+                    requests INTEGER DEFAULT 0, errors INTEGER DEFAULT 0,
+                    input_tokens INTEGER DEFAULT 0, output_tokens INTEGER DEFAULT 0,
+                    latency_ms REAL DEFAULT 0,
+                    PRIMARY KEY (bucket, model, endpoint, key_id)) WITHOUT ROWID""")
+
+    def record(self, endpoint: str, model: str, api_key: str | None, usage: dict,
+               latency_ms: float, error: bool = False):
+        usage = usage or {}
+        self._queue.put((time.time(), endpoint, model or "?", key_id(api_key),
+                         int(usage.get("input_tokens", 0) or 0),
+                         int(usage.get("output_tokens", 0) or 0),
+                         float(latency_ms), int(error)))
+
+    def _writer(self):
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_s
+            while len(rows) < self.batch:
+                try:
+                    rows.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(rows)
+            except sqlite3.Error:
+                log.exception("UsageStore: error escribiendo lote")
+
+    def _write(self, rows: list):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT INTO usage_events VALUES (?,?,?,?,?,?,?,?)", rows)
+            for name, width in _ROLLUPS.items():
+                conn.executemany(f"""
+                    INSERT INTO usage_{name} VALUES (?,?,?,?,1,?,?,?,?)
+                    ON CONFLICT (bucket, model, endpoint, key_id) DO UPDATE SET
+                        requests      = requests + 1,
+                        errors        = errors + excluded.errors,
+                        input_tokens  = input_tokens + excluded.input_tokens,
+                        output_tokens = output_tokens + excluded.output_tokens,
+                        latency_ms    = latency_ms + excluded.latency_ms""",
+                    [(int(ts // width) * width, model, ep, kid, err, tin, tout, lat)
+                     for ts, ep, model, kid, tin, tout, lat, err in rows])
+
+    def flush(self):
+        """Escribe de forma síncrona lo pendiente (al salir / para consultas)."""
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows:
+            self._write(rows)
+
+    def query(self, since: float, until: float, bucket: str | None = None,
+              group_by: tuple = (), filters: dict | None = None) -> dict:
+        span_s = until - since
+        if bucket not in _ROLLUPS:
+            bucket = "minute" if span_s <= 6 * 3600 else "hour" if span_s <= 14 * 86400 else "day"
+        width  = _ROLLUPS[bucket]
+        cols   = [c for c in group_by if c in ("model", "endpoint", "key_id", "bucket")]
+        where  = ["bucket >= ?", "bucket < ?"]
+        params = [int(since // width) * width, until]
+        for col, value in (filters or {}).items():
+            if value:
+                where.append(f"{col} = ?")
+                params.append(value)
+        select = ", ".join(cols + ["SUM(requests)", "SUM(errors)", "SUM(input_tokens)",
+                                   "SUM(output_tokens)", "SUM(latency_ms)"])
+        sql = f"SELECT {select} FROM usage_{bucket} WHERE {' AND '.join(where)}"
+        if cols:
+            sql += f" GROUP BY {', '.join(cols)} ORDER BY {', '.join(cols)}"
+        with closing(self._connect()) as conn:
+            rows = conn.execute(sql, params).fetchall()
+        out = []
+        for row in rows:
+            reqs, errs, tin, tout, lat = row[len(cols):]
+            if not reqs:
+                continue
+            item = dict(zip(cols, row[:len(cols)]))
+            item.update({
+                "requests":       reqs,
+                "errors":         errs,
+                "input_tokens":   tin,
+                "output_tokens":  tout,
+                "avg_latency_ms": round(lat / reqs, 1),
+            })
+            out.append(item)
+        return {"bucket": bucket, "since": since, "until": until, "rows": out}
+
+USAGE = UsageStore(DATA_DIR / "usage.db", USAGE_FLUSH_SECONDS, USAGE_BATCH)
+
 # ── Helpers ───────────────────────────────────────────────────────
 def anthropic_headers(key: str | None = None) -> dict:
     k = key or API_KEY
@@ -83,9 +741,44 @@ def extract_key(req_data: dict) -> str:
     """Extrae la API key del body o usa la del entorno."""
     return req_data.pop("api_key", None) or API_KEY
 
+def caller_key(req_data: dict | None = None) -> str:
+    """API key del llamante en endpoints de control: body, cabecera X-API-Key o entorno."""
+    return (req_data or {}).get("api_key") or request.headers.get("X-API-Key") or API_KEY
+
 def validate_key(key: str) -> bool:
     return bool(key and key.startswith("sk-ant"))
 
+class LRUCache:
+    """LRU con límite de capacidad; `weigh` da el peso de cada valor (1 por defecto)."""
+
+    def __init__(self, capacity: int, weigh=None):
+        self.capacity = capacity
+        self.weigh    = weigh or (lambda value: 1)
+        self.weight   = 0
+        self._items   = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: str, value):
+        w = self.weigh(value)
+        if w > self.capacity:
+            return
+        with self._lock:
+            if key in self._items:
+                self.weight -= self.weigh(self._items[key])
+            self._items[key] = value
+            self._items.move_to_end(key)
+            self.weight += w
+            while self.weight > self.capacity:
+                _, old = self._items.popitem(last=False)
+                self.weight -= self.weigh(old)
+
 def build_payload(data: dict, stream: bool = False) -> dict:
     """Construye el payload para Anthropic API."""
     messages  = data.get("messages", [])
@@ -97,220 +790,3413 @@ def build_payload(data: dict, stream: bool = False) -> dict:
     payload = {
         "model":      model,
         "max_tokens": max_tok,
-        "messages":   messages,
+        "messages":   expand_blobs(messages),
         "stream":     stream,
         "temperature": temp,
     }
     if sys_prompt:
         payload["system"] = sys_prompt
+    if data.get("tools"):
+        payload["tools"] = data["tools"]
+        if data.get("tool_choice"):
+            payload["tool_choice"] = data["tool_choice"]
     return payload
 
+class ContentAccumulator:
+    """Reconstruye los bloques de contenido (text / tool_use) de un stream SSE de Anthropic."""
+
+    def __init__(self):
+        self.blocks      = []
+        self.stop_reason = None
+        self._json       = {}     # índice → input JSON parcial de un tool_use
+
+    def feed(self, event: dict) -> dict | None:
+        """Procesa un evento; devuelve el bloque tool_use cuando se completa."""
+        etype = event.get("type", "")
+        if etype == "content_block_start":
+            block = dict(event.get("content_block", {}))
+            if block.get("type") == "tool_use":
+                block["input"] = {}
+                self._json[event.get("index", len(self.blocks))] = ""
+            self.blocks.append(block)
+        elif etype == "content_block_delta" and self.blocks:
+            delta = event.get("delta", {})
+            if delta.get("type") == "text_delta":
+                self.blocks[-1]["text"] = self.blocks[-1].get("text", "") + delta.get("text", "")
+            elif delta.get("type") == "input_json_delta":
+                idx = event.get("index", len(self.blocks) - 1)
+                self._json[idx] = self._json.get(idx, "") + delta.get("partial_json", "")
+        elif etype == "content_block_stop" and self.blocks:
+            idx = event.get("index", len(self.blocks) - 1)
+            if idx in self._json:
+                block = self.blocks[idx] if idx < len(self.blocks) else self.blocks[-1]
+                try:
+                    block["input"] = json.loads(self._json.pop(idx) or "{}")
+                except json.JSONDecodeError:
+                    block["input"] = {}
+                return block
+        elif etype == "message_delta":
+            self.stop_reason = event.get("delta", {}).get("stop_reason") or self.stop_reason
+        return None
+
+def tool_calls(blocks: list) -> list:
+    return [{"id": b.get("id"), "name": b.get("name"), "input": b.get("input", {})}
+            for b in blocks if b.get("type") == "tool_use"]
+
+def sse_error(error: str, status: int = 200, **extra) -> Response:
+    """Respuesta SSE de un solo evento de error (el frontend siempre espera SSE)."""
+    def err_gen():
+        yield f"data: {json.dumps({'error': error, **extra})}\n\n"
+        yield "data: [DONE]\n\n"
+    return Response(stream_with_context(err_gen()), status=status, mimetype="text/event-stream")
+
 def log_request(endpoint: str, model: str, messages: list):
     n_msgs  = len(messages)
     n_toks  = sum(len(str(m.get("content", ""))) // 4 for m in messages)
-    log.info(f"[{endpoint}] model={model} msgs={n_msgs} ~tokens={n_toks}")
+    log.info(f"[{endpoint}] model={model} msgs={n_msgs} ~tokens={n_toks}",
+             extra={"endpoint": endpoint, "model": model, "tokens": n_toks})
 
-# ── Rutas estáticas ───────────────────────────────────────────────
-@app.route("/")
-def index():
-    return send_from_directory(str(BASE_DIR), "index.html")
+def log_usage(endpoint: str, model: str, usage: dict, started: float, api_key: str | None = None):
+    """Loguea el consumo de una respuesta y lo envía al UsageStore."""
+    tokens = (usage or {}).get("input_tokens", 0) + (usage or {}).get("output_tokens", 0)
+    latency_ms = round((time.perf_counter() - started) * 1000, 1)
+    USAGE.record(endpoint, model, api_key, usage, latency_ms)
+    log.info(f"[{endpoint}] done model={model} tokens={tokens} latency={latency_ms}ms",
+             extra={"endpoint": endpoint, "model": model, "tokens": tokens, "latency_ms": latency_ms})
 
-@app.route("/<path:filename>")
-def static_files(filename):
-    return send_from_directory(str(BASE_DIR), filename)
+# ── Cuerpos de petición ───────────────────────────────────────────
+# Los POST aceptan Content-Encoding gzip/deflate/zstd. El cuerpo se
+# descomprime por trozos acotados (a prueba de bombas de compresión) y se
+# parsea de forma incremental: el array `messages` se decodifica elemento a
+# elemento, sin tener en memoria a la vez el cuerpo entero como bytes y texto.
+_BODY_CHUNK = 64 * 1024
 
-# ── Health check ──────────────────────────────────────────────────
-@app.route("/api/health")
-def health():
-    key_ok = validate_key(API_KEY)
-    return jsonify({
-        "status":    "ok",
-        "version":   "2.0.0",
-        "timestamp": datetime.utcnow().isoformat() + "Z",
-        "api_key":   "configured" if key_ok else "missing",
-        "models":    len(AVAILABLE_MODELS),
-        "ollama":    _check_ollama(),
-    })
+class BodyError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
 
-def _check_ollama() -> str:
+def _decoded_chunks(stream, encoding: str) -> Generator[bytes, None, None]:
+    """Trozos descomprimidos del body; corta al superar MAX_BODY_DECODED_BYTES."""
+    total = 0
+
+    def count(chunk: bytes) -> bytes:
+        nonlocal total
+        total += len(chunk)
+        if total > MAX_BODY_DECODED_BYTES:
+            raise BodyError(f"Body descomprimido mayor de {MAX_BODY_DECODED_BYTES} bytes", 413)
+        return chunk
+
+    if encoding in ("", "identity"):
+        while chunk := stream.read(_BODY_CHUNK):
+            yield count(chunk)
+        return
+    if encoding == "zstd":
+        if zstd is None:
+            raise BodyError("Content-Encoding zstd requiere `pip install zstandard`", 415)
+        try:
+            with zstd.ZstdDecompressor().stream_reader(stream) as reader:
+                while chunk := reader.read(_BODY_CHUNK):
+                    yield count(chunk)
+        except zstd.ZstdError as e:
+            raise BodyError(f"Body zstd inválido: {e}")
+        return
+    if encoding not in ("gzip", "x-gzip", "deflate"):
+        raise BodyError(f"Content-Encoding no soportado: {encoding}", 415)
+
+    d = zlib.decompressobj(zlib.MAX_WBITS | (16 if "gzip" in encoding else 32))
     try:
-        r = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=2)
-        return "online" if r.ok else "error"
-    except Exception:
-        return "offline"
+        while raw := stream.read(_BODY_CHUNK):
+            # max_length acota cada salida; lo no consumido queda en unconsumed_tail
+            while raw:
+                yield count(d.decompress(raw, _BODY_CHUNK))
+                raw = d.unconsumed_tail
+        yield count(d.flush())
+    except zlib.error as e:
+        raise BodyError(f"Body {encoding} inválido: {e}")
+    if not d.eof:
+        raise BodyError(f"Body {encoding} truncado")
 
-# ── Modelos ───────────────────────────────────────────────────────
-@app.route("/api/models")
-def get_models():
-    models = list(AVAILABLE_MODELS)
-    # Añadir modelos Ollama si está disponible
-    try:
-        r = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=2)
-        if r.ok:
-            for m in r.json().get("models", []):
-                models.append({
-                    "id":       m["name"],
-                    "name":     m["name"],
-                    "provider": "ollama",
-                    "ctx":      8192,
-                })
-    except Exception:
-        pass
-    return jsonify({"models": models})
+class _JsonStream:
+    """Buffer de texto sobre los trozos decodificados, con lectura bajo demanda."""
+    _ws      = re.compile(r"\s*")
+    _decoder = json.JSONDecoder()
+    _number  = frozenset("0123456789.eE+-")
 
-# ── Configuración ─────────────────────────────────────────────────
-@app.route("/api/config")
-def get_config():
-    return jsonify({
-        "model":       DEFAULT_MODEL,
-        "max_tokens":  MAX_TOKENS,
-        "ollama_host": OLLAMA_HOST,
-        "debug":       DEBUG,
-        "api_key_set": validate_key(API_KEY),
-        "version":     "2.0.0",
-    })
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.text   = codecs.getincrementaldecoder("utf-8")()
+        self.buf    = ""
+        self.pos    = 0
+        self.eof    = False
 
-# ── Chat estándar ─────────────────────────────────────────────────
-@app.route("/api/chat", methods=["POST"])
-def chat():
-    data    = request.get_json(force=True)
-    api_key = extract_key(data)
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof  = True
+            self.buf += self.text.decode(b"", final=True)
+        else:
+            self.buf += self.text.decode(chunk)
+        return True
+
+    def _compact(self):
+        if self.pos > _BODY_CHUNK:
+            self.buf, self.pos = self.buf[self.pos:], 0
 
+    def peek(self) -> str:
+        """Siguiente carácter no blanco (sin consumirlo); "" al final."""
+        while True:
+            self.pos = self._ws.match(self.buf, self.pos).end()
+            self._compact()
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise BodyError(f"JSON inválido: se esperaba '{char}' en la posición {self.pos}")
+        self.pos += 1
+
+    def _truncated(self, obj, end: int) -> bool:
+        """True si un número podría seguir en el siguiente trozo ("7." + "5")."""
+        if self.eof or isinstance(obj, bool) or not isinstance(obj, (int, float)):
+            return False
+        return end >= len(self.buf) or self.buf[end] in self._number
+
+    def value(self):
+        """Decodifica un valor JSON completo. Un número que acaba al final del
+        buffer, o antes de un carácter que podría continuarlo, sólo se acepta si
+        no pueden llegar más datos; tras un fallo se espera a que el buffer
+        doble su tamaño antes de reintentar."""
+        self.peek()
+        need = 0
+        while True:
+            if len(self.buf) - self.pos >= need or self.eof:
+                try:
+                    obj, end = self._decoder.raw_decode(self.buf, self.pos)
+                    if (end < len(self.buf) or self.eof) and not self._truncated(obj, end):
+                        self.pos = end
+                        self._compact()
+                        return obj
+                except json.JSONDecodeError as e:
+                    if self.eof:
+                        raise BodyError(f"JSON inválido ({e.msg}, posición {e.pos})")
+                need = 2 * (len(self.buf) - self.pos) + 1
+            self._fill()
+
+def parse_json_body(chunks) -> dict:
+    """Parser incremental de un objeto JSON de primer nivel; `messages` elemento a elemento."""
+    js = _JsonStream(iter(chunks))
+    if js.peek() != "{":
+        return js.value()
+    js.expect("{")
+    obj = {}
+    if js.peek() == "}":
+        js.pos += 1
+        return obj
+    while True:
+        key = js.value()
+        if not isinstance(key, str):
+            raise BodyError("JSON inválido: clave no textual")
+        js.expect(":")
+        if key == "messages" and js.peek() == "[":
+            js.expect("[")
+            items = []
+            if js.peek() == "]":
+                js.pos += 1
+            else:
+                while True:
+                    items.append(js.value())
+                    if js.peek() == "]":
+                        js.pos += 1
+                        break
+                    js.expect(",")
+            obj[key] = items
+        else:
+            obj[key] = js.value()
+        if js.peek() == "}":
+            js.pos += 1
+            break
+        js.expect(",")
+    if js.peek():
+        raise BodyError("JSON inválido: datos tras el objeto")
+    return obj
+
+def json_body() -> dict:
+    """Sustituto de request.get_json(force=True) con descompresión y límites."""
+    encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+    return parse_json_body(_decoded_chunks(request.stream, encoding))
+
+# ── Blobs ─────────────────────────────────────────────────────────
+# Almacén direccionado por contenido para adjuntos grandes (ficheros, logs,
+# outputs previos). El cliente los sube una vez a /api/blobs y en `messages`
+# envía {"type": "blob_ref", "hash": …}; build_payload los expande desde
+# disco (data/blobs, deduplicado por sha256) con un nivel LRU en memoria.
+_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+class BlobStore:
+    def __init__(self, root: Path, cache_bytes: int, max_bytes: int):
+        self.root      = root
+        self.max_bytes = max_bytes
+        self.cache     = LRUCache(cache_bytes, weigh=len)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:]
+
+    def put(self, chunks, quota: int | None = None) -> tuple[str, int, bool]:
+        """Guarda un blob por trozos; devuelve (hash, tamaño, creado).
+
+        `quota`: bytes que le quedan al que sube (None = sin cuota)."""
+        sha  = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise BodyError(f"Blob mayor de {self.max_bytes} bytes", 413)
+                    sha.update(chunk)
+                    # Pasada la cuota se sigue hasheando sin escribir: si ya existe, no cuenta
+                    if quota is None or size <= quota:
+                        f.write(chunk)
+            digest = sha.hexdigest()
+            path   = self._path(digest)
+            if path.exists():
+                return digest, size, False
+            if quota is not None and size > quota:
+                raise BodyError("Cuota de blobs agotada para esta API key", 413)
+            path.parent.mkdir(exist_ok=True)
+            os.replace(tmp, path)
+            return digest, size, True
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def get(self, digest: str) -> bytes | None:
+        if not _HASH_RE.match(digest or ""):
+            return None
+        data = self.cache.get(digest)
+        if data is None:
+            try:
+                data = self._path(digest).read_bytes()
+            except FileNotFoundError:
+                return None
+            self.cache.put(digest, data)
+        return data
+
+    def exists(self, digest: str) -> bool:
+        return bool(_HASH_RE.match(digest or "")) and (
+            self.cache.get(digest) is not None or self._path(digest).exists())
+
+    def size(self, digest: str) -> int:
+        if not _HASH_RE.match(digest or ""):
+            return 0
+        try:
+            return self._path(digest).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+BLOBS = BlobStore(BLOB_DIR, BLOB_CACHE_MB * 1024 * 1024, BLOB_MAX_BYTES)
+
+def _blob_refs(messages: list):
+    for m in messages:
+        content = m.get("content") if isinstance(m, dict) else None
+        if isinstance(content, list):
+            for block in content:
+                if isinstance(block, dict) and block.get("type") == "blob_ref":
+                    yield block
+
+def _expand_ref(ref: dict) -> dict:
+    digest = str(ref.get("hash", "")).lower()
+    data   = BLOBS.get(digest)
+    if data is None:
+        raise BodyError(f"Blob desconocido: {digest or '(sin hash)'}", 422)
+    media = ref.get("media_type", "text/plain")
+    if media.startswith("image/") or media == "application/pdf":
+        block = {"type": "image" if media.startswith("image/") else "document",
+                 "source": {"type": "base64", "media_type": media,
+                            "data": base64.b64encode(data).decode("ascii")}}
+    else:
+        block = {"type": "text", "text": data.decode("utf-8", errors="replace")}
+    if ref.get("cache_control"):
+        block["cache_control"] = ref["cache_control"]
+    return block
+
+def expand_blobs(messages: list, text_only: bool = False) -> list:
+    """Sustituye los blob_ref por su contenido. `text_only` aplana el
+    mensaje a un string (para backends sin bloques, como Ollama)."""
+    if next(_blob_refs(messages), None) is None:
+        return messages
+    out = []
+    for m in messages:
+        content = m.get("content") if isinstance(m, dict) else None
+        if not isinstance(content, list) or not any(
+                isinstance(b, dict) and b.get("type") == "blob_ref" for b in content):
+            out.append(m)
+            continue
+        blocks = [_expand_ref(b) if isinstance(b, dict) and b.get("type") == "blob_ref" else b
+                  for b in content]
+        if text_only:
+            blocks = "\n\n".join(b.get("text", "") for b in blocks if isinstance(b, dict))
+        out.append({**m, "content": blocks})
+    return out
+
+def check_blob_refs(messages) -> None:
+    """BodyError 422 si algún blob_ref apunta a un blob que no existe; los
+    endpoints SSE lo comprueban antes de abrir el stream."""
+    if not isinstance(messages, list):
+        return
+    for ref in _blob_refs(messages):
+        digest = str(ref.get("hash", "")).lower()
+        if not BLOBS.exists(digest):
+            raise BodyError(f"Blob desconocido: {digest or '(sin hash)'}", 422)
+
+def blob_chars(messages: list) -> int:
+    """Tamaño de los blobs referenciados (para estimar tokens sin expandirlos)."""
+    return sum(BLOBS.size(str(ref.get("hash", "")).lower()) for ref in _blob_refs(messages))
+
+def put_blob(owner: str, chunks) -> tuple[str, int, bool]:
+    """BLOBS.put descontando de la cuota de `owner` (key_id); los duplicados no cuentan."""
+    used_key = f"blobs:used:{owner}"
+    quota    = None
+    if BLOB_KEY_QUOTA_MB:
+        quota = max(BLOB_KEY_QUOTA_MB * 1024 * 1024 - int(STATE.get(used_key) or 0), 0)
+    digest, size, created = BLOBS.put(chunks, quota)
+    if created:
+        STATE.incr(used_key, size)
+    return digest, size, created
+
+@app.route("/api/blobs", methods=["POST"])
+def upload_blob():
+    """Body crudo (admite Content-Encoding); responde con su sha256.
+
+    La API key va en `X-API-Key`. Cada key tiene BLOB_KEY_QUOTA_MB de blobs
+    nuevos; los duplicados no cuentan.
+    """
+    api_key = caller_key()
     if not validate_key(api_key):
-        return jsonify({"error": "API key no configurada. Añade ANTHROPIC_API_KEY al .env"}), 401
+        return jsonify({"error": "API key no configurada"}), 401
+    encoding = request.headers.get("Content-Encoding", "identity").strip().lower()
+    digest, size, created = put_blob(key_id(api_key), _decoded_chunks(request.stream, encoding))
+    log.info(f"[blobs] {'nuevo' if created else 'duplicado'} {digest[:12]} {size}B")
+    return jsonify({"hash": digest, "size": size, "created": created}), 201 if created else 200
 
-    model = data.get("model", DEFAULT_MODEL)
-    log_request("chat", model, data.get("messages", []))
+@app.route("/api/blobs/<digest>")
+def get_blob(digest: str):
+    data = BLOBS.get(digest.lower())
+    if data is None:
+        return jsonify({"error": "Blob no encontrado"}), 404
+    return Response(data, mimetype="application/octet-stream",
+                    headers={"Cache-Control": "public, max-age=31536000, immutable",
+                             "ETag": f'"{digest.lower()}"'})
 
-    # Ollama local
-    if data.get("provider") == "ollama" or not model.startswith("claude"):
-        return _ollama_chat(data)
+# ── Estado compartido ─────────────────────────────────────────────
+# Cachés, presupuestos, sesiones WebSocket y supersesión pasan por STATE,
+# así varios workers (o nodos) ven los mismos datos. STATE_URL elige el
+# backend: memory:// (un proceso, como antes), sqlite:///ruta (procesos de
+# una misma máquina) o redis://host:puerto/db (cliente RESP mínimo, sin
+# dependencias; rediss:// va por TLS). Los valores se guardan como JSON;
+# `ttl` en segundos.
+class StateStore(abc.ABC):
+    """Interfaz: kv con TTL, contadores atómicos y hashes de contadores."""
+    local = False        # True si el estado sólo vive en este proceso
 
-    # Anthropic
-    try:
-        payload = build_payload(data, stream=False)
-        resp    = requests.post(
-            ANTHROPIC_URL,
-            headers=anthropic_headers(api_key),
-            json=payload,
-            timeout=120,
-        )
-        if not resp.ok:
-            log.error(f"Anthropic error {resp.status_code}: {resp.text[:300]}")
-            return jsonify({"error": resp.json()}), resp.status_code
+    @abc.abstractmethod
+    def get(self, key: str): ...
+    @abc.abstractmethod
+    def set(self, key: str, value, ttl: float | None = None): ...
+    @abc.abstractmethod
+    def delete(self, key: str): ...
+    @abc.abstractmethod
+    def incr(self, key: str, amount: float = 1, ttl: float | None = None) -> float: ...
+    @abc.abstractmethod
+    def hincr(self, key: str, field: str, amount: float, ttl: float | None = None) -> float: ...
+    @abc.abstractmethod
+    def hgetall(self, key: str) -> dict: ...
+    @abc.abstractmethod
+    def hdel(self, key: str, *fields: str): ...
+    @abc.abstractmethod
+    def keys(self, prefix: str) -> list: ...
+
+class MemoryState(StateStore):
+    local = True
+
+    def __init__(self):
+        self._data    = {}       # clave → valor (los hashes son dict)
+        self._expires = {}
+        self._lock    = threading.Lock()
+
+    def _live(self, key: str) -> bool:
+        exp = self._expires.get(key)
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def _touch(self, key: str, ttl: float | None):
+        if ttl:
+            self._expires[key] = time.time() + ttl
+
+    def get(self, key):
+        with self._lock:
+            return self._data[key] if self._live(key) else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = value
+            self._expires.pop(key, None)
+            self._touch(key, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            value = (self._data[key] if self._live(key) else 0) + amount
+            self._data[key] = value
+            self._touch(key, ttl)
+            return value
+
+    def hincr(self, key, field, amount, ttl=None):
+        with self._lock:
+            h = self._data[key] if self._live(key) else self._data.setdefault(key, {})
+            h[field] = h.get(field, 0) + amount
+            self._touch(key, ttl)
+            return h[field]
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._data[key]) if self._live(key) else {}
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            if self._live(key):
+                for f in fields:
+                    self._data[key].pop(f, None)
+
+    def keys(self, prefix):
+        with self._lock:
+            return [k for k in list(self._data) if k.startswith(prefix) and self._live(k)]
+
+class SQLiteState(StateStore):
+    """Un fichero SQLite en WAL compartido por los procesos de la máquina."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db     = sqlite3.connect(str(path), timeout=10, check_same_thread=False,
+                                       isolation_level=None)
+        self._lock   = threading.Lock()
+        self._writes = 0
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS hash (key TEXT, field TEXT, value REAL, "
+                             "PRIMARY KEY (key, field))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS hash_ttl (key TEXT PRIMARY KEY, expires REAL)")
+
+    @contextmanager
+    def _tx(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+                self._writes += 1
+                if self._writes % 1000 == 0:
+                    self._purge(self._db)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _purge(db):
+        now = time.time()
+        db.execute("DELETE FROM kv WHERE expires <= ?", (now,))
+        db.execute("DELETE FROM hash WHERE key IN (SELECT key FROM hash_ttl WHERE expires <= ?)", (now,))
+        db.execute("DELETE FROM hash_ttl WHERE expires <= ?", (now,))
+
+    @staticmethod
+    def _exp(ttl):
+        return time.time() + ttl if ttl else None
+
+    def _row(self, db, key):
+        return db.execute("SELECT value, expires FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                          (key, time.time())).fetchone()
+
+    def get(self, key):
+        with self._lock:
+            row = self._row(self._db, key)
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        with self._tx() as db:
+            db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                       (key, json.dumps(value, ensure_ascii=False), self._exp(ttl)))
+
+    def delete(self, key):
+        with self._tx() as db:
+            for table in ("kv", "hash", "hash_ttl"):
+                db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._tx() as db:
+            row   = self._row(db, key)
+            value = (json.loads(row[0]) if row else 0) + amount
+            db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                       (key, json.dumps(value), self._exp(ttl) if ttl else (row[1] if row else None)))
+            return value
+
+    def _hash_expired(self, db, key) -> bool:
+        row = db.execute("SELECT expires FROM hash_ttl WHERE key = ?", (key,)).fetchone()
+        return bool(row and row[0] is not None and row[0] <= time.time())
+
+    def hincr(self, key, field, amount, ttl=None):
+        with self._tx() as db:
+            if self._hash_expired(db, key):
+                db.execute("DELETE FROM hash WHERE key = ?", (key,))
+            if ttl:
+                db.execute("INSERT OR REPLACE INTO hash_ttl VALUES (?, ?)", (key, self._exp(ttl)))
+            db.execute("INSERT INTO hash VALUES (?, ?, ?) ON CONFLICT (key, field) "
+                       "DO UPDATE SET value = value + excluded.value", (key, field, amount))
+            return db.execute("SELECT value FROM hash WHERE key = ? AND field = ?", (key, field)).fetchone()[0]
+
+    def hgetall(self, key):
+        with self._lock:
+            if self._hash_expired(self._db, key):
+                return {}
+            return dict(self._db.execute("SELECT field, value FROM hash WHERE key = ?", (key,)).fetchall())
+
+    def hdel(self, key, *fields):
+        with self._tx() as db:
+            db.executemany("DELETE FROM hash WHERE key = ? AND field = ?", [(key, f) for f in fields])
+
+    def keys(self, prefix):
+        like = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key FROM kv WHERE key LIKE ? ESCAPE '\\' AND (expires IS NULL OR expires > ?) "
+                "UNION SELECT DISTINCT key FROM hash WHERE key LIKE ? ESCAPE '\\'",
+                (like, time.time(), like)).fetchall()
+            return [r[0] for r in rows if not self._hash_expired(self._db, r[0])]
+
+class RespError(Exception):
+    """Respuesta de error de Redis (-ERR …); la conexión sigue sincronizada."""
+
+class RespProtocolError(RespError):
+    """Respuesta mal formada: la conexión queda desincronizada y se descarta."""
+
+class RedisState(StateStore):
+    """Cliente RESP2 mínimo (GET/SET/INCRBYFLOAT/HINCRBYFLOAT/…) con pool de conexiones."""
+
+    def __init__(self, url: str):
+        from urllib.parse import urlparse
+        u = urlparse(url)
+        self.addr     = (u.hostname or "127.0.0.1", u.port or 6379)
+        self.tls      = u.scheme == "rediss"
+        self.username = u.username
+        self.password = u.password
+        self.db       = int((u.path or "/0").lstrip("/") or 0)
+        self._pool    = queue.LifoQueue()
+
+    def _connect(self):
+        sock = socket.create_connection(self.addr, timeout=5)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.addr[0])
+        conn = (sock, sock.makefile("rb"))
+        try:
+            if self.password:
+                # Con usuario (ACL de Redis 6+) AUTH lleva dos argumentos
+                self._call(conn, "AUTH", *filter(None, (self.username, self.password)))
+            if self.db:
+                self._call(conn, "SELECT", self.db)
+        except BaseException:
+            self._close(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        conn[1].close()
+        conn[0].close()
+
+    @staticmethod
+    def _read(f):
+        line = f.readline()
+        if not line:
+            raise ConnectionError("Redis cerró la conexión")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        try:
+            if kind == b":":
+                return int(rest)
+            if kind == b"$":
+                n = int(rest)
+                return None if n < 0 else f.read(n + 2)[:-2]
+            if kind == b"*":
+                n = int(rest)
+                if n < 0:
+                    return None
+                # Se leen todos los elementos aunque alguno sea -ERR, para no desincronizar
+                items, error = [], None
+                for _ in range(n):
+                    try:
+                        items.append(RedisState._read(f))
+                    except RespProtocolError:
+                        raise
+                    except RespError as e:
+                        error = error or e
+                if error:
+                    raise error
+                return items
+        except ValueError:
+            pass
+        raise RespProtocolError(f"Respuesta RESP inválida: {line[:40]!r}")
+
+    def _call(self, conn, *args):
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            a = a if isinstance(a, bytes) else str(a).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(a), a))
+        conn[0].sendall(b"".join(out))
+        return self._read(conn[1])
+
+    def command(self, *args):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        reusable = False
+        try:
+            result   = self._call(conn, *args)
+            reusable = True
+            return result
+        except RespProtocolError:
+            raise
+        except RespError:
+            reusable = True      # -ERR leído entero
+            raise
+        finally:
+            # Tras un OSError o una respuesta mal formada el socket no es fiable
+            if reusable:
+                self._pool.put(conn)
+            else:
+                self._close(conn)
+
+    def get(self, key):
+        raw = self.command("GET", key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        args = ["SET", key, json.dumps(value, ensure_ascii=False)]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        self.command(*args)
+
+    def delete(self, key):
+        self.command("DEL", key)
+
+    def incr(self, key, amount=1, ttl=None):
+        value = float(self.command("INCRBYFLOAT", key, amount))
+        if ttl:
+            self.command("PEXPIRE", key, int(ttl * 1000))
+        return value
+
+    def hincr(self, key, field, amount, ttl=None):
+        value = float(self.command("HINCRBYFLOAT", key, field, amount))
+        if ttl:
+            self.command("PEXPIRE", key, int(ttl * 1000))
+        return value
+
+    def hgetall(self, key):
+        flat = self.command("HGETALL", key) or []
+        return {flat[i].decode(): float(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+    def hdel(self, key, *fields):
+        if fields:
+            self.command("HDEL", key, *fields)
+
+    def keys(self, prefix):
+        pattern = re.sub(r"([*?\[\]\\])", r"\\\1", prefix) + "*"
+        cursor, out = "0", []
+        while True:
+            cursor, batch = self.command("SCAN", cursor, "MATCH", pattern, "COUNT", 500)
+            out += [k.decode() for k in batch]
+            cursor = cursor.decode() if isinstance(cursor, bytes) else cursor
+            if cursor == "0":
+                return out
+
+def open_state(url: str) -> StateStore:
+    scheme, _, rest = url.partition("://")
+    if scheme == "memory":
+        return MemoryState()
+    if scheme == "sqlite":
+        # sqlite:///data/state.db (relativa a BASE_DIR) o sqlite:////ruta/absoluta.db
+        path = Path(rest[1:] if rest.startswith("/") else rest)
+        return SQLiteState(path if path.is_absolute() else BASE_DIR / path)
+    if scheme in ("redis", "rediss"):
+        return RedisState(url)
+    raise ValueError(f"STATE_URL no soportada: {url}")
+
+STATE = open_state(STATE_URL)
+
+class SharedCache:
+    """Caché en STATE con TTL; la expulsión la hace el backend."""
+
+    def __init__(self, prefix: str, ttl: float):
+        self.prefix = prefix
+        self.ttl    = ttl
+
+    def get(self, key: str):
+        return STATE.get(self.prefix + key)
+
+    def put(self, key: str, value):
+        STATE.set(self.prefix + key, value, self.ttl)
+
+def make_cache(prefix: str, capacity: int, ttl: float):
+    """LRU en proceso con el backend memory://; si no, caché compartida."""
+    return LRUCache(capacity) if STATE.local else SharedCache(prefix, ttl)
+
+# ── Scheduler upstream ────────────────────────────────────────────
+# Cada llamada upstream ocupa un slot (UPSTREAM_CONCURRENCY para Anthropic,
+# OLLAMA_CONCURRENCY para Ollama) durante toda su duración, incluido el
+# stream. Sin slot libre, la petición espera en la cola de su clase:
+# interactive se admite antes que batch y batch antes que background; dentro
+# de cada clase, weighted fair queuing por API key (tiempo de fin virtual),
+# para que una key con muchas peticiones no acapare la cola. Cada petición
+# cuesta 1/peso de su key (SCHED_WEIGHTS), sin mirar su tamaño en tokens. El
+# fin virtual de una key se olvida cuando el reloj virtual de la clase lo
+# alcanza o la cola se vacía. Quien supera su deadline en cola sale con
+# SchedulerTimeout.
+PRIORITY_CLASSES = ("interactive", "batch", "background")
+
+class SchedulerTimeout(Exception):
+    pass
+
+class Ticket:
+    """Slot concedido; release() es idempotente."""
+    __slots__ = ("scheduler", "released")
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.released  = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release()
+
+class Scheduler:
+    def __init__(self, name: str, slots: int, weights: dict | None = None):
+        self.name        = name
+        self.slots       = slots
+        self.free        = slots
+        self.weights     = weights or {}                       # key_id → peso
+        self.queues      = {c: [] for c in PRIORITY_CLASSES}   # heap (fin virtual, seq, waiter)
+        self.depth       = {c: 0 for c in PRIORITY_CLASSES}
+        self.vtime       = {c: 0.0 for c in PRIORITY_CLASSES}
+        self.last_finish = {c: {} for c in PRIORITY_CLASSES}   # clase → key → fin virtual
+        self.waits       = {c: deque(maxlen=1000) for c in PRIORITY_CLASSES}
+        self.admitted    = {c: 0 for c in PRIORITY_CLASSES}
+        self.expired     = {c: 0 for c in PRIORITY_CLASSES}
+        self._seq        = 0
+        self._cond       = threading.Condition()
+
+    def _waiting_ahead(self, cls: str) -> bool:
+        return any(self.depth[c] for c in PRIORITY_CLASSES[:PRIORITY_CLASSES.index(cls) + 1])
+
+    def acquire(self, cls: str, key: str, deadline: float, cancelled=None) -> Ticket:
+        started = time.monotonic()
+        with self._cond:
+            if self.free > 0 and not self._waiting_ahead(cls):
+                self.free -= 1
+                self._admit(cls, 0.0)
+                return Ticket(self)
+
+            start  = max(self.vtime[cls], self.last_finish[cls].get(key, 0.0))
+            finish = start + 1.0 / self.weights.get(key, 1.0)
+            self.last_finish[cls][key] = finish
+            self._seq += 1
+            waiter = {"granted": False, "dead": False}
+            heapq.heappush(self.queues[cls], (finish, self._seq, waiter))
+            self.depth[cls] += 1
+            while not waiter["granted"]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (cancelled and cancelled()):
+                    waiter["dead"] = True
+                    self.depth[cls] -= 1
+                    self.expired[cls] += 1
+                    self._prune(cls)
+                    raise SchedulerTimeout(
+                        f"Cola upstream saturada: sin slot en {time.monotonic() - started:.1f}s ({cls})")
+                self._cond.wait(min(remaining, 0.25))
+            self._admit(cls, time.monotonic() - started)
+            return Ticket(self)
+
+    def _admit(self, cls: str, waited: float):
+        self.admitted[cls] += 1
+        self.waits[cls].append(waited)
+
+    def _prune(self, cls: str):
+        """Olvida fines virtuales que ya no cuentan (≤ reloj de la clase, o cola vacía)."""
+        if not self.depth[cls]:
+            self.last_finish[cls].clear()
+            return
+        vtime = self.vtime[cls]
+        for key in [k for k, f in self.last_finish[cls].items() if f <= vtime]:
+            del self.last_finish[cls][key]
+
+    def release(self):
+        with self._cond:
+            self.free += 1
+            while self.free > 0:
+                for cls in PRIORITY_CLASSES:
+                    q = self.queues[cls]
+                    while q and q[0][2]["dead"]:
+                        heapq.heappop(q)
+                    if q:
+                        finish, _, waiter = heapq.heappop(q)
+                        self.vtime[cls] = finish
+                        self.depth[cls] -= 1
+                        self._prune(cls)
+                        waiter["granted"] = True
+                        self.free -= 1
+                        break
+                else:
+                    break
+            self._cond.notify_all()
+
+    def metrics(self) -> dict:
+        with self._cond:
+            classes = {}
+            for cls in PRIORITY_CLASSES:
+                waits = sorted(self.waits[cls])
+                classes[cls] = {
+                    "queue_depth": self.depth[cls],
+                    "admitted":    self.admitted[cls],
+                    "expired":     self.expired[cls],
+                    "wait_ms_avg": round(1000 * sum(waits) / len(waits), 1) if waits else 0.0,
+                    "wait_ms_p95": round(1000 * waits[math.ceil(0.95 * len(waits)) - 1], 1) if waits else 0.0,
+                }
+            return {"slots": self.slots, "in_flight": self.slots - self.free, "classes": classes}
+
+_SCHED_WEIGHTS = {k.strip(): float(w) for k, w in
+                  (item.split("=", 1) for item in SCHED_WEIGHTS.split(",") if "=" in item) if float(w) > 0}
+
+SCHEDULERS = {
+    "anthropic": Scheduler("anthropic", UPSTREAM_CONCURRENCY, _SCHED_WEIGHTS),
+    "ollama":    Scheduler("ollama", OLLAMA_CONCURRENCY, _SCHED_WEIGHTS),
+}
+SCHED_DEADLINES = {"interactive": SCHED_DEADLINE_INTERACTIVE, "batch": SCHED_DEADLINE_BATCH,
+                   "background": SCHED_DEADLINE_BACKGROUND}
+
+def request_priority(data: dict, default: str = "interactive") -> str:
+    """Clase de prioridad pedida en el body (`priority`), o la del endpoint."""
+    cls = str(data.get("priority") or default).lower()
+    return cls if cls in PRIORITY_CLASSES else default
+
+# ── Upstream (live / record / replay) ─────────────────────────────
+# Todas las llamadas a Anthropic y Ollama pasan por upstream_post().
+# En modo `record` cada respuesta (incluida la secuencia SSE/NDJSON con sus
+# tiempos) se guarda en un cassette indexado por hash de la petición; en
+# `replay` se reproduce sin red, con el ritmo original o acelerado.
+def request_hash(url: str, payload: dict | None) -> str:
+    """Hash estable de la petición: ruta + JSON canónico (sin cabeceras ni API key)."""
+    path = urlsplit(url).path
+    body = json.dumps(payload or {}, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(f"{path}\n{body}".encode("utf-8")).hexdigest()
+
+class CassetteMiss(Exception):
+    pass
+
+class Cassette:
+    """Fichero de datos append-only (registros JSON comprimidos) + índice `hash offset len`.
+
+    Un mismo hash puede tener varias grabaciones; en replay se recorren en orden.
+    """
+
+    def __init__(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.data_path  = directory / "cassette.dat"
+        self.index_path = directory / "cassette.idx"
+        self._index     = {}
+        self._cursor    = {}
+        self._lock      = threading.Lock()
+        if self.index_path.exists():
+            for line in self.index_path.read_text(encoding="utf-8").splitlines():
+                h, off, size = line.split()
+                self._index.setdefault(h, []).append((int(off), int(size)))
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._index.values())
+
+    def append(self, h: str, record: dict):
+        blob = zlib.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+        with self._lock, open(self.data_path, "ab") as data, open(self.index_path, "a", encoding="utf-8") as idx:
+            offset = data.seek(0, os.SEEK_END)
+            data.write(blob)
+            idx.write(f"{h} {offset} {len(blob)}\n")
+            self._index.setdefault(h, []).append((offset, len(blob)))
+
+    def next(self, h: str) -> dict:
+        with self._lock:
+            entries = self._index.get(h)
+            if not entries:
+                raise CassetteMiss(h)
+            n = self._cursor.get(h, 0)
+            self._cursor[h] = n + 1
+            offset, size = entries[n % len(entries)]
+        with open(self.data_path, "rb") as data:
+            data.seek(offset)
+            return json.loads(zlib.decompress(data.read(size)))
+
+class ReplayResponse:
+    """Imita la parte de requests.Response que usa el servidor."""
+
+    def __init__(self, record: dict, speed: float):
+        self.status_code = record["status"]
+        self.ok          = self.status_code < 400
+        self.headers     = record.get("headers", {})
+        self._record     = record
+        self._speed      = speed
+        self._closed     = False
+
+    def _sleep(self, seconds: float):
+        if self._speed > 0 and seconds > 0:
+            time.sleep(seconds / self._speed)
+
+    @property
+    def text(self) -> str:
+        if "body" in self._record:
+            return self._record["body"]
+        return "\n".join(line for _, line in self._record.get("lines", []))
+
+    @property
+    def content(self) -> bytes:
+        return self.text.encode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_lines(self, *args, **kwargs):
+        last = 0.0
+        for at, line in self._record.get("lines", []):
+            if self._closed:
+                return
+            self._sleep(at - last)
+            last = at
+            yield line.encode("utf-8")
+
+    def close(self):
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class RecordingResponse:
+    """Envuelve una respuesta real y la graba al terminar de consumirla."""
+
+    _TERMINAL = ("message_stop", "[DONE]", '"done":true', '"done": true')
+
+    def __init__(self, resp, cassette: Cassette, h: str, started: float):
+        self._resp     = resp
+        self._cassette = cassette
+        self._hash     = h
+        self._ttfb     = time.perf_counter() - started
+        self._lines    = None
+        self._recorded = False
+
+    def __getattr__(self, name):
+        return getattr(self._resp, name)
+
+    def _base(self) -> dict:
+        return {"status": self._resp.status_code, "ttfb": round(self._ttfb, 4),
+                "headers": {"content-type": self._resp.headers.get("content-type", "")}}
+
+    def record_body(self):
+        self._recorded = True
+        self._cassette.append(self._hash, {**self._base(), "body": self._resp.text})
+
+    def iter_lines(self, *args, **kwargs):
+        self._lines, t0 = [], time.perf_counter()
+        for line in self._resp.iter_lines(*args, **kwargs):
+            text = line.decode("utf-8") if isinstance(line, bytes) else line
+            self._lines.append((round(time.perf_counter() - t0, 4), text))
+            yield line
+        self._record_stream(complete=True)
+
+    def _record_stream(self, complete: bool):
+        # Sólo se graban streams completos (agotados o cortados tras el evento final)
+        if self._recorded or self._lines is None:
+            return
+        nonempty = [text for _, text in self._lines if text]
+        if complete or (nonempty and any(t in nonempty[-1] for t in self._TERMINAL)):
+            self._recorded = True
+            self._cassette.append(self._hash, {**self._base(), "lines": self._lines})
+
+    def close(self):
+        self._record_stream(complete=False)
+        self._resp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+CASSETTE = Cassette(CASSETTE_DIR) if UPSTREAM_MODE in ("record", "replay") else None
+
+def upstream_post(url: str, *, json: dict | None = None, headers: dict | None = None,
+                  stream: bool = False, timeout: float | None = None,
+                  priority: str = "interactive", cancelled=None):
+    """POST upstream pasando por el scheduler: espera slot según `priority` y
+    lo retiene hasta que se cierra la respuesta (los streams, hasta el final)."""
+    scheduler = SCHEDULERS["anthropic" if url == ANTHROPIC_URL else "ollama"]
+    key       = key_id((headers or {}).get("x-api-key"))
+    with span("upstream.queue", priority=priority):
+        ticket = scheduler.acquire(priority, key, time.monotonic() + SCHED_DEADLINES[priority], cancelled)
+    try:
+        resp = _post(url, json=json, headers=headers, stream=stream, timeout=timeout)
+    except BaseException:
+        ticket.release()
+        raise
+    if not stream:
+        ticket.release()
+        return resp
+    close = resp.close
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            ticket.release()
+    resp.close = close_and_release
+    return resp
+
+def _post(url: str, *, json: dict | None = None, headers: dict | None = None,
+          stream: bool = False, timeout: float | None = None):
+    """POST upstream según UPSTREAM_MODE (live | record | replay)."""
+    if UPSTREAM_MODE == "replay":
+        h = request_hash(url, json)
+        try:
+            record = CASSETTE.next(h)
+        except CassetteMiss:
+            if CASSETTE_MISS != "live":
+                raise requests.ConnectionError(f"Cassette: petición no grabada ({h[:12]})")
+            log.warning(f"Cassette: miss {h[:12]} → live")
+            return requests.post(url, json=json, headers=headers, stream=stream, timeout=timeout)
+        resp = ReplayResponse(record, CASSETTE_SPEED)
+        resp._sleep(record.get("ttfb", 0))
+        return resp
+
+    started = time.perf_counter()
+    resp = requests.post(url, json=json, headers=headers, stream=stream, timeout=timeout)
+    if UPSTREAM_MODE == "record":
+        rec = RecordingResponse(resp, CASSETTE, request_hash(url, json), started)
+        if not stream:
+            rec.record_body()
+        return rec
+    return resp
+
+# ── Presupuestos ──────────────────────────────────────────────────
+# Antes de cada llamada upstream se estima el coste en el peor caso
+# (tokens de entrada + max_tokens completos) y se reserva contra ventanas
+# móviles por API key y por conversación. Al terminar se liquida con el
+# `usage` real. Los contadores viven en memoria y se persisten cada
+# BUDGET_PERSIST_SECONDS en data/budgets.json.
+class BudgetExceeded(Exception):
+    def __init__(self, scope: str, limit: float, spent: float, estimate: float):
+        super().__init__(f"Presupuesto agotado ({scope}): gastado ${spent:.4f} "
+                         f"+ estimado ${estimate:.4f} > límite ${limit:.2f}")
+        self.scope    = scope
+        self.limit    = limit
+        self.spent    = spent
+        self.estimate = estimate
+
+    def to_dict(self) -> dict:
+        return {
+            "error":    str(self),
+            "scope":    self.scope,
+            "limit":    self.limit,
+            "spent":    round(self.spent, 6),
+            "estimate": round(self.estimate, 6),
+        }
+
+def model_price(model: str) -> dict:
+    """USD por millón de tokens. Modelos Claude desconocidos → el más caro."""
+    for m in AVAILABLE_MODELS:
+        if m["id"] == model:
+            return m.get("price", {"input": 0.0, "output": 0.0})
+    if model.startswith("claude"):
+        return max((m["price"] for m in AVAILABLE_MODELS if "price" in m), key=lambda p: p["output"])
+    return {"input": 0.0, "output": 0.0}
+
+def requested_max_tokens(data: dict) -> int:
+    """max_tokens del body como entero positivo (lo normaliza en `data`) o BodyError 400."""
+    value = data.get("max_tokens", MAX_TOKENS)
+    try:
+        if isinstance(value, bool) or float(value) != int(value):
+            raise ValueError
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        raise BodyError("max_tokens debe ser un entero positivo")
+    if value <= 0:
+        raise BodyError("max_tokens debe ser un entero positivo")
+    if "max_tokens" in data:
+        data["max_tokens"] = value
+    return value
+
+def estimate_input_tokens(data: dict) -> int:
+    """Misma heurística que log_request: ~4 caracteres por token."""
+    messages = data.get("messages", [])
+    chars    = sum(len(str(m.get("content", ""))) for m in messages) + blob_chars(messages)
+    return (chars + len(str(data.get("system") or ""))) // 4
+
+def usage_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    price = model_price(model)
+    return (input_tokens * price["input"] + output_tokens * price["output"]) / 1e6
+
+class Reservation:
+    __slots__ = ("scopes", "model", "estimate", "settled")
+
+    def __init__(self, scopes: list, model: str, estimate: float):
+        self.scopes   = scopes
+        self.model    = model
+        self.estimate = estimate
+        self.settled  = False
+
+class BudgetLedger:
+    """Gasto por ámbito en buckets de un minuto (hash `budget:<ámbito>` en STATE); la ventana es móvil."""
+
+    def __init__(self, path: Path, window_s: float):
+        self.path     = path
+        self.window_s = window_s
+        self._dirty   = False
+        if STATE.local:
+            self._load()
+
+    def _load(self):
+        try:
+            raw = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return
+        for scope, buckets in raw.items():
+            for b, v in buckets.items():
+                STATE.hincr(f"budget:{scope}", str(int(b)), v, self.window_s + 120)
+
+    def _buckets(self, scope: str, now: float) -> dict:
+        buckets = STATE.hgetall(f"budget:{scope}")
+        cutoff  = now - self.window_s - 60
+        old     = [b for b in buckets if int(b) < cutoff]
+        if old:
+            STATE.hdel(f"budget:{scope}", *old)
+        return {int(b): v for b, v in buckets.items() if int(b) >= cutoff}
+
+    def total(self, scope: str) -> float:
+        return sum(self._buckets(scope, time.time()).values())
+
+    def add(self, scope: str, usd: float):
+        if not usd:
+            return
+        bucket = int(time.time() // 60) * 60
+        STATE.hincr(f"budget:{scope}", str(bucket), usd, self.window_s + 120)
+        self._dirty = True
+
+    def persist(self):
+        """Con memory:// guarda los contadores en disco; los otros backends ya persisten."""
+        if not STATE.local or not self._dirty:
+            return
+        self._dirty = False
+        now      = time.time()
+        snapshot = {}
+        for key in STATE.keys("budget:"):
+            buckets = self._buckets(key[len("budget:"):], now)
+            if buckets:
+                snapshot[key[len("budget:"):]] = buckets
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(snapshot), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+class BudgetManager:
+    def __init__(self, ledger: BudgetLedger, key_limit: float, conv_limit: float, mode: str):
+        self.ledger     = ledger
+        self.key_limit  = key_limit
+        self.conv_limit = conv_limit
+        self.mode       = mode
+        self._lock      = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.key_limit > 0 or self.conv_limit > 0
+
+    def _scopes(self, api_key: str, conversation: str | None) -> list:
+        scopes = []
+        if self.key_limit > 0:
+            scopes.append((f"key:{key_id(api_key)}", self.key_limit))
+        if self.conv_limit > 0 and conversation:
+            scopes.append((f"conv:{conversation}", self.conv_limit))
+        return scopes
+
+    def _check(self, scopes: list, estimate: float):
+        for scope, limit in scopes:
+            spent = self.ledger.total(scope)
+            if spent + estimate > limit:
+                raise BudgetExceeded(scope, limit, spent, estimate)
+
+    def _headroom(self, scopes: list) -> float:
+        return min(limit - self.ledger.total(scope) for scope, limit in scopes)
+
+    def reserve(self, data: dict, api_key: str) -> Reservation | None:
+        """Reserva el coste en el peor caso o lanza BudgetExceeded.
+
+        En modo `downgrade` ajusta `data` in situ: primero recorta max_tokens
+        hasta BUDGET_MIN_TOKENS y, si no basta, prueba modelos más baratos.
+        """
+        max_tok = requested_max_tokens(data)
+        if not self.enabled:
+            return None
+        scopes = self._scopes(api_key, data.get("conversation_id"))
+        if not scopes:
+            return None
+        model   = data.get("model", DEFAULT_MODEL)
+        in_tok  = estimate_input_tokens(data)
+        with self._lock:
+            estimate = usage_cost(model, in_tok, max_tok)
+            try:
+                self._check(scopes, estimate)
+            except BudgetExceeded:
+                if self.mode != "downgrade":
+                    raise
+                model, max_tok, estimate = self._downgrade(scopes, model, in_tok, max_tok)
+                log.warning(f"[budget] downgrade → model={model} max_tokens={max_tok}",
+                            extra={"model": model})
+                data["model"], data["max_tokens"] = model, max_tok
+            for scope, _ in scopes:
+                self.ledger.add(scope, estimate)
+        return Reservation(scopes, model, estimate)
+
+    def _downgrade(self, scopes: list, model: str, in_tok: int, max_tok: int) -> tuple:
+        headroom   = self._headroom(scopes)
+        candidates = [model] + [m["id"] for m in sorted(
+            (m for m in AVAILABLE_MODELS if "price" in m and m["id"] != model),
+            key=lambda m: m["price"]["output"],
+        ) if usage_cost(m["id"], in_tok, max_tok) < usage_cost(model, in_tok, max_tok)]
+        for cand in candidates:
+            price = model_price(cand)
+            fixed = in_tok * price["input"] / 1e6
+            if not price["output"]:
+                return cand, max_tok, fixed
+            fits  = int((headroom - fixed) * 1e6 / price["output"])
+            if fits >= BUDGET_MIN_TOKENS:
+                tokens = min(max_tok, fits)
+                return cand, tokens, usage_cost(cand, in_tok, tokens)
+        raise BudgetExceeded(scopes[0][0], scopes[0][1], scopes[0][1] - headroom,
+                             usage_cost(model, in_tok, max_tok))
+
+    def settle(self, reservation: Reservation | None, usage: dict | None = None):
+        """Sustituye la reserva por el coste real (0 si la llamada falló)."""
+        if reservation is None or reservation.settled:
+            return
+        reservation.settled = True
+        usage  = usage or {}
+        actual = usage_cost(reservation.model, usage.get("input_tokens", 0) or 0,
+                            usage.get("output_tokens", 0) or 0)
+        for scope, _ in reservation.scopes:
+            self.ledger.add(scope, actual - reservation.estimate)
+
+    def status(self, api_key: str | None = None, conversation: str | None = None) -> dict:
+        out = {"mode": self.mode, "window_hours": self.ledger.window_s / 3600, "scopes": []}
+        for scope, limit in self._scopes(api_key, conversation):
+            spent = self.ledger.total(scope)
+            out["scopes"].append({"scope": scope, "limit": limit, "spent": round(spent, 6),
+                                  "remaining": round(max(0.0, limit - spent), 6)})
+        return out
+
+def reserve_payload(payload: dict, data: dict, api_key: str) -> Reservation | None:
+    """Reserva para un payload ya construido (enhance/review); aplica el downgrade."""
+    req = {**payload, "conversation_id": data.get("conversation_id")}
+    reservation = BUDGETS.reserve(req, api_key)
+    payload["model"], payload["max_tokens"] = req["model"], req["max_tokens"]
+    return reservation
+
+BUDGETS = BudgetManager(
+    BudgetLedger(DATA_DIR / "budgets.json", BUDGET_WINDOW_HOURS * 3600),
+    BUDGET_KEY_USD, BUDGET_CONVERSATION_USD, BUDGET_MODE,
+)
+
+def _budget_persister():
+    while True:
+        time.sleep(BUDGET_PERSIST_SECONDS)
+        try:
+            BUDGETS.ledger.persist()
+        except OSError:
+            log.exception("Budget: error persistiendo contadores")
+
+threading.Thread(target=_budget_persister, name="budget-persist", daemon=True).start()
+atexit.register(BUDGETS.ledger.persist)
+
+# ── Router de modelos ("auto") ────────────────────────────────────
+# Con `model: "auto"` un clasificador lineal barato elige el tier a partir de
+# tokens de entrada, presencia de código, longitud de salida pedida y rol
+# del agente. Cada resultado (latencia y calidad: error, truncado, o la nota
+# que llegue por /api/router/feedback) se acumula en EWMAs por ruta y modelo:
+# una ruta cuyo tier rinde mal sube de tier, y una decisión en el límite baja
+# al tier inferior si éste ya ha demostrado calidad suficiente en esa ruta
+# (el margen se ensancha cuanto más lento es el tier superior que el inferior).
+# Las rutas son endpoint × rol conocido: un agente fuera de ROUTER_ROLE_BIAS
+# cuenta como "other", y sólo se guardan estadísticas de los modelos tier.
+_CODE_RE = re.compile(r"```|^\s*(def |class |function |import |#include|public |SELECT )|[;{}]\s*$", re.M)
+
+# Sesgo por rol: negativo → tier más barato, positivo → más capaz
+ROUTER_ROLE_BIAS = {
+    "classifier": -1.5, "classify": -1.5, "detector": -1.5, "router": -1.5, "title": -1.5,
+    "extractor": -1.0, "summarizer": -1.0, "rewrite": -1.0, "enhancer": -1.0, "translator": -0.5,
+    "reviewer": 0.5, "executor": 0.5, "coder": 1.0, "planner": 1.0, "architect": 1.5,
+}
+
+ROUTER_ENDPOINTS = ("chat", "stream", "stream_multi", "ws", "agent", "enhance", "review")
+
+def router_route(endpoint: str, agent: str | None) -> str:
+    agent = str(agent or "").lower()
+    return f"{endpoint}:{agent if agent in ROUTER_ROLE_BIAS else ('other' if agent else '-')}"
+
+class ModelRouter:
+    def __init__(self, tiers: list, thresholds: list):
+        self.tiers      = tiers          # ids de modelo, del más barato al más capaz
+        self.thresholds = thresholds     # score mínimo para cada tier a partir del 1
+        self.stats      = {}             # (ruta, modelo) → {"n", "latency_ms", "quality"}
+        self._lock      = threading.Lock()
+
+    @staticmethod
+    def features(data: dict) -> dict:
+        text = "\n".join(str(m.get("content", "")) for m in data.get("messages", [])[-4:])
+        return {
+            "tokens":     estimate_input_tokens(data),
+            "code":       bool(_CODE_RE.search(text)),
+            "max_tokens": requested_max_tokens(data) if "max_tokens" in data else None,
+            "agent":      str(data.get("agent") or "").lower(),
+        }
+
+    @staticmethod
+    def score(f: dict) -> float:
+        s  = min(math.log2(1 + f["tokens"] / 250), 5) * 0.4      # 0 … 2
+        s += 1.0 if f["code"] else 0.0
+        if f["max_tokens"]:
+            s += min(math.log2(1 + f["max_tokens"] / 512), 3) * 0.4
+        return s + ROUTER_ROLE_BIAS.get(f["agent"], 0.0)
+
+    def _stat(self, route: str, model: str) -> dict | None:
+        st = self.stats.get((route, model))
+        return st if st and st["n"] >= ROUTER_MIN_SAMPLES else None
+
+    def route(self, data: dict, endpoint: str) -> dict:
+        f     = self.features(data)
+        score = self.score(f)
+        tier  = sum(score >= t for t in self.thresholds[:len(self.tiers) - 1])
+        route = router_route(endpoint, f["agent"])
+        reason = "classifier"
+        with self._lock:
+            while tier < len(self.tiers) - 1:
+                st = self._stat(route, self.tiers[tier])
+                if not st or st["quality"] >= ROUTER_MIN_QUALITY:
+                    break
+                tier, reason = tier + 1, "escalated"
+            if reason == "classifier" and tier > 0:
+                lower, upper = self._stat(route, self.tiers[tier - 1]), self._stat(route, self.tiers[tier])
+                # Si el tier elegido es más lento que el inferior, el margen crece en proporción
+                slowdown = 1.0
+                if lower and upper and lower["latency_ms"] and upper["latency_ms"]:
+                    slowdown = min(max(upper["latency_ms"] / lower["latency_ms"], 1.0), 4.0)
+                over = score - self.thresholds[tier - 1]
+                if lower and lower["quality"] >= ROUTER_MIN_QUALITY and over < ROUTER_MARGIN * slowdown:
+                    tier, reason = tier - 1, "learned" if over < ROUTER_MARGIN else "latency"
+        decision = {"model": self.tiers[tier], "tier": tier, "score": round(score, 2),
+                    "reason": reason, "route": route}
+        log.debug(f"[router] {route} score={score:.2f} → {decision['model']} ({reason})",
+                  extra={"endpoint": endpoint, "model": decision["model"]})
+        return decision
+
+    def observe(self, endpoint: str, agent: str | None, model: str,
+                latency_ms: float | None, quality: float):
+        if model not in self.tiers:
+            return          # modelo pedido explícitamente: no es decisión del router
+        key = (router_route(endpoint, agent), model)
+
+        def ewma(old, new):
+            if old is None or new is None:
+                return new if old is None else old
+            return (1 - ROUTER_EWMA_ALPHA) * old + ROUTER_EWMA_ALPHA * new
+
+        with self._lock:
+            st = self.stats.setdefault(key, {"n": 0, "latency_ms": None, "quality": None})
+            st["n"]         += 1
+            st["latency_ms"] = ewma(st["latency_ms"], latency_ms)
+            st["quality"]    = ewma(st["quality"], quality)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "tiers":      self.tiers,
+                "thresholds": self.thresholds[:len(self.tiers) - 1],
+                "routes":     [{"route": r, "model": m, "n": st["n"],
+                                "latency_ms": st["latency_ms"] and round(st["latency_ms"], 1),
+                                "quality":    round(st["quality"], 3)}
+                               for (r, m), st in sorted(self.stats.items())],
+            }
+
+def outcome_quality(stop_reason: str | None, failed: bool) -> float:
+    """Señal de calidad implícita: error 0, salida truncada 0.5, completa 1."""
+    if failed:
+        return 0.0
+    return 0.5 if stop_reason == "max_tokens" else 1.0
+
+def resolve_model(data: dict, endpoint: str) -> dict | None:
+    """Sustituye `model: "auto"` por el tier elegido (modifica data)."""
+    if data.get("model") != "auto":
+        return None
+    decision = ROUTER.route(data, endpoint)
+    data["model"] = decision["model"]
+    current_trace().annotate(route_model=decision["model"], route_score=decision["score"],
+                             route_reason=decision["reason"])
+    return decision
+
+ROUTER = ModelRouter(
+    [m.strip() for m in ROUTER_TIERS.split(",") if m.strip()]
+    or [m["id"] for m in sorted((m for m in AVAILABLE_MODELS if m["provider"] == "anthropic"),
+                                key=lambda m: m["price"]["output"])],
+    ROUTER_THRESHOLDS,
+)
+
+# ── Rutas estáticas ───────────────────────────────────────────────
+# Los assets pequeños se cargan en memoria al arrancar, con variantes
+# gzip/brotli precalculadas y ETag fuerte. Cada asset tiene además una URL
+# con hash de contenido (index.<hash>.html) servible como `immutable`.
+# Lo que no está en memoria (grande o no listado) cae a send_from_directory.
+_STATIC_EXTS     = {".html", ".js", ".jsx", ".mjs", ".css", ".json", ".map", ".svg", ".txt",
+                    ".ico", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".woff", ".woff2"}
+_COMPRESSIBLE    = {".html", ".js", ".jsx", ".mjs", ".css", ".json", ".map", ".svg", ".txt"}
+_STATIC_SKIP     = {"logs", "data", "venv", ".venv", "__pycache__", "node_modules"}
+_IMMUTABLE       = "public, max-age=31536000, immutable"
+
+class StaticAsset:
+    __slots__ = ("name", "path", "mtime", "mimetype", "digest", "hashed_name", "variants")
+
+    def __init__(self, name: str, path: Path, body: bytes):
+        ext              = path.suffix.lower()
+        self.name        = name
+        self.path        = path
+        self.mtime       = path.stat().st_mtime
+        self.mimetype    = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if self.mimetype.startswith("text/") or ext in (".js", ".jsx", ".mjs", ".json", ".svg"):
+            self.mimetype += "; charset=utf-8"
+        self.digest      = hashlib.sha256(body).hexdigest()[:16]
+        stem, dot, sfx   = name.rpartition(".")
+        self.hashed_name = f"{stem}.{self.digest[:10]}.{sfx}" if dot else f"{name}.{self.digest[:10]}"
+        self.variants    = {"identity": body}
+        if ext in _COMPRESSIBLE and len(body) >= 256:
+            gz = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(gz) < len(body):
+                self.variants["gzip"] = gz
+            if brotli is not None:
+                br = brotli.compress(body, quality=11)
+                if len(br) < len(body):
+                    self.variants["br"] = br
+
+    def etag(self, encoding: str) -> str:
+        return self.digest if encoding == "identity" else f"{self.digest}-{encoding}"
+
+def _accepted_encodings(header: str) -> dict:
+    """Accept-Encoding → {codificación: q}."""
+    out = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            out[name.lower()] = q
+    return out
+
+class StaticAssets:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root      = root
+        self.max_bytes = max_bytes
+        self._assets   = {}
+        self._hashed   = {}
+        self._lock     = threading.Lock()
+        self.load()
+
+    def _candidates(self):
+        for path in sorted(self.root.rglob("*")):
+            rel = path.relative_to(self.root)
+            if any(p.startswith(".") or p in _STATIC_SKIP for p in rel.parts):
+                continue
+            if path.is_file() and path.suffix.lower() in _STATIC_EXTS and path.stat().st_size <= self.max_bytes:
+                yield rel.as_posix(), path
+
+    def load(self):
+        assets = {}
+        pages  = []
+        for name, path in self._candidates():
+            if path.suffix.lower() == ".html":
+                pages.append((name, path))
+            else:
+                assets[name] = StaticAsset(name, path, path.read_bytes())
+        # Las páginas van al final: sus referencias locales se reescriben a URLs con hash
+        for name, path in pages:
+            assets[name] = StaticAsset(name, path, self._rewrite(path.read_text(encoding="utf-8"), assets))
+        with self._lock:
+            self._assets = assets
+            self._hashed = {a.hashed_name: a for a in assets.values()}
+        total = sum(len(v) for a in assets.values() for v in a.variants.values())
+        log.info(f"Static: {len(assets)} assets en memoria ({total // 1024} KB con variantes)")
+
+    @staticmethod
+    def _rewrite(html: str, assets: dict) -> bytes:
+        def sub(m):
+            ref = m.group(2).lstrip("./").lstrip("/")
+            asset = assets.get(ref)
+            return f'{m.group(1)}="/{asset.hashed_name}"' if asset else m.group(0)
+        return re.sub(r'\b(src|href)="((?:\./|/)?[^":?#]+)"', sub, html).encode("utf-8")
+
+    def lookup(self, name: str) -> tuple:
+        """→ (asset, immutable) o (None, False)."""
+        with self._lock:
+            asset = self._hashed.get(name)
+            if asset is not None:
+                return asset, True
+            asset = self._assets.get(name)
+        if asset is not None and DEBUG and asset.path.stat().st_mtime != asset.mtime:
+            self.load()
+            return self.lookup(name)
+        return asset, False
+
+    def manifest(self) -> dict:
+        with self._lock:
+            return {name: f"/{a.hashed_name}" for name, a in self._assets.items()}
+
+    def respond(self, asset: StaticAsset, immutable: bool) -> Response:
+        accepted = _accepted_encodings(request.headers.get("Accept-Encoding", ""))
+        encoding = "identity"
+        for enc in ("br", "gzip"):
+            if enc in asset.variants and accepted.get(enc, accepted.get("*", 0)) > 0:
+                encoding = enc
+                break
+        etag = asset.etag(encoding)
+        headers = {
+            "ETag":          f'"{etag}"',
+            "Vary":          "Accept-Encoding",
+            "Cache-Control": _IMMUTABLE if immutable else "no-cache",
+        }
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        return Response(asset.variants[encoding], content_type=asset.mimetype, headers=headers)
+
+ASSETS = StaticAssets(BASE_DIR, STATIC_MAX_BYTES)
+
+def asset_url(name: str) -> str:
+    """URL con hash de contenido para un asset (o la ruta tal cual si no está en memoria)."""
+    asset, _ = ASSETS.lookup(name)
+    return f"/{asset.hashed_name}" if asset else f"/{name}"
+
+@app.route("/")
+def index():
+    asset, _ = ASSETS.lookup("index.html")
+    if asset is not None:
+        return ASSETS.respond(asset, immutable=False)
+    return send_from_directory(str(BASE_DIR), "index.html")
+
+@app.route("/<path:filename>")
+def static_files(filename):
+    asset, immutable = ASSETS.lookup(filename)
+    if asset is not None:
+        return ASSETS.respond(asset, immutable)
+    return send_from_directory(str(BASE_DIR), filename)
+
+@app.route("/api/assets")
+def asset_manifest():
+    return jsonify({"assets": ASSETS.manifest()})
+
+# ── Ollama: backends y warm pool ──────────────────────────────────
+# OLLAMA_HOSTS admite varios nodos. Cada petición va al nodo sano con menos
+# peticiones en curso, prefiriendo los que ya tienen el modelo cargado (y si
+# no, los que lo tienen descargado en disco). Los health checks periódicos
+# y los errores de conexión expulsan un nodo durante OLLAMA_EJECT_SECONDS.
+#
+# Por nodo: precarga los modelos de OLLAMA_PRELOAD, fija `keep_alive` por
+# modelo en cada petición, sigue qué modelos están residentes (/api/ps) y,
+# con OLLAMA_MEM_BUDGET_MB, descarga por LRU (keep_alive 0) los que hagan
+# falta antes de cargar uno nuevo, en vez de dejar que Ollama haga thrashing.
+def _duration_seconds(value: str) -> float:
+    """"30m" / "1h" / "45s" / "300" → segundos; negativo → para siempre."""
+    value = str(value).strip()
+    units = {"s": 1, "m": 60, "h": 3600}
+    try:
+        if value[-1:] in units:
+            secs = float(value[:-1]) * units[value[-1]]
+        else:
+            secs = float(value)
+    except ValueError:
+        return 0.0
+    return float("inf") if secs < 0 else secs
+
+def ollama_name(model: str) -> str:
+    """Nombre canónico de Ollama: /api/ps y /api/tags dicen "llama3.2:latest"
+    aunque la petición diga "llama3.2"."""
+    return model if ":" in model.rsplit("/", 1)[-1] else f"{model}:latest"
+
+def ollama_options(data: dict) -> dict:
+    """`options` de Ollama a partir del body: max_tokens → num_predict (lo que
+    reservó el presupuesto) y temperature si viene."""
+    options = {"num_predict": requested_max_tokens(data)}
+    if isinstance(data.get("temperature"), (int, float)):
+        options["temperature"] = data["temperature"]
+    return options
+
+class OllamaBackend:
+    def __init__(self, host: str, keep_alive: str, per_model: dict, budget_mb: int):
+        self.host          = host
+        self.keep_alive    = keep_alive
+        self.per_model     = {ollama_name(m): ka for m, ka in per_model.items()}
+        self.budget_mb     = budget_mb
+        self.sizes         = {}     # modelo → MB (de /api/tags)
+        self.resident      = {}     # modelo → {"size_mb", "expires_at", "last_used"}
+        self.inflight      = {}     # modelo → peticiones en curso (no se desalojan)
+        self.outstanding   = 0
+        self.failures      = 0
+        self.ejected_until = 0.0
+        self._lock         = threading.Lock()
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.time()
+
+    def mark_ok(self):
+        with self._lock:
+            self.failures, self.ejected_until = 0, 0.0
+
+    def mark_failed(self, reason: str):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= OLLAMA_EJECT_FAILURES and self.healthy:
+                self.ejected_until = time.time() + OLLAMA_EJECT_SECONDS
+                log.warning(f"[ollama] {self.host} expulsado {OLLAMA_EJECT_SECONDS:g}s ({reason})")
+
+    def keep_alive_for(self, model: str) -> str:
+        return self.per_model.get(ollama_name(model), self.keep_alive)
+
+    def is_warm(self, model: str) -> bool:
+        with self._lock:
+            r = self.resident.get(ollama_name(model))
+            return bool(r and r["expires_at"] > time.time())
+
+    def refresh(self):
+        """Health check: sincroniza tamaños (/api/tags) y residentes (/api/ps)."""
+        try:
+            tags = requests.get(f"{self.host}/api/tags", timeout=2)
+            ps   = requests.get(f"{self.host}/api/ps", timeout=2)
+        except requests.RequestException as e:
+            self.mark_failed(type(e).__name__)
+            return
+        if not tags.ok:
+            self.mark_failed(f"HTTP {tags.status_code}")
+            return
+        self.mark_ok()
+        now  = time.time()
+        with self._lock:
+            self.sizes = {ollama_name(m["name"]): m.get("size", 0) / 1048576 for m in tags.json().get("models", [])}
+            if ps.ok:
+                seen = {}
+                for m in ps.json().get("models", []):
+                    name = ollama_name(m["name"])
+                    try:
+                        expires = datetime.fromisoformat(m["expires_at"].replace("Z", "+00:00")).timestamp()
+                    except (KeyError, ValueError):
+                        expires = now + _duration_seconds(self.keep_alive_for(name))
+                    prev = self.resident.get(name, {})
+                    seen[name] = {
+                        "size_mb":    (m.get("size_vram") or m.get("size", 0)) / 1048576,
+                        "expires_at": expires,
+                        "last_used":  prev.get("last_used", now),
+                    }
+                self.resident = seen
+
+    def _unload(self, model: str):
+        try:
+            requests.post(f"{self.host}/api/generate", json={"model": model, "keep_alive": 0}, timeout=10)
+            log.info(f"[ollama] {model} descargado (LRU, presupuesto {self.budget_mb} MB)")
+        except requests.RequestException as e:
+            log.warning(f"[ollama] no se pudo descargar {model}: {e}")
+
+    def acquire(self, model: str):
+        """Antes de usar un modelo: hacer sitio por LRU si no está residente."""
+        model = ollama_name(model)
+        evict = []
+        with self._lock:
+            self.outstanding    += 1
+            self.inflight[model] = self.inflight.get(model, 0) + 1
+            if self.budget_mb and model not in self.resident:
+                used = sum(r["size_mb"] for r in self.resident.values())
+                need = self.sizes.get(model, 0)
+                for name, r in sorted(self.resident.items(), key=lambda kv: kv[1]["last_used"]):
+                    if used + need <= self.budget_mb:
+                        break
+                    if self.inflight.get(name):
+                        continue
+                    evict.append(name)
+                    used -= r["size_mb"]
+                for name in evict:
+                    del self.resident[name]
+        for name in evict:
+            self._unload(name)
+
+    def release(self, model: str, ok: bool = True):
+        model, now = ollama_name(model), time.time()
+        with self._lock:
+            self.outstanding     = max(self.outstanding - 1, 0)
+            self.inflight[model] = max(self.inflight.get(model, 1) - 1, 0)
+            if ok:
+                r = self.resident.setdefault(model, {"size_mb": self.sizes.get(model, 0)})
+                r["last_used"]  = now
+                r["expires_at"] = now + _duration_seconds(self.keep_alive_for(model))
+
+    def preload(self, model: str):
+        self.acquire(model)
+        ok = False
+        try:
+            # generate sin prompt sólo carga el modelo en memoria
+            r  = requests.post(f"{self.host}/api/generate",
+                               json={"model": model, "keep_alive": self.keep_alive_for(model)}, timeout=300)
+            ok = r.ok
+            log.info(f"[ollama] {model} precargado en {self.host}" if ok
+                     else f"[ollama] precarga de {model} en {self.host}: HTTP {r.status_code}")
+        except requests.RequestException as e:
+            log.warning(f"[ollama] precarga de {model} fallida: {e}")
+        finally:
+            self.release(model, ok)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "healthy":     self.healthy,
+                "outstanding": self.outstanding,
+                "budget_mb":   self.budget_mb,
+                "used_mb":   round(sum(r["size_mb"] for r in self.resident.values())),
+                "resident":  {name: {"size_mb": round(r["size_mb"]), "expires_in": round(r["expires_at"] - time.time()),
+                                     "inflight": self.inflight.get(name, 0)}
+                              for name, r in self.resident.items()},
+            }
+
+class OllamaPool:
+    def __init__(self, backends: list):
+        self.backends = backends
+
+    def keep_alive_for(self, model: str) -> str:
+        return self.backends[0].keep_alive_for(model)
+
+    def is_warm(self, model: str) -> bool:
+        return any(b.is_warm(model) for b in self.backends if b.healthy)
+
+    def pick(self, model: str, exclude=()) -> OllamaBackend:
+        """Menos peticiones en curso, con afinidad: residente > en disco > cualquiera."""
+        model      = ollama_name(model)
+        candidates = [b for b in self.backends if b not in exclude]
+        healthy    = [b for b in candidates if b.healthy] or candidates
+        for group in ([b for b in healthy if b.is_warm(model)],
+                      [b for b in healthy if model in b.sizes],
+                      healthy):
+            if group:
+                return min(group, key=lambda b: b.outstanding)
+        raise requests.ConnectionError("No quedan backends Ollama")
+
+    def post(self, path: str, model: str, payload: dict, **kwargs):
+        """POST al mejor backend; si no conecta, se expulsa y se reintenta en otro.
+
+        Devuelve (backend, respuesta) con el backend ya adquirido: el llamante
+        debe hacer backend.release(model, ok) al terminar.
+        """
+        tried = []
+        while True:
+            backend = self.pick(model, exclude=tried)
+            backend.acquire(model)
+            try:
+                resp = upstream_post(f"{backend.host}{path}", json=payload, **kwargs)
+            except requests.ConnectionError as e:
+                backend.release(model, False)
+                backend.mark_failed(type(e).__name__)
+                tried.append(backend)
+                if len(tried) >= len(self.backends):
+                    raise
+                continue
+            except BaseException:
+                backend.release(model, False)
+                raise
+            if resp.status_code >= 500:
+                backend.mark_failed(f"HTTP {resp.status_code}")
+            return backend, resp
+
+    def models(self) -> dict:
+        """Modelos de todos los backends sanos: nombre → {size_mb, backends, warm}."""
+        merged = {}
+        for b in self.backends:
+            if not b.healthy:
+                continue
+            for name, size in b.sizes.items():
+                m = merged.setdefault(name, {"size_mb": round(size), "backends": [], "warm": False})
+                m["backends"].append(b.host)
+                m["warm"] = m["warm"] or b.is_warm(name)
+        return merged
+
+    def status(self) -> dict:
+        return {b.host: b.status() for b in self.backends}
+
+OLLAMA = OllamaPool([
+    OllamaBackend(host, OLLAMA_KEEP_ALIVE,
+                  dict(item.split("=", 1) for item in OLLAMA_KEEP_ALIVE_MODELS.split(",") if "=" in item),
+                  OLLAMA_MEM_BUDGET_MB)
+    for host in OLLAMA_HOSTS
+])
+
+def _ollama_preload():
+    for model in filter(None, (m.strip() for m in OLLAMA_PRELOAD.split(","))):
+        OLLAMA.pick(model).preload(model)
+
+def _ollama_warm_pool():
+    # La precarga puede tardar minutos: va aparte para no retrasar el primer
+    # refresh, del que viven /api/models y la elección de nodo
+    for b in OLLAMA.backends:
+        b.refresh()
+    threading.Thread(target=_ollama_preload, name="ollama-preload", daemon=True).start()
+    while True:
+        time.sleep(OLLAMA_POLL_SECONDS)
+        for b in OLLAMA.backends:
+            b.refresh()
+
+if UPSTREAM_MODE != "replay":
+    threading.Thread(target=_ollama_warm_pool, name="ollama-pool", daemon=True).start()
+
+# ── Health check ──────────────────────────────────────────────────
+@app.route("/api/health")
+def health():
+    key_ok = validate_key(API_KEY)
+    return jsonify({
+        "status":    "ok",
+        "version":   "2.0.0",
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "api_key":   "configured" if key_ok else "missing",
+        "models":    len(AVAILABLE_MODELS),
+        "ollama":    _check_ollama(),
+        "ollama_pool": OLLAMA.status(),
+        "state":     _check_state(),
+    })
+
+def _check_state() -> str:
+    """Backend de estado compartido y si responde."""
+    name = STATE_URL.partition("://")[0]
+    try:
+        STATE.get("health")
+        return name
+    except Exception as e:
+        return f"{name}: {type(e).__name__}"
+
+def _check_ollama() -> str:
+    states = []
+    for host in OLLAMA_HOSTS:
+        try:
+            r = requests.get(f"{host}/api/tags", timeout=2)
+            states.append("online" if r.ok else "error")
+        except Exception:
+            states.append("offline")
+    if "online" in states:
+        return "online" if all(s == "online" for s in states) else "degraded"
+    return "error" if "error" in states else "offline"
+
+# ── Modelos ───────────────────────────────────────────────────────
+@app.route("/api/models")
+def get_models():
+    models = list(AVAILABLE_MODELS) + [
+        {"id": "auto", "name": "Auto (según complejidad)", "provider": "router", "tiers": ROUTER.tiers},
+    ]
+    # Modelos Ollama de todos los backends, del estado que mantiene el hilo del
+    # pool (refresh cada OLLAMA_POLL_SECONDS): la petición no espera a ningún nodo
+    for name, info in sorted(OLLAMA.models().items()):
+        models.append({
+            "id":       name,
+            "name":     name,
+            "provider": "ollama",
+            "ctx":      8192,
+            **info,
+        })
+    return jsonify({"models": models})
+
+# ── Configuración ─────────────────────────────────────────────────
+@app.route("/api/config")
+def get_config():
+    return jsonify({
+        "model":       DEFAULT_MODEL,
+        "max_tokens":  MAX_TOKENS,
+        "ollama_host": OLLAMA_HOST,
+        "ollama_hosts": OLLAMA_HOSTS,
+        "debug":       DEBUG,
+        "api_key_set": validate_key(API_KEY),
+        "upstream":    UPSTREAM_MODE,
+        "version":     "2.0.0",
+    })
+
+# ── Chat estándar ─────────────────────────────────────────────────
+@app.route("/api/chat", methods=["POST"])
+def chat():
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
+    api_key = extract_key(data)
+
+    if not validate_key(api_key):
+        return jsonify({"error": "API key no configurada. Añade ANTHROPIC_API_KEY al .env"}), 401
+    resolve_model(data, "chat")
+
+    try:
+        with span("budget.reserve"):
+            reservation = BUDGETS.reserve(data, api_key)
+    except BudgetExceeded as e:
+        log.warning(f"[chat] {e}")
+        return jsonify(e.to_dict()), 402
+
+    model = data.get("model", DEFAULT_MODEL)
+    log_request("chat", model, data.get("messages", []))
+
+    # Ollama local
+    if is_ollama(data, model):
+        BUDGETS.settle(reservation)
+        return _ollama_chat(data)
+
+    # Anthropic
+    usage = {}
+    try:
+        with span("payload.build"):
+            payload = build_payload(data, stream=False)
+        with span("upstream.request", kind="client", model=model) as sp:
+            resp = upstream_post(
+                ANTHROPIC_URL,
+                headers=anthropic_headers(api_key),
+                json=payload,
+                timeout=120,
+                priority=request_priority(data),
+            )
+            sp.attrs["status"] = resp.status_code
+        if not resp.ok:
+            log.error(f"Anthropic error {resp.status_code}: {resp.text[:300]}")
+            USAGE.record("chat", model, api_key, {}, (time.perf_counter() - started) * 1000, error=True)
+            ROUTER.observe("chat", data.get("agent"), model, (time.perf_counter() - started) * 1000, 0.0)
+            return jsonify({"error": resp.json()}), resp.status_code
+
+        with span("response.parse"):
+            result = resp.json()
+            text   = "".join(b["text"] for b in result.get("content", []) if b.get("type") == "text")
+        usage = result.get("usage", {})
+        log_usage("chat", model, usage, started, api_key)
+        ROUTER.observe("chat", data.get("agent"), model, (time.perf_counter() - started) * 1000,
+                       outcome_quality(result.get("stop_reason"), False))
+        body = {
+            "content":    text,
+            "model":      result.get("model", model),
+            "usage":      result.get("usage", {}),
+            "stop_reason":result.get("stop_reason", "end_turn"),
+        }
+        calls = tool_calls(result.get("content", []))
+        if calls:
+            # Para continuar: mensaje assistant con `content` tal cual + tool_result del cliente
+            body["tool_calls"] = calls
+            body["content_blocks"] = result.get("content", [])
+        return jsonify(body)
+
+    except requests.Timeout:
+        return jsonify({"error": "Timeout — la respuesta tardó más de 120s"}), 504
+    except SchedulerTimeout as e:
+        return jsonify({"error": str(e)}), 503
+    except BodyError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        log.exception("Error en /api/chat")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        BUDGETS.settle(reservation, usage)
+
+def _ollama_chat(data: dict):
+    """Proxy hacia Ollama para modelos locales."""
+    started = time.perf_counter()
+    try:
+        messages = expand_blobs(data.get("messages", []), text_only=True)
+        model    = data.get("model", "llama3.2")
+        payload  = {"model": model, "messages": messages, "stream": False,
+                    "keep_alive": OLLAMA.keep_alive_for(model), "options": ollama_options(data)}
+        warm     = OLLAMA.is_warm(model)
+        with span("upstream.request", kind="client", provider="ollama", model=model, warm=warm) as sp:
+            backend, resp = OLLAMA.post("/api/chat", model, payload, timeout=300,
+                                        priority=request_priority(data))
+            sp.attrs["backend"] = backend.host
+        backend.release(model, resp.ok)
+        if not resp.ok:
+            return jsonify({"error": "Ollama error"}), 502
+        result   = resp.json()
+        text     = result.get("message", {}).get("content", "")
+        usage    = {"input_tokens":  result.get("prompt_eval_count", 0),
+                    "output_tokens": result.get("eval_count", 0)}
+        log_usage("chat", model, usage, started)
+        return jsonify({"content": text, "model": model, "usage": usage})
+    except Exception as e:
+        return jsonify({"error": f"Ollama: {e}"}), 502
+
+# ── Cancelación de streams ────────────────────────────────────────
+# Cada /api/stream se registra con un id. Cancelarlo (endpoint explícito o
+# desconexión del cliente detectada por el monitor) hace shutdown del socket
+# upstream, con lo que el hilo bloqueado en iter_lines() se despierta al
+# momento y la generación deja de facturarse.
+_STREAM_ID_RE = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+def _upstream_socket(resp):
+    """Socket subyacente de una respuesta de requests (o None si no aplica)."""
+    raw = getattr(resp, "raw", None)
+    conn = getattr(raw, "_connection", None)
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        fp = getattr(getattr(raw, "_fp", None), "fp", None)
+        sock = getattr(getattr(fp, "raw", None), "_sock", None)
+    return sock
+
+def abort_response(resp):
+    """Cierra una respuesta upstream despertando al hilo que la está leyendo."""
+    sock = _upstream_socket(resp)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        resp.close()
+    except Exception:
+        pass
+
+class StreamHandle:
+    """Stream en curso: el productor (hilo upstream) emite eventos numerados a un
+    buffer acotado y los consumidores SSE los leen desde cualquier posición."""
+
+    def __init__(self, stream_id: str, client_sock=None, resumable: bool = False):
+        self.id          = stream_id
+        self.created     = time.time()
+        self.client_sock = client_sock
+        self.resumable   = resumable
+        self.owner       = None          # key_id de quien lo abrió
+        self.reason      = None
+        self.done        = False
+        self.finished_at = None
+        self.detached_at = None
+        self._consumer   = 0             # generación del consumidor enganchado
+        self._resp       = None
+        self._events     = deque(maxlen=SSE_REPLAY_BUFFER)
+        self._seq        = 0
+        self._cancelled  = threading.Event()
+        self._lock       = threading.Lock()
+        self._cond       = threading.Condition(self._lock)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def wait_cancelled(self, timeout: float) -> bool:
+        return self._cancelled.wait(timeout)
+
+    def attach(self, resp):
+        """Asocia la respuesta upstream; si ya estaba cancelado, la aborta."""
+        with self._lock:
+            self._resp = resp
+        if self.cancelled:
+            abort_response(resp)
+
+    def cancel(self, reason: str) -> bool:
+        with self._lock:
+            if self._cancelled.is_set() or self.done:
+                return False
+            self.reason = reason
+            self._cancelled.set()
+            resp = self._resp
+        if resp is not None:
+            abort_response(resp)
+        log.info(f"[stream] {self.id} cancelado ({reason})")
+        return True
+
+    # ── Productor ──
+    def emit(self, event: dict | str):
+        """Añade un evento (dict → JSON, str → tal cual, p.ej. "[DONE]")."""
+        data = event if isinstance(event, str) else json.dumps(event)
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, data))
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self.done        = True
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    # ── Consumidores ──
+    def frames(self, after: int = 0) -> Generator[tuple, None, None]:
+        """(seq, data) con seq > after; (None, None) como keep-alive mientras se espera."""
+        cursor = after
+        while True:
+            with self._cond:
+                if self._events and cursor < self._events[0][0] - 1:
+                    missed = self._events[0][0] - 1 - cursor
+                    cursor = self._events[0][0] - 1
+                    pending = [(None, json.dumps({"error": "replay_gap", "missed": missed}))]
+                else:
+                    pending = []
+                pending += [(seq, data) for seq, data in self._events if seq > cursor]
+                if not pending:
+                    if self.done:
+                        return
+                    self._cond.wait(SSE_KEEPALIVE_SECONDS)
+                    if not any(seq > cursor for seq, _ in self._events) and not self.done:
+                        pending = [(None, None)]
+            for seq, data in pending:
+                if seq is not None:
+                    cursor = seq
+                yield seq, data
+
+    @property
+    def consumer(self) -> int:
+        return self._consumer
+
+    def attach_client(self, client_sock) -> int:
+        """Engancha un consumidor nuevo y devuelve su generación."""
+        with self._lock:
+            self._consumer  += 1
+            self.client_sock = client_sock
+            self.detached_at = None
+            return self._consumer
+
+    def client_gone(self, consumer: int | None = None):
+        """El consumidor se fue: si es reanudable se espera SSE_RESUME_GRACE; si no, se cancela.
+
+        Con `consumer`, sólo cuenta si sigue siendo el actual: el cierre tardío de
+        una conexión ya sustituida por una reanudación no debe soltar a la nueva.
+        """
+        if self.done:
+            return
+        with self._lock:
+            if consumer is not None and consumer != self._consumer:
+                return
+            if self.resumable:
+                self.client_sock = None
+                self.detached_at = self.detached_at or time.time()
+                return
+        self.cancel("client_disconnected")
+
+class StreamRegistry:
+    def __init__(self):
+        self._streams = {}
+        self._lock    = threading.Lock()
+
+    def open(self, stream_id: str | None = None, client_sock=None, resumable: bool = False,
+             cls: type = StreamHandle, owner: str | None = None) -> StreamHandle:
+        with self._lock:
+            # Un id en uso nunca se pisa (los endpoints ya lo rechazan con taken();
+            # esto cubre la carrera entre dos peticiones simultáneas)
+            if not stream_id or not _STREAM_ID_RE.match(stream_id) or stream_id in self._streams:
+                stream_id = os.urandom(8).hex()
+            handle = cls(stream_id, client_sock, resumable)
+            handle.owner = owner
+            self._streams[stream_id] = handle
+        return handle
+
+    def taken(self, stream_id: str | None) -> bool:
+        with self._lock:
+            return bool(stream_id) and stream_id in self._streams
+
+    def register(self, handle: StreamHandle) -> StreamHandle:
+        with self._lock:
+            self._streams[handle.id] = handle
+        return handle
+
+    def close(self, handle: StreamHandle):
+        with self._lock:
+            if self._streams.get(handle.id) is handle:
+                del self._streams[handle.id]
+
+    def get(self, stream_id: str) -> StreamHandle | None:
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    def active(self) -> list:
+        with self._lock:
+            return list(self._streams.values())
+
+    def reap(self):
+        """Cancela streams sin cliente tras la gracia y olvida los terminados."""
+        now = time.time()
+        for h in self.active():
+            if h.done and (not h.resumable or now - h.finished_at > SSE_RESUME_GRACE):
+                self.close(h)
+            elif h.detached_at and now - h.detached_at > SSE_RESUME_GRACE:
+                h.cancel("resume_timeout")
+
+STREAMS = StreamRegistry()
+
+def _monitor_disconnects():
+    """Detecta clientes SSE desconectados (EOF en su socket) y avisa a su stream."""
+    interval  = (SSE_DISCONNECT_POLL_MS or 1000) / 1000
+    last_reap = time.monotonic()
+    while True:
+        time.sleep(interval)
+        if time.monotonic() - last_reap >= 1:
+            STREAMS.reap()
+            last_reap = time.monotonic()
+        watched = {h.client_sock: (h, h.consumer) for h in STREAMS.active()
+                   if SSE_DISCONNECT_POLL_MS and h.client_sock is not None and not h.cancelled and not h.done}
+        if not watched:
+            continue
+        # selectors (epoll/poll) en vez de select(): sin el límite FD_SETSIZE de 1024
+        candidates = set()
+        with selectors.DefaultSelector() as sel:
+            for sock in watched:
+                try:
+                    sel.register(sock, selectors.EVENT_READ)
+                except (OSError, ValueError, KeyError):
+                    candidates.add(sock)        # ya cerrado: se revisa abajo
+            try:
+                candidates.update(key.fileobj for key, _ in sel.select(0))
+            except OSError:
+                candidates.update(watched)
+        for sock in candidates:
+            try:
+                gone = sock.fileno() < 0 or sock.recv(1, socket.MSG_PEEK) == b""
+            except (BlockingIOError, InterruptedError):
+                gone = False
+            except (OSError, ValueError):
+                gone = True
+            if gone:
+                handle, consumer = watched[sock]
+                handle.client_gone(consumer)
+
+threading.Thread(target=_monitor_disconnects, name="sse-monitor", daemon=True).start()
+
+def client_socket():
+    """Socket del cliente HTTP (servidor de werkzeug); None si no es vigilable."""
+    sock = request.environ.get("werkzeug.socket")
+    if sock is None or hasattr(sock, "getpeercert"):   # TLS: MSG_PEEK no disponible
+        return None
+    return sock
+
+@app.route("/api/stream/<stream_id>/cancel", methods=["POST"])
+def cancel_stream(stream_id):
+    handle = STREAMS.get(stream_id)
+    body   = request.get_json(silent=True)
+    # Sólo quien abrió el stream puede cancelarlo; a los demás ni se les confirma que existe
+    if handle is None or handle.owner != key_id(caller_key(body if isinstance(body, dict) else None)):
+        return jsonify({"error": "Stream no encontrado"}), 404
+    handle.cancel("client_request")
+    return jsonify({"stream_id": stream_id, "cancelled": True})
+
+# ── Chat streaming SSE ────────────────────────────────────────────
+# La lectura upstream corre en un hilo productor que vuelca eventos
+# numerados en el StreamHandle; la respuesta HTTP sólo los consume. Así un
+# stream reanudable sigue generando aunque el cliente se caiga, y al
+# reconectar con Last-Event-ID se reenvía lo que faltaba sin otra llamada.
+def pump_anthropic_stream(handle: StreamHandle, data: dict, api_key: str, model: str,
+                          reservation, trace, started: float, endpoint: str = "stream"):
+    """Productor: consume el SSE de Anthropic y emite token/usage/error/[DONE]."""
+    relay  = None
+    tokens = 0
+    usage  = {}
+    stop   = None
+    failed = False
+    blocks = ContentAccumulator()
+
+    def emit_cancelled():
+        if handle.reason != "client_disconnected":
+            handle.emit({"cancelled": True, "reason": handle.reason})
+            handle.emit("[DONE]")
+
+    try:
+        with trace.span("payload.build"):
+            payload = build_payload(data, stream=True)
+        if handle.cancelled:
+            emit_cancelled()
+            return
+        # connect + TLS + cola upstream hasta recibir cabeceras
+        with trace.span("upstream.connect", kind="client", model=model) as sp:
+            resp = upstream_post(
+                ANTHROPIC_URL,
+                headers=anthropic_headers(api_key),
+                json=payload,
+                stream=True,
+                timeout=300,
+                priority=request_priority(data),
+                cancelled=lambda: handle.cancelled,
+            )
+            sp.attrs["status"] = resp.status_code
+        handle.attach(resp)
+        with resp:
+            if not resp.ok:
+                failed = True
+                handle.emit({"error": f"API error {resp.status_code}"})
+                handle.emit("[DONE]")
+                return
+
+            ttft = trace.start_span("upstream.ttft", kind="client")
+            for line in resp.iter_lines():
+                if handle.cancelled:
+                    break
+                if not line:
+                    continue
+                line = line.decode("utf-8") if isinstance(line, bytes) else line
+                if not line.startswith("data: "):
+                    continue
+                payload_str = line[6:]
+                if payload_str == "[DONE]":
+                    handle.emit("[DONE]")
+                    return
+                try:
+                    event = json.loads(payload_str)
+                except json.JSONDecodeError:
+                    continue
+                etype = event.get("type", "")
+                tool_use = blocks.feed(event)
+                if tool_use is not None:
+                    handle.emit({"tool_use": {k: tool_use.get(k) for k in ("id", "name", "input")}})
+
+                if etype == "content_block_delta":
+                    delta = event.get("delta", {})
+                    if delta.get("type") == "text_delta":
+                        if relay is None:
+                            trace.end_span(ttft)
+                            relay = trace.start_span("relay")
+                        tokens += 1
+                        handle.emit({"token": delta.get("text", "")})
+
+                elif etype == "message_start":
+                    usage.update(event.get("message", {}).get("usage", {}))
+
+                elif etype == "message_delta":
+                    stop = event.get("delta", {}).get("stop_reason") or stop
+                    delta_usage = event.get("usage", {})
+                    usage.update(delta_usage)
+                    handle.emit({"usage": delta_usage})
+
+                elif etype == "message_stop":
+                    handle.emit("[DONE]")
+                    return
+
+        if handle.cancelled:
+            emit_cancelled()
+
+    except Exception as e:
+        # Tras cancelar, el socket upstream cerrado provoca errores de lectura esperables
+        failed = not handle.cancelled
+        if handle.cancelled:
+            emit_cancelled()
+        elif isinstance(e, requests.Timeout):
+            handle.emit({"error": "Timeout"})
+            handle.emit("[DONE]")
+        elif isinstance(e, BodyError):
+            handle.emit({"error": str(e)})
+            handle.emit("[DONE]")
+        else:
+            log.exception("Error en SSE stream")
+            handle.emit({"error": str(e)})
+            handle.emit("[DONE]")
+    finally:
+        if relay is not None:
+            relay.attrs["tokens"] = tokens
+            trace.end_span(relay)
+        if handle.cancelled:
+            trace.annotate(cancelled=handle.reason)
+            if usage:
+                # Sin message_delta final: aproximar la salida por los deltas recibidos
+                usage["output_tokens"] = max(usage.get("output_tokens", 0), tokens)
+        if usage:
+            log_usage(endpoint, model, usage, started, api_key)
+        if not handle.cancelled:
+            ROUTER.observe(endpoint, data.get("agent"), model, (time.perf_counter() - started) * 1000,
+                           outcome_quality(stop, failed))
+        BUDGETS.settle(reservation, usage)
+        handle.finish()
+        if not handle.resumable:
+            STREAMS.close(handle)
+
+def is_ollama(data: dict, model: str) -> bool:
+    return data.get("provider") == "ollama" or not model.startswith("claude")
+
+def pump_ollama_stream(handle: StreamHandle, data: dict, api_key: str, model: str,
+                       reservation, trace, started: float, endpoint: str = "stream"):
+    """Productor para modelos Ollama: NDJSON de /api/chat → mismos eventos que Anthropic."""
+    usage   = {}
+    stop    = None
+    failed  = False
+    backend = None
+    payload = {"model": model, "messages": expand_blobs(data.get("messages", []), text_only=True), "stream": True,
+               "keep_alive": OLLAMA.keep_alive_for(model), "options": ollama_options(data)}
+    if data.get("system"):
+        payload["messages"] = [{"role": "system", "content": data["system"]}] + payload["messages"]
+
+    def emit_cancelled():
+        if handle.reason != "client_disconnected":
+            handle.emit({"cancelled": True, "reason": handle.reason})
+            handle.emit("[DONE]")
+
+    try:
+        if handle.cancelled:
+            emit_cancelled()
+            return
+        with trace.span("upstream.connect", kind="client", provider="ollama", model=model,
+                        warm=OLLAMA.is_warm(model)) as sp:
+            backend, resp = OLLAMA.post("/api/chat", model, payload, stream=True, timeout=300,
+                                        priority=request_priority(data), cancelled=lambda: handle.cancelled)
+            sp.attrs.update(status=resp.status_code, backend=backend.host)
+        handle.attach(resp)
+        with resp:
+            if not resp.ok:
+                failed = True
+                handle.emit({"error": f"Ollama error {resp.status_code}"})
+                handle.emit("[DONE]")
+                return
+            with trace.span("relay"):
+                for line in resp.iter_lines():
+                    if handle.cancelled:
+                        break
+                    if not line:
+                        continue
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if event.get("error"):
+                        failed = True
+                        handle.emit({"error": f"Ollama: {event['error']}"})
+                        handle.emit("[DONE]")
+                        return
+                    text = event.get("message", {}).get("content", "")
+                    if text:
+                        handle.emit({"token": text})
+                    if event.get("done"):
+                        usage = {"input_tokens":  event.get("prompt_eval_count", 0),
+                                 "output_tokens": event.get("eval_count", 0)}
+                        stop  = "max_tokens" if event.get("done_reason") == "length" else "end_turn"
+                        handle.emit({"usage": usage})
+                        handle.emit("[DONE]")
+                        return
+        if handle.cancelled:
+            emit_cancelled()
+
+    except Exception as e:
+        failed = not handle.cancelled
+        if handle.cancelled:
+            emit_cancelled()
+        else:
+            log.exception("Error en stream Ollama")
+            handle.emit({"error": f"Ollama: {e}"})
+            handle.emit("[DONE]")
+    finally:
+        if backend is not None:
+            backend.release(model, not failed)
+        if handle.cancelled:
+            trace.annotate(cancelled=handle.reason)
+        if usage:
+            log_usage(endpoint, model, usage, started, api_key)
+        if not handle.cancelled:
+            ROUTER.observe(endpoint, data.get("agent"), model, (time.perf_counter() - started) * 1000,
+                           outcome_quality(stop, failed))
+        BUDGETS.settle(reservation, usage)
+        handle.finish()
+        if not handle.resumable:
+            STREAMS.close(handle)
+
+def stream_producer(data: dict, model: str):
+    """Productor según proveedor: Ollama (NDJSON) o Anthropic (SSE)."""
+    return pump_ollama_stream if is_ollama(data, model) else pump_anthropic_stream
+
+def sse_frames(handle: StreamHandle, after: int = 0, consumer: int = 0) -> Generator[str, None, None]:
+    """Consumidor: eventos del handle como frames SSE con `id:` para Last-Event-ID."""
+    try:
+        for seq, data in handle.frames(after):
+            if data is None:
+                yield ": keep-alive\n\n"
+            elif seq is None:
+                yield f"data: {data}\n\n"
+            else:
+                yield f"id: {seq}\ndata: {data}\n\n"
+    finally:
+        handle.client_gone(consumer)
+
+def sse_response(frames, handle: StreamHandle) -> Response:
+    return Response(
+        stream_with_context(frames),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control":  "no-cache",
+            "X-Accel-Buffering": "no",
+            "Connection":     "keep-alive",
+            "X-Stream-ID":    handle.id,
+        },
+    )
+
+def _last_event_id() -> int:
+    try:
+        return int(request.headers.get("Last-Event-ID") or request.args.get("last_event_id") or 0)
+    except ValueError:
+        return 0
+
+def resume_stream(stream_id: str, api_key: str):
+    handle = STREAMS.get(stream_id)
+    # Sólo la key que lo abrió puede reengancharse (y a otra no se le confirma que existe)
+    if handle is None or handle.owner != key_id(api_key):
+        return sse_error("Stream no encontrado o expirado", stream_id=stream_id)
+    consumer = handle.attach_client(client_socket())
+    log.info(f"[stream] {stream_id} reanudado desde {_last_event_id()}")
+    return sse_response(sse_frames(handle, _last_event_id(), consumer), handle)
+
+@app.route("/api/stream/<stream_id>", methods=["GET"])
+def resume_stream_get(stream_id):
+    """Reconexión (compatible con EventSource): reenvía desde Last-Event-ID."""
+    return resume_stream(stream_id, caller_key())
+
+@app.route("/api/stream", methods=["POST"])
+def stream_chat():
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
+
+    # Reconexión: mismo stream_id + Last-Event-ID → sin nueva llamada upstream
+    if request.headers.get("Last-Event-ID") and STREAMS.get(data.get("stream_id") or ""):
+        return resume_stream(data["stream_id"], caller_key(data))
+
+    api_key = extract_key(data)
+
+    if not validate_key(api_key):
+        return sse_error("API key no configurada")
+    if STREAMS.taken(data.get("stream_id")):
+        return sse_error("stream_id ya en uso", stream_id=data["stream_id"])
+    try:
+        check_blob_refs(data.get("messages"))
+    except BodyError as e:
+        return sse_error(str(e), status=e.status)
+    resolve_model(data, "stream")
+
+    try:
+        with span("budget.reserve"):
+            reservation = BUDGETS.reserve(data, api_key)
+    except BudgetExceeded as e:
+        log.warning(f"[stream] {e}")
+        return sse_error(**e.to_dict())
+
+    try:
+        target = diff_target(data)
+    except BodyError as e:
+        BUDGETS.settle(reservation)
+        return sse_error(str(e), status=e.status)
+
+    model = data.get("model", DEFAULT_MODEL)
+    log_request("stream", model, data.get("messages", []))
+    handle = STREAMS.open(data.pop("stream_id", None), client_socket(),
+                          resumable=bool(data.pop("resumable", SSE_RESUMABLE)),
+                          cls=DiffStreamHandle if target else StreamHandle,
+                          owner=key_id(api_key))
+    if target:
+        handle.target = target
+    handle.emit({"stream_id": handle.id})
+    threading.Thread(
+        target=stream_producer(data, model),
+        args=(handle, data, api_key, model, reservation, current_trace(), started),
+        name=f"stream-{handle.id}", daemon=True,
+    ).start()
+    return sse_response(sse_frames(handle), handle)
+
+# ── Streaming multiplexado ────────────────────────────────────────
+# Varias generaciones independientes sobre una sola conexión SSE: cada
+# canal tiene su propio productor upstream (y su propio id cancelable) y
+# sus eventos se intercalan en el stream común etiquetados con `channel`.
+_CHANNEL_RE = re.compile(r"[^A-Za-z0-9_\-]")
+
+class MuxHandle(StreamHandle):
+    """Stream contenedor: termina cuando terminan todos sus canales."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channels = []
+        self._closing = False
+
+    def cancel(self, reason: str) -> bool:
+        if not super().cancel(reason):
+            return False
+        for ch in self.channels:
+            ch.cancel(reason)
+        return True
+
+    def channel_finished(self):
+        # Varios canales pueden terminar a la vez: sólo uno cierra el contenedor
+        with self._lock:
+            if self._closing or not all(ch.done for ch in self.channels):
+                return
+            self._closing = True
+        if not self.done:
+            self.emit("[DONE]")
+            self.finish()
+            if not self.resumable:
+                STREAMS.close(self)
+
+class ChannelHandle(StreamHandle):
+    """Canal de un MuxHandle: sus eventos van al stream común con `channel`."""
+
+    def __init__(self, mux: MuxHandle, channel: str):
+        super().__init__(f"{mux.id}-{channel}")
+        self.owner   = mux.owner
+        self.mux     = mux
+        self.channel = channel
+
+    def emit(self, event: dict | str):
+        if event == "[DONE]":
+            self.mux.emit({"channel": self.channel, "done": True})
+        else:
+            self.mux.emit({"channel": self.channel, **event})
+
+    def finish(self):
+        super().finish()
+        self.mux.channel_finished()
+
+@app.route("/api/stream/multi", methods=["POST"])
+def stream_multi():
+    """Body: {"channels": [{"channel": "planner", "messages": [...], ...}, ...], ...defaults}
+
+    Las claves de primer nivel (model, system, max_tokens, temperature,
+    conversation_id) sirven de valores por defecto para cada canal.
+    """
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
+
+    if request.headers.get("Last-Event-ID") and STREAMS.get(data.get("stream_id") or ""):
+        return resume_stream(data["stream_id"], caller_key(data))
+
+    api_key  = extract_key(data)
+    specs    = data.pop("channels", None) or []
+    if not validate_key(api_key):
+        return sse_error("API key no configurada")
+    if STREAMS.taken(data.get("stream_id")):
+        return sse_error("stream_id ya en uso", stream_id=data["stream_id"])
+    if not isinstance(specs, list) or not specs:
+        return sse_error("Se requiere una lista 'channels'")
+    if len(specs) > MUX_MAX_CHANNELS:
+        return sse_error(f"Máximo {MUX_MAX_CHANNELS} canales por conexión")
+
+    defaults = {k: data[k] for k in ("model", "system", "max_tokens", "temperature", "conversation_id") if k in data}
+
+    # Validar todos los canales antes de abrir nada: un error a medias dejaría
+    # canales registrados que nunca terminan
+    named, seen = [], set()
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            return sse_error(f"El canal {i} debe ser un objeto", status=400)
+        name = _CHANNEL_RE.sub("", str(spec.get("channel", i)))[:32] or str(i)
+        if name in seen:
+            name = f"{name}{i}"
+        seen.add(name)
+        job = {"agent": name, **defaults, **spec}
+        try:
+            requested_max_tokens(job)
+            check_blob_refs(job.get("messages"))
+            resolve_model(job, "stream_multi")
+        except BodyError as e:
+            return sse_error(f"Canal {name}: {e}", status=e.status)
+        named.append((name, job))
+
+    mux = STREAMS.open(data.pop("stream_id", None), client_socket(),
+                       resumable=bool(data.pop("resumable", SSE_RESUMABLE)), cls=MuxHandle,
+                       owner=key_id(api_key))
+    trace = current_trace()
+
+    jobs = []
+    for name, job in named:
+        ch = STREAMS.register(ChannelHandle(mux, name))
+        mux.channels.append(ch)
+        jobs.append((ch, job))
+
+    mux.emit({"stream_id": mux.id, "channels": {ch.channel: ch.id for ch in mux.channels}})
+    for ch, spec in jobs:
+        model = spec.get("model", DEFAULT_MODEL)
+        log_request("stream_multi", model, spec.get("messages", []))
+        try:
+            reservation = BUDGETS.reserve(spec, api_key)
+        except BudgetExceeded as e:
+            ch.emit(e.to_dict())
+            ch.emit("[DONE]")
+            ch.finish()
+            STREAMS.close(ch)
+            continue
+        threading.Thread(
+            target=stream_producer(spec, spec.get("model", DEFAULT_MODEL)),
+            args=(ch, spec, api_key, spec.get("model", DEFAULT_MODEL), reservation, trace, started, "stream_multi"),
+            name=f"stream-{ch.id}", daemon=True,
+        ).start()
+    return sse_response(sse_frames(mux), mux)
+
+# ── WebSocket ─────────────────────────────────────────────────────
+# Sesión persistente por usuario sobre un WebSocket (RFC 6455 mínimo,
+# sobre el socket del servidor integrado de werkzeug). La sesión guarda
+# api_key, valores por defecto e historial, así que cada turno sólo envía
+# lo nuevo. Frames JSON compactos, con `t` = tipo e `id` = petición:
+#   cliente → {"t":"hello"|"req"|"cancel"|"tool_result"|"reset"|"ping", ...}
+#   servidor → {"t":"ready"|"tok"|"usage"|"done"|"err"|"cancelled"|"tool_ack"|"pong", ...}
+_WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC11B85"
+
+class WebSocketClosed(Exception):
+    pass
+
+class WebSocket:
+    def __init__(self, sock):
+        self.sock       = sock
+        self._send_lock = threading.Lock()
+        self.closed     = False
+
+    @staticmethod
+    def accept_key(key: str) -> str:
+        return base64.b64encode(hashlib.sha1((key + _WS_GUID).encode()).digest()).decode()
+
+    def handshake(self, key: str):
+        self.sock.sendall((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {self.accept_key(key)}\r\n\r\n"
+        ).encode())
+
+    def _read_exact(self, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise WebSocketClosed()
+            buf += chunk
+        return bytes(buf)
+
+    def _read_frame(self) -> tuple:
+        b0, b1 = self._read_exact(2)
+        fin, opcode = b0 & 0x80, b0 & 0x0F
+        length = b1 & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self._read_exact(8))[0]
+        if length > WS_MAX_MESSAGE_BYTES:
+            self.close(1009)
+            raise WebSocketClosed()
+        mask = self._read_exact(4) if b1 & 0x80 else None
+        data = self._read_exact(length)
+        if mask and length:
+            key  = (mask * (length // 4 + 1))[:length]
+            data = (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+        return bool(fin), opcode, data
+
+    def recv(self) -> str | None:
+        """Siguiente mensaje de texto (None si el cliente cierra)."""
+        parts, total = [], 0
+        while True:
+            try:
+                fin, opcode, data = self._read_frame()
+            except (WebSocketClosed, OSError):
+                self.closed = True
+                return None
+            if opcode == 0x8:                       # close
+                self.close()
+                return None
+            if opcode == 0x9:                       # ping
+                self._send_frame(0xA, data)
+                continue
+            if opcode == 0xA:                       # pong
+                continue
+            parts.append(data)
+            total += len(data)
+            if total > WS_MAX_MESSAGE_BYTES:
+                self.close(1009)
+                return None
+            if fin:
+                return b"".join(parts).decode("utf-8", errors="replace")
+
+    def _send_frame(self, opcode: int, payload: bytes):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack(">BB", 0x80 | opcode, n)
+        elif n < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, n)
+        with self._send_lock:
+            if self.closed and opcode != 0x8:
+                raise WebSocketClosed()
+            self.sock.sendall(header + payload)
+
+    def send(self, obj: dict):
+        self._send_frame(0x1, json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+    def close(self, code: int = 1000):
+        if not self.closed:
+            try:
+                self._send_frame(0x8, struct.pack(">H", code))
+            except OSError:
+                pass
+            self.closed = True
+
+class WsSession:
+    def __init__(self, session_id: str, owner: str):
+        self.id           = session_id
+        self.owner        = owner        # key_id de la API key que la creó
+        self.api_key      = API_KEY
+        self.defaults     = {}
+        self.history      = []
+        self.pending      = []           # ids de tool_use del último turno sin resolver
+        self.tool_results = {}           # tool_use_id → bloque tool_result
+        self.last_seen    = time.time()
+        self.lock         = threading.Lock()
+
+    def load(self) -> bool:
+        """Trae el estado de STATE (la sesión pudo seguir en otro worker); False si no es suya."""
+        stored = STATE.get(f"ws:{self.id}")
+        if not stored or stored.get("owner") != self.owner:
+            return False
+        with self.lock:
+            self.defaults, self.history = stored["defaults"], stored["history"]
+            self.pending, self.tool_results = stored.get("pending", []), stored.get("tool_results", {})
+        return True
+
+    def save(self):
+        # La API key no sale del proceso: sólo su key_id, para comprobar al reconectar
+        with self.lock:
+            state = {"owner": self.owner, "defaults": self.defaults, "history": self.history,
+                     "pending": self.pending, "tool_results": self.tool_results}
+        STATE.set(f"ws:{self.id}", state, WS_SESSION_TTL)
+
+    def add_tool_result(self, frame: dict) -> str | None:
+        """Guarda un tool_result para el siguiente turno; devuelve el error si no encaja."""
+        tool_use_id = frame.get("tool_use_id")
+        with self.lock:
+            if tool_use_id not in self.pending:
+                return "tool_result sin tool_use pendiente"
+            content = frame.get("content", "")
+            self.tool_results[tool_use_id] = {
+                "type":        "tool_result",
+                "tool_use_id": tool_use_id,
+                "content":     content if isinstance(content, (str, list)) else json.dumps(content),
+                **({"is_error": True} if frame.get("is_error") else {}),
+            }
+        return None
+
+    def next_messages(self, append: list) -> list:
+        """Historial + turno nuevo; si el anterior acabó en tool_use, el turno
+        empieza con sus tool_result (la API los exige justo después)."""
+        with self.lock:
+            if not self.pending:
+                return self.history + append
+            missing = [i for i in self.pending if i not in self.tool_results]
+            if missing:
+                raise BodyError(f"Faltan tool_result para: {', '.join(missing)}")
+            blocks = [self.tool_results[i] for i in self.pending]
+            history = list(self.history)
+        if append and append[0].get("role") == "user":
+            content = append[0].get("content", "")
+            extra   = [{"type": "text", "text": content}] if isinstance(content, str) else list(content)
+            return history + [{"role": "user", "content": blocks + [b for b in extra if b]}] + append[1:]
+        return history + [{"role": "user", "content": blocks}] + append
+
+    def remember(self, messages: list, reply: str, tool_uses: list):
+        """Cierra un turno: respuesta al historial y, si pidió herramientas, quedan pendientes."""
+        if tool_uses:
+            content = ([{"type": "text", "text": reply}] if reply else []) + \
+                      [{"type": "tool_use", **tu} for tu in tool_uses]
+        else:
+            content = reply
+        with self.lock:
+            self.history      = messages + [{"role": "assistant", "content": content}]
+            self.pending      = [tu["id"] for tu in tool_uses]
+            self.tool_results = {}
+        self.save()
+
+class _DetachedResponse(Response):
+    """El socket ya no habla HTTP: abortar para que werkzeug no escriba nada más."""
+    def __call__(self, environ, start_response):
+        raise ConnectionAbortedError("websocket cerrado")
+
+WS_SESSIONS = {}
+_WS_SESSIONS_LOCK = threading.Lock()
+
+def ws_session(session_id: str | None, api_key: str) -> WsSession:
+    """Sesión `session_id` si existe y es de esta API key; si no, una nueva.
+
+    Los ids sólo los genera el servidor: un id desconocido o de otra key no se
+    adopta, se devuelve otra sesión (el cliente ve el id real en `ready`).
+    """
+    owner, now = key_id(api_key), time.time()
+    with _WS_SESSIONS_LOCK:
+        for sid in [s for s, sess in WS_SESSIONS.items() if now - sess.last_seen > WS_SESSION_TTL]:
+            del WS_SESSIONS[sid]
+        session = WS_SESSIONS.get(session_id) if session_id else None
+    if session_id and _STREAM_ID_RE.match(session_id):
+        if session is not None and session.owner != owner:
+            session = None
+        elif not STATE.local:
+            # Otro worker pudo crearla o avanzarla: STATE manda
+            candidate = session or WsSession(session_id, owner)
+            session   = candidate if candidate.load() else session
+    if session is None:
+        session = WsSession(os.urandom(8).hex(), owner)
+    with _WS_SESSIONS_LOCK:
+        session = WS_SESSIONS.setdefault(session.id, session)
+    session.api_key   = api_key
+    session.last_seen = now
+    return session
+
+class WsChannel(StreamHandle):
+    """Petición de una sesión WS: los eventos del productor salen como frames."""
+    _MAP = (("token", "tok", "d"), ("usage", "usage", "u"), ("error", "err", "e"), ("tool_use", "tool_use", "c"))
+
+    def __init__(self, ws: WebSocket, req_id: str, on_done=None):
+        super().__init__(f"ws-{os.urandom(6).hex()}")
+        self.ws      = ws
+        self.req_id  = req_id
+        self.text    = []
+        self.tools   = []
+        self.failed  = False
+        self.on_done = on_done
+
+    def emit(self, event: dict | str):
+        try:
+            if event == "[DONE]":
+                self.ws.send({"t": "done", "id": self.req_id})
+                return
+            if event.get("cancelled"):
+                self.ws.send({"t": "cancelled", "id": self.req_id, "r": event.get("reason")})
+                return
+            for key, t, short in self._MAP:
+                if key in event:
+                    if key == "token":
+                        self.text.append(event["token"])
+                    elif key == "tool_use":
+                        self.tools.append(event["tool_use"])
+                    elif key == "error":
+                        self.failed = True
+                    self.ws.send({"t": t, "id": self.req_id, short: event[key]})
+                    return
+        except (WebSocketClosed, OSError):
+            self.cancel("client_disconnected")
+
+    def finish(self):
+        super().finish()
+        if self.on_done and not (self.cancelled or self.failed):
+            self.on_done("".join(self.text), self.tools)
+
+def _ws_request(ws: WebSocket, session: WsSession, frame: dict, active: dict, trace):
+    req_id = str(frame.get("id") or os.urandom(4).hex())
+    for done in [k for k, ch in active.items() if ch.done]:
+        del active[done]
+    with session.lock:
+        data = {**session.defaults, **{k: v for k, v in frame.items() if k not in ("t", "id", "append")}}
+    api_key = session.api_key
+    if not validate_key(api_key):
+        ws.send({"t": "err", "id": req_id, "e": "API key no configurada"})
+        return
+    try:
+        if "append" in frame:
+            append = frame["append"]
+            if not isinstance(append, list) or not all(isinstance(m, dict) for m in append):
+                raise BodyError("'append' debe ser una lista de mensajes")
+            data["messages"] = session.next_messages(append)
+        check_blob_refs(data.get("messages"))
+        resolve_model(data, "ws")
+        reservation = BUDGETS.reserve(data, api_key)
+    except (BudgetExceeded, BodyError) as e:
+        ws.send({"t": "err", "id": req_id, "e": str(e)})
+        return
+
+    def remember(reply: str, tool_uses: list):
+        if "append" in frame:
+            session.remember(data["messages"], reply, tool_uses)
+
+    model = data.get("model", DEFAULT_MODEL)
+    log_request("ws", model, data.get("messages", []))
+    ch = WsChannel(ws, req_id, on_done=remember)
+    ch.owner = key_id(api_key)
+    STREAMS.register(ch)
+    active[req_id] = ch
+    threading.Thread(
+        target=stream_producer(data, model),
+        args=(ch, data, api_key, model, reservation, trace, time.perf_counter(), "ws"),
+        name=f"ws-{req_id}", daemon=True,
+    ).start()
+
+@app.route("/api/ws", websocket=True)
+def websocket():
+    sock = request.environ.get("werkzeug.socket")
+    key  = request.headers.get("Sec-WebSocket-Key")
+    if request.headers.get("Upgrade", "").lower() != "websocket" or not key:
+        return jsonify({"error": "Se esperaba un upgrade a WebSocket"}), 400
+    if sock is None:
+        return jsonify({"error": "WebSocket requiere el servidor integrado (werkzeug)"}), 501
+
+    session = ws_session(request.args.get("session"), caller_key())
+    trace   = current_trace()
+    ws      = WebSocket(sock)
+    ws.handshake(key)
+    ws.send({"t": "ready", "session": session.id, "history": len(session.history)})
+    active  = {}
+    log.info(f"[ws] sesión {session.id} conectada")
+    try:
+        while True:
+            raw = ws.recv()
+            if raw is None:
+                break
+            session.last_seen = time.time()
+            try:
+                frame = json.loads(raw)
+                kind  = frame.get("t")
+            except (ValueError, AttributeError):
+                ws.send({"t": "err", "e": "Frame JSON inválido"})
+                continue
+            if kind == "req":
+                _ws_request(ws, session, frame, active, trace)
+            elif kind == "cancel":
+                ch = active.get(str(frame.get("id")))
+                if ch is not None:
+                    ch.cancel("client_request")
+            elif kind == "tool_result":
+                error = session.add_tool_result(frame)
+                if error:
+                    ws.send({"t": "err", "id": frame.get("id"), "e": error})
+                else:
+                    session.save()
+                    ws.send({"t": "tool_ack", "id": frame.get("id"), "tool_use_id": frame.get("tool_use_id")})
+            elif kind == "hello":
+                if frame.get("api_key") and key_id(frame["api_key"]) != session.owner:
+                    # Otra key no hereda la sesión: empieza una suya
+                    session = ws_session(None, frame["api_key"])
+                with session.lock:
+                    session.defaults.update({k: frame[k] for k in
+                                             ("model", "system", "max_tokens", "temperature", "conversation_id")
+                                             if k in frame})
+                session.save()
+                ws.send({"t": "ready", "session": session.id, "history": len(session.history)})
+            elif kind == "reset":
+                with session.lock:
+                    session.history, session.pending, session.tool_results = [], [], {}
+                session.save()
+                ws.send({"t": "ready", "session": session.id, "history": 0})
+            elif kind == "ping":
+                ws.send({"t": "pong"})
+            else:
+                ws.send({"t": "err", "e": f"Tipo de frame desconocido: {kind}"})
+    except (WebSocketClosed, OSError):
+        pass
+    finally:
+        for ch in active.values():
+            ch.cancel("client_disconnected")
+        ws.close()
+        trace.finish(status=101)
+        log.info(f"[ws] sesión {session.id} desconectada")
+    return _DetachedResponse()
+
+# ── Agente con herramientas ───────────────────────────────────────
+# /api/agent ejecuta en el servidor el ciclo tool_use → tool_result: las
+# herramientas registradas con @tool se ofrecen al modelo, y las llamadas
+# de un mismo turno se ejecutan en paralelo en TOOL_POOL con timeout. El
+# progreso (texto, tool_call, tool_result, turn) sale por SSE. Si el modelo
+# pide una herramienta que sólo conoce el cliente, el bucle se detiene y
+# devuelve el tool_use para que el cliente continúe.
+TOOLS = {}
+TOOL_POOL = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+
+def tool(name: str, description: str, input_schema: dict, timeout: float | None = None):
+    """Registra una función como herramienta: recibe el `input` como kwargs y devuelve texto/JSON."""
+    def register(fn):
+        TOOLS[name] = {
+            "fn":      fn,
+            "timeout": timeout or TOOL_TIMEOUT,
+            "schema":  {"name": name, "description": description, "input_schema": input_schema},
+        }
+        return fn
+    return register
+
+_CALC_MAX_BITS = 10000      # enteros de hasta ~3000 cifras; más es trabajo de CPU sin sentido
+
+def _calc_mul(a, b):
+    if isinstance(a, int) and isinstance(b, int) and a.bit_length() + b.bit_length() > _CALC_MAX_BITS:
+        raise ValueError("Resultado demasiado grande")
+    return a * b
 
-        result = resp.json()
-        text   = "".join(b["text"] for b in result.get("content", []) if b.get("type") == "text")
-        return jsonify({
-            "content":    text,
-            "model":      result.get("model", model),
-            "usage":      result.get("usage", {}),
-            "stop_reason":result.get("stop_reason", "end_turn"),
-        })
+def _calc_pow(a, b):
+    # El tamaño del resultado se estima antes de calcularlo: b·log2|a| bits
+    if (isinstance(a, int) and isinstance(b, int) and b > 0 and abs(a) > 1
+            and b * math.log2(abs(a)) > _CALC_MAX_BITS):
+        raise ValueError("Resultado demasiado grande")
+    return a ** b
 
-    except requests.Timeout:
-        return jsonify({"error": "Timeout — la respuesta tardó más de 120s"}), 504
-    except Exception as e:
-        log.exception("Error en /api/chat")
-        return jsonify({"error": str(e)}), 500
+_CALC_OPS = {
+    ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: _calc_mul,
+    ast.Div: lambda a, b: a / b, ast.FloorDiv: lambda a, b: a // b, ast.Mod: lambda a, b: a % b,
+    ast.Pow: _calc_pow,
+    ast.USub: lambda a: -a, ast.UAdd: lambda a: a,
+}
+_CALC_FUNCS = {name: getattr(math, name) for name in
+               ("sqrt", "log", "log10", "exp", "sin", "cos", "tan", "floor", "ceil", "fabs")}
 
-def _ollama_chat(data: dict):
-    """Proxy hacia Ollama para modelos locales."""
-    try:
-        messages = data.get("messages", [])
-        model    = data.get("model", "llama3.2")
-        payload  = {"model": model, "messages": messages, "stream": False}
-        resp     = requests.post(f"{OLLAMA_HOST}/api/chat", json=payload, timeout=300)
-        if not resp.ok:
-            return jsonify({"error": "Ollama error"}), 502
-        result   = resp.json()
-        text     = result.get("message", {}).get("content", "")
-        return jsonify({"content": text, "model": model, "usage": {}})
-    except Exception as e:
-        return jsonify({"error": f"Ollama: {e}"}), 502
+def _calc(node):
+    if isinstance(node, ast.Expression):
+        return _calc(node.body)
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _CALC_OPS:
+        return _CALC_OPS[type(node.op)](_calc(node.left), _calc(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _CALC_OPS:
+        return _CALC_OPS[type(node.op)](_calc(node.operand))
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id in _CALC_FUNCS and not node.keywords):
+        return _CALC_FUNCS[node.func.id](*[_calc(a) for a in node.args])
+    if isinstance(node, ast.Name) and node.id in ("pi", "e"):
+        return getattr(math, node.id)
+    raise ValueError("Expresión no permitida")
 
-# ── Chat streaming SSE ────────────────────────────────────────────
-@app.route("/api/stream", methods=["POST"])
-def stream_chat():
-    data    = request.get_json(force=True)
-    api_key = extract_key(data)
+@tool("calculator", "Evalúa una expresión aritmética (+ - * / // % **, sqrt, log, sin, pi…).",
+      {"type": "object", "properties": {"expression": {"type": "string"}}, "required": ["expression"]})
+def _tool_calculator(expression: str):
+    return str(_calc(ast.parse(expression, mode="eval")))
 
-    if not validate_key(api_key):
-        def err_gen():
-            yield f"data: {json.dumps({'error': 'API key no configurada'})}\n\n"
-            yield "data: [DONE]\n\n"
-        return Response(stream_with_context(err_gen()), mimetype="text/event-stream")
+@tool("current_time", "Fecha y hora actuales en UTC (ISO 8601).",
+      {"type": "object", "properties": {}})
+def _tool_current_time():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
-    model = data.get("model", DEFAULT_MODEL)
-    log_request("stream", model, data.get("messages", []))
+@tool("text_stats", "Cuenta caracteres, palabras, líneas y tokens aproximados de un texto.",
+      {"type": "object", "properties": {"text": {"type": "string"}}, "required": ["text"]})
+def _tool_text_stats(text: str):
+    return {"chars": len(text), "words": len(text.split()), "lines": text.count("\n") + 1,
+            "tokens": len(text) // 4}
+
+def _run_tool(name: str, args: dict):
+    result = TOOLS[name]["fn"](**(args or {}))
+    return result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+
+def run_tool_calls(calls: list, emit) -> list:
+    """Ejecuta en paralelo las llamadas de un turno; emite cada resultado al
+    terminar y devuelve los bloques tool_result en el orden de las llamadas."""
+    t0       = time.perf_counter()
+    pending  = {}
+    results  = {}
+    for call in calls:
+        emit({"tool_call": call})
+        fut = TOOL_POOL.submit(_run_tool, call["name"], call["input"])
+        pending[fut] = (call, t0 + TOOLS[call["name"]]["timeout"])
+
+    def finish(call, content, is_error):
+        emit({"tool_result": {"id": call["id"], "name": call["name"], "is_error": is_error,
+                              "content": content[:2000],
+                              "ms": round((time.perf_counter() - t0) * 1000, 1)}})
+        results[call["id"]] = {"type": "tool_result", "tool_use_id": call["id"],
+                               "content": content, "is_error": is_error}
 
-    def generate() -> Generator[str, None, None]:
+    while pending:
+        wait_s = max(min(d for _, d in pending.values()) - time.perf_counter(), 0)
+        done, _ = futures_wait(pending, timeout=wait_s, return_when=FIRST_COMPLETED)
+        for fut in done:
+            call, _ = pending.pop(fut)
+            try:
+                finish(call, fut.result(), False)
+            except Exception as e:
+                finish(call, f"{type(e).__name__}: {e}", True)
+        now = time.perf_counter()
+        for fut, (call, deadline) in list(pending.items()):
+            if now >= deadline:
+                # El hilo no se puede interrumpir: se abandona y su resultado se descarta
+                fut.cancel()
+                del pending[fut]
+                finish(call, f"Timeout: la herramienta tardó más de {TOOLS[call['name']]['timeout']:g}s", True)
+    return [results[c["id"]] for c in calls]
+
+def anthropic_events(resp) -> Generator[dict, None, None]:
+    """Eventos JSON de un stream SSE de Anthropic."""
+    for line in resp.iter_lines():
+        line = line.decode("utf-8") if isinstance(line, bytes) else line
+        if not line or not line.startswith("data: ") or line[6:] == "[DONE]":
+            continue
         try:
-            payload = build_payload(data, stream=True)
-            with requests.post(
-                ANTHROPIC_URL,
-                headers=anthropic_headers(api_key),
-                json=payload,
-                stream=True,
-                timeout=300,
-            ) as resp:
-                if not resp.ok:
-                    yield f"data: {json.dumps({'error': f'API error {resp.status_code}'})}\n\n"
-                    yield "data: [DONE]\n\n"
-                    return
+            yield json.loads(line[6:])
+        except json.JSONDecodeError:
+            continue
 
-                for line in resp.iter_lines():
-                    if not line:
-                        continue
-                    line = line.decode("utf-8") if isinstance(line, bytes) else line
-                    if line.startswith("data: "):
-                        payload_str = line[6:]
-                        if payload_str == "[DONE]":
-                            yield "data: [DONE]\n\n"
-                            return
-                        try:
-                            event = json.loads(payload_str)
-                            etype = event.get("type", "")
+def run_agent(handle: StreamHandle, data: dict, api_key: str, model: str,
+              reservation, trace, started: float):
+    """Productor de /api/agent: turnos del modelo + herramientas hasta end_turn."""
+    messages = list(data.get("messages", []))
+    total    = {}
+    failed   = False
+    try:
+        for turn in range(AGENT_MAX_TURNS):
+            req = {**data, "messages": messages}
+            if turn:
+                try:
+                    # Cada turno reserva su propio coste (puede degradar el modelo)
+                    reservation = BUDGETS.reserve(req, api_key)
+                except BudgetExceeded as e:
+                    handle.emit(e.to_dict())
+                    break
+            handle.emit({"turn": turn})
+            payload = build_payload(req, stream=True)
+            acc, usage = ContentAccumulator(), {}
+            try:
+                with trace.span("agent.turn", kind="client", model=model, turn=turn):
+                    resp = upstream_post(ANTHROPIC_URL, headers=anthropic_headers(api_key), json=payload,
+                                         stream=True, timeout=300, priority=request_priority(data),
+                                         cancelled=lambda: handle.cancelled)
+                    handle.attach(resp)
+                    with resp:
+                        if not resp.ok:
+                            failed = True
+                            handle.emit({"error": f"API error {resp.status_code}"})
+                            break
+                        for event in anthropic_events(resp):
+                            if handle.cancelled:
+                                break
+                            acc.feed(event)
+                            if event.get("type") == "message_start":
+                                usage.update(event.get("message", {}).get("usage", {}))
+                            elif event.get("type") == "message_delta":
+                                usage.update(event.get("usage", {}))
+                            elif event.get("type") == "content_block_delta" and \
+                                    event.get("delta", {}).get("type") == "text_delta":
+                                handle.emit({"token": event["delta"].get("text", "")})
+            finally:
+                BUDGETS.settle(reservation, usage)
+                reservation = None
+                for k, v in usage.items():
+                    if isinstance(v, int):
+                        total[k] = total.get(k, 0) + v
+            if handle.cancelled:
+                break
 
-                            if etype == "content_block_delta":
-                                delta = event.get("delta", {})
-                                if delta.get("type") == "text_delta":
-                                    token = delta.get("text", "")
-                                    yield f"data: {json.dumps({'token': token})}\n\n"
+            messages.append({"role": "assistant", "content": acc.blocks})
+            calls = tool_calls(acc.blocks)
+            if acc.stop_reason != "tool_use" or not calls:
+                break
+            client_side = [c for c in calls if c["name"] not in TOOLS]
+            server_side = [c for c in calls if c["name"] in TOOLS]
+            if server_side:
+                with trace.span("agent.tools", turn=turn, calls=len(server_side)):
+                    results = run_tool_calls(server_side, handle.emit)
+                messages.append({"role": "user", "content": results})
+            if client_side:
+                # Herramientas del cliente: devolver el control con el historial para continuar.
+                # Si hubo llamadas del servidor, el último turno (user) ya lleva sus
+                # resultados y el cliente añade los suyos a ese mismo turno.
+                handle.emit({"tool_use": client_side, "messages": messages})
+                break
+        else:
+            handle.emit({"error": f"Límite de {AGENT_MAX_TURNS} turnos alcanzado"})
 
-                            elif etype == "message_delta":
-                                usage = event.get("usage", {})
-                                yield f"data: {json.dumps({'usage': usage})}\n\n"
+        if handle.cancelled:
+            if handle.reason != "client_disconnected":
+                handle.emit({"cancelled": True, "reason": handle.reason})
+        elif total:
+            handle.emit({"usage": total})
+        if not handle.cancelled or handle.reason != "client_disconnected":
+            handle.emit("[DONE]")
+    except Exception as e:
+        failed = True
+        if handle.cancelled:
+            handle.emit({"cancelled": True, "reason": handle.reason})
+        else:
+            log.exception("Error en /api/agent")
+            handle.emit({"error": str(e)})
+        handle.emit("[DONE]")
+    finally:
+        BUDGETS.settle(reservation, {})
+        if total:
+            log_usage("agent", model, total, started, api_key)
+        if not handle.cancelled:
+            ROUTER.observe("agent", data.get("agent"), model, (time.perf_counter() - started) * 1000,
+                           outcome_quality(None, failed))
+        handle.finish()
+        if not handle.resumable:
+            STREAMS.close(handle)
 
-                            elif etype == "message_stop":
-                                yield "data: [DONE]\n\n"
-                                return
+@app.route("/api/agent", methods=["POST"])
+def agent_loop():
+    """Como /api/stream, con `tools`: nombres de herramientas del servidor (por
+    defecto todas) y/o definiciones completas de herramientas del cliente."""
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
+    api_key = extract_key(data)
+    if not validate_key(api_key):
+        return sse_error("API key no configurada")
+    if STREAMS.taken(data.get("stream_id")):
+        return sse_error("stream_id ya en uso", stream_id=data["stream_id"])
+    try:
+        check_blob_refs(data.get("messages"))
+    except BodyError as e:
+        return sse_error(str(e), status=e.status)
 
-                        except json.JSONDecodeError:
-                            pass
+    requested = data.get("tools", list(TOOLS))
+    unknown   = [t for t in requested if isinstance(t, str) and t not in TOOLS]
+    if unknown:
+        return sse_error(f"Herramientas desconocidas: {', '.join(unknown)}", available=list(TOOLS))
+    data["tools"] = [TOOLS[t]["schema"] if isinstance(t, str) else t for t in requested]
+    resolve_model(data, "agent")
+    try:
+        reservation = BUDGETS.reserve(data, api_key)
+    except BudgetExceeded as e:
+        return sse_error(**e.to_dict())
 
-        except requests.Timeout:
-            yield f"data: {json.dumps({'error': 'Timeout'})}\n\n"
-            yield "data: [DONE]\n\n"
-        except Exception as e:
-            log.exception("Error en SSE stream")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
-            yield "data: [DONE]\n\n"
+    model = data.get("model", DEFAULT_MODEL)
+    log_request("agent", model, data.get("messages", []))
+    handle = STREAMS.open(data.pop("stream_id", None), client_socket(),
+                          resumable=bool(data.pop("resumable", SSE_RESUMABLE)),
+                          owner=key_id(api_key))
+    handle.emit({"stream_id": handle.id, "tools": [t["name"] for t in data["tools"]]})
+    threading.Thread(
+        target=run_agent,
+        args=(handle, data, api_key, model, reservation, current_trace(), started),
+        name=f"agent-{handle.id}", daemon=True,
+    ).start()
+    return sse_response(sse_frames(handle), handle)
 
-    return Response(
-        stream_with_context(generate()),
-        mimetype="text/event-stream",
-        headers={
-            "Cache-Control":  "no-cache",
-            "X-Accel-Buffering": "no",
-            "Connection":     "keep-alive",
-        },
-    )
+@app.route("/api/tools")
+def list_tools():
+    return jsonify({"tools": [t["schema"] for t in TOOLS.values()]})
 
 # ── Prompt Enhancer ───────────────────────────────────────────────
+ENHANCE_SYSTEM = (
+    "Eres un experto en ingeniería de prompts. "
+    "Tu tarea: reescribir el prompt del usuario haciéndolo más claro, "
+    "específico y efectivo para un modelo de lenguaje. "
+    "Responde SOLO con el prompt mejorado, sin explicaciones ni prefijos."
+)
+
 @app.route("/api/enhance", methods=["POST"])
 def enhance_prompt():
-    data    = request.get_json(force=True)
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
     api_key = extract_key(data)
     prompt  = data.get("prompt", "")
 
@@ -319,39 +4205,407 @@ def enhance_prompt():
     if not prompt.strip():
         return jsonify({"error": "Prompt vacío"}), 400
 
-    system = (
-        "Eres un experto en ingeniería de prompts. "
-        "Tu tarea: reescribir el prompt del usuario haciéndolo más claro, "
-        "específico y efectivo para un modelo de lenguaje. "
-        "Responde SOLO con el prompt mejorado, sin explicaciones ni prefijos."
-    )
+    payload = {
+        "model":      data.get("model", ENHANCE_MODEL),
+        "max_tokens": 1024,
+        "system":     ENHANCE_SYSTEM,
+        "messages":   [{"role": "user", "content": prompt}],
+    }
+    resolve_model(payload, "enhance")
     try:
-        payload = {
-            "model":      data.get("model", DEFAULT_MODEL),
-            "max_tokens": 1024,
-            "system":     system,
-            "messages":   [{"role": "user", "content": prompt}],
-        }
-        resp  = requests.post(ANTHROPIC_URL, headers=anthropic_headers(api_key), json=payload, timeout=60)
+        reservation = reserve_payload(payload, data, api_key)
+    except BudgetExceeded as e:
+        return jsonify(e.to_dict()), 402
+    usage = {}
+    try:
+        with span("upstream.request", kind="client", model=payload["model"]):
+            resp  = upstream_post(ANTHROPIC_URL, headers=anthropic_headers(api_key), json=payload, timeout=60,
+                                  priority=request_priority(data))
         result= resp.json()
         enhanced = "".join(b["text"] for b in result.get("content", []) if b.get("type") == "text")
-        return jsonify({"original": prompt, "enhanced": enhanced, "usage": result.get("usage", {})})
+        usage = result.get("usage", {})
+        log_usage("enhance", payload["model"], usage, started, api_key)
+        ROUTER.observe("enhance", None, payload["model"], (time.perf_counter() - started) * 1000,
+                       outcome_quality(result.get("stop_reason"), not resp.ok))
+        return jsonify({"original": prompt, "enhanced": enhanced, "usage": usage})
+    except SchedulerTimeout as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        BUDGETS.settle(reservation, usage)
 
-# ── AI Self-Review ────────────────────────────────────────────────
-@app.route("/api/review", methods=["POST"])
-def self_review():
-    data    = request.get_json(force=True)
+# Variante en streaming pensada para dispararse mientras el usuario escribe:
+# cada petición espera ENHANCE_DEBOUNCE_MS antes de llamar upstream y una
+# petición nueva del mismo usuario cancela la anterior (esté esperando o
+# generando), así que el trabajo obsoleto no consume capacidad.
+class Supersession:
+    """Petición en curso por propietario; registrar una nueva cancela la anterior.
+
+    En el proceso la anterior se cancela al momento; entre workers cada claim
+    sube una generación en STATE y `superseded()` detecta que hay otra más nueva."""
+
+    def __init__(self, name: str):
+        self.name     = name
+        self._current = {}
+        self._lock    = threading.Lock()
+
+    def claim(self, owner: str, handle: StreamHandle) -> float:
+        generation = STATE.incr(f"supersede:{self.name}:{owner}", 1, 3600)
+        with self._lock:
+            prev = self._current.get(owner)
+            self._current[owner] = handle
+        if prev is not None and prev is not handle:
+            prev.cancel("superseded")
+        return generation
+
+    def superseded(self, owner: str, generation: float) -> bool:
+        current = STATE.get(f"supersede:{self.name}:{owner}")
+        return current is not None and current > generation
+
+    def release(self, owner: str, handle: StreamHandle):
+        with self._lock:
+            if self._current.get(owner) is handle:
+                del self._current[owner]
+
+ENHANCE_INFLIGHT = Supersession("enhance")
+
+def _debounced_enhance(owner: str, generation: float, handle: StreamHandle, *args):
+    try:
+        # cancel() durante la espera despierta el hilo sin llegar a upstream
+        handle.wait_cancelled(ENHANCE_DEBOUNCE_MS / 1000)
+        if ENHANCE_INFLIGHT.superseded(owner, generation):
+            handle.cancel("superseded")      # la sustituta llegó a otro worker
+        pump_anthropic_stream(handle, *args, endpoint="enhance")
+    finally:
+        ENHANCE_INFLIGHT.release(owner, handle)
+
+@app.route("/api/enhance/stream", methods=["POST"])
+def enhance_stream():
+    """Prompt enhancer por SSE, con debounce y supersesión por usuario.
+
+    El usuario se identifica por `session_id` (o `conversation_id`) dentro de
+    su API key; sin ninguno de los dos, por la IP del cliente.
+    """
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
     api_key = extract_key(data)
-    content = data.get("content", "")
+    prompt  = data.get("prompt", "")
+
+    if not validate_key(api_key):
+        return sse_error("API key no configurada")
+    if not prompt.strip():
+        return sse_error("Prompt vacío")
+
+    req = {
+        "model":           data.get("model", ENHANCE_MODEL),
+        "max_tokens":      1024,
+        "system":          ENHANCE_SYSTEM,
+        "messages":        [{"role": "user", "content": prompt}],
+        "temperature":     data.get("temperature", 0.7),
+        "conversation_id": data.get("conversation_id"),
+        "priority":        request_priority(data),
+    }
+    resolve_model(req, "enhance")
+    try:
+        reservation = BUDGETS.reserve(req, api_key)
+    except BudgetExceeded as e:
+        return sse_error(**e.to_dict())
+
+    owner  = f"{key_id(api_key)}:{data.get('session_id') or data.get('conversation_id') or request.remote_addr}"
+    handle = STREAMS.open(data.get("stream_id"), client_socket(), owner=key_id(api_key))
+    generation = ENHANCE_INFLIGHT.claim(owner, handle)
+    handle.emit({"stream_id": handle.id})
+    threading.Thread(
+        target=_debounced_enhance,
+        args=(owner, generation, handle, req, api_key, req["model"], reservation, current_trace(), started),
+        name=f"enhance-{handle.id}", daemon=True,
+    ).start()
+    return sse_response(sse_frames(handle), handle)
+
+# ── Diff de artefactos ────────────────────────────────────────────
+# Cuando un agente regenera un fichero, el servidor guarda cada versión
+# (contenido en el almacén de blobs, índice de versiones en STATE por
+# conversación y artefacto) y calcula el diff con Myers O(ND) sobre líneas
+# convertidas a enteros, tras recortar prefijo y sufijo comunes: en una
+# regeneración típica sólo queda un trozo pequeño por comparar. /api/diff
+# lo expone, y /api/stream con `"diff": {"artifact": …}` manda hunks en vez
+# del cuerpo completo.
+_FENCE_BLOCK_RE = re.compile(r"^```[^\n]*\n(.*?)^```", re.M | re.S)
+
+def _line_ids(a: list, b: list) -> tuple[list, list]:
+    """Cada línea distinta → un entero; comparar ints es mucho más barato que strings."""
+    ids = {}
+    return ([ids.setdefault(x, len(ids)) for x in a],
+            [ids.setdefault(x, len(ids)) for x in b])
+
+def myers(a: list, b: list, max_d: int) -> list | None:
+    """Script de edición mínimo [(op, i, j)] con op en "=-+"; None si supera max_d ediciones."""
+    n, m   = len(a), len(b)
+    offset = n + m + 1
+    v      = [0] * (2 * offset + 1)
+    trace  = []
+    for d in range(min(n + m, max_d) + 1):
+        trace.append(v[offset - d - 1: offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return None
+
+def _backtrack(trace: list, x: int, y: int) -> list:
+    ops = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]                      # v[i] ↔ k = i - d - 1
+        k = x - y
+        if k == -d or (k != d and v[k - 1 + d + 1] < v[k + 1 + d + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k + d + 1]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x, y = x - 1, y - 1
+            ops.append(("=", x, y))
+        if d > 0:
+            ops.append(("+", x, prev_y) if x == prev_x else ("-", prev_x, y))
+        x, y = prev_x, prev_y
+    ops.reverse()
+    return ops
+
+def diff_ops(old: list, new: list) -> list:
+    """Ops (op, i_old, j_new) de línea a línea; posiciones absolutas en ambos lados."""
+    n, m = len(old), len(new)
+    pre  = 0
+    while pre < n and pre < m and old[pre] == new[pre]:
+        pre += 1
+    suf = 0
+    while suf < n - pre and suf < m - pre and old[n - 1 - suf] == new[m - 1 - suf]:
+        suf += 1
+    a, b   = _line_ids(old[pre:n - suf], new[pre:m - suf])
+    # Cota inferior de ediciones: si ya supera el máximo, no merece la pena buscar
+    common = sum((Counter(a) & Counter(b)).values())
+    middle = myers(a, b, DIFF_MAX_EDITS) if len(a) + len(b) - 2 * common <= DIFF_MAX_EDITS else None
+    if middle is None:
+        # Demasiado distintos: sustitución completa del tramo central
+        middle = [("-", i, 0) for i in range(len(a))] + [("+", len(a), j) for j in range(len(b))]
+    ops  = [("=", i, i) for i in range(pre)]
+    ops += [(op, i + pre, j + pre) for op, i, j in middle]
+    ops += [("=", n - suf + i, m - suf + i) for i in range(suf)]
+    return ops
+
+def make_hunks(ops: list, old: list, new: list, context: int) -> list:
+    """Agrupa los cambios en hunks estilo unified diff con `context` líneas alrededor."""
+    changes = [idx for idx, op in enumerate(ops) if op[0] != "="]
+    hunks   = []
+    c = 0
+    while c < len(changes):
+        first = last = changes[c]
+        while c + 1 < len(changes) and changes[c + 1] - last <= 2 * context + 1:
+            c += 1
+            last = changes[c]
+        c += 1
+        chunk = ops[max(first - context, 0): last + context + 1]
+        lines = [(" " + old[i]) if op == "=" else ("-" + old[i]) if op == "-" else ("+" + new[j])
+                 for op, i, j in chunk]
+        old_lines = sum(op != "+" for op, _, _ in chunk)
+        new_lines = sum(op != "-" for op, _, _ in chunk)
+        hunks.append({
+            # como en unified diff, un lado vacío apunta a la línea anterior
+            "old_start": chunk[0][1] + (1 if old_lines else 0),
+            "old_lines": old_lines,
+            "new_start": chunk[0][2] + (1 if new_lines else 0),
+            "new_lines": new_lines,
+            "lines":     lines,
+        })
+    return hunks
+
+def compute_diff(old_text: str, new_text: str, context: int = DIFF_CONTEXT) -> dict:
+    old, new = old_text.splitlines(), new_text.splitlines()
+    ops = diff_ops(old, new)
+    return {
+        "stats": {"added":     sum(op == "+" for op, _, _ in ops),
+                  "removed":   sum(op == "-" for op, _, _ in ops),
+                  "unchanged": sum(op == "=" for op, _, _ in ops)},
+        "hunks": make_hunks(ops, old, new, context),
+    }
+
+def unified(hunks: list, name: str) -> str:
+    out = [f"--- a/{name}", f"+++ b/{name}"]
+    for h in hunks:
+        out.append(f"@@ -{h['old_start']},{h['old_lines']} +{h['new_start']},{h['new_lines']} @@")
+        out += h["lines"]
+    return "\n".join(out) + "\n"
+
+def extract_artifact(text: str) -> str:
+    """El bloque de código más largo de la respuesta, o el texto entero si no hay."""
+    blocks = _FENCE_BLOCK_RE.findall(text)
+    return max(blocks, key=len) if blocks else text
+
+def _artifact_key(owner: str, conversation: str, artifact: str) -> str:
+    return f"artifact:{owner}:{conversation}:{hashlib.sha1(artifact.encode()).hexdigest()[:16]}"
+
+# Los artefactos son de quien los guardó: `owner` es el key_id del llamante
+def load_artifact(owner: str, conversation: str, artifact: str,
+                  version: int | None = None) -> tuple[int, str | None]:
+    """(versión, texto) de la última versión guardada, o de `version` si sigue en el historial."""
+    index = STATE.get(_artifact_key(owner, conversation, artifact)) or {"version": 0, "hashes": []}
+    if not index["hashes"]:
+        return 0, None
+    latest = index["version"]
+    if version is None:
+        version = latest
+    pos = len(index["hashes"]) - 1 - (latest - version)
+    if not 0 <= pos < len(index["hashes"]):
+        return 0, None
+    data = BLOBS.get(index["hashes"][pos])
+    return (version, data.decode("utf-8")) if data is not None else (0, None)
 
+def save_artifact(owner: str, conversation: str, artifact: str, text: str) -> int:
+    digest, _, _ = put_blob(owner, [text.encode("utf-8")])
+    key   = _artifact_key(owner, conversation, artifact)
+    index = STATE.get(key) or {"version": 0, "hashes": []}
+    if index["hashes"] and index["hashes"][-1] == digest:
+        return index["version"]
+    index = {"version": index["version"] + 1, "hashes": (index["hashes"] + [digest])[-DIFF_VERSIONS:]}
+    STATE.set(key, index, DIFF_TTL)
+    return index["version"]
+
+def diff_artifact(owner: str, conversation: str, artifact: str, text: str,
+                  base_version: int | None = None, context: int = DIFF_CONTEXT) -> dict:
+    """Guarda `text` como nueva versión y devuelve el diff contra la base (la anterior por defecto)."""
+    base, old = load_artifact(owner, conversation, artifact, base_version)
+    out = {"artifact": artifact, "version": None, "base_version": base or None}
+    if old is None:
+        # Sin base: el cliente necesita el contenido completo una vez
+        out.update(stats={"added": len(text.splitlines()), "removed": 0, "unchanged": 0},
+                   hunks=[], content=text)
+    else:
+        out.update(compute_diff(old, text, max(context, 0)))
+    # Se guarda después de calcular: si el diff falla no queda una versión huérfana
+    out["version"] = save_artifact(owner, conversation, artifact, text)
+    return out
+
+def _base_version(value) -> int | None:
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise BodyError("base_version debe ser un entero")
+    return value
+
+class DiffStreamHandle(StreamHandle):
+    """Stream con `diff`: acumula los tokens y al final emite hunks contra la versión anterior."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.target = None       # (conversation_id, artifact, extract, base_version)
+        self.buf    = []
+        self.lines  = 0
+        self.failed = False
+
+    def emit(self, event: dict | str):
+        if isinstance(event, dict) and "token" in event:
+            self.buf.append(event["token"])
+            lines = event["token"].count("\n")
+            if lines and (self.lines + lines) // DIFF_PROGRESS_LINES > self.lines // DIFF_PROGRESS_LINES:
+                super().emit({"progress": {"lines": self.lines + lines}})
+            self.lines += lines
+            return
+        if isinstance(event, dict) and "error" in event:
+            self.failed = True
+        if event == "[DONE]" and not (self.cancelled or self.failed):
+            conversation, artifact, extract, base_version = self.target
+            text = "".join(self.buf)
+            try:
+                body = diff_artifact(self.owner, conversation, artifact,
+                                     extract_artifact(text) if extract else text, base_version)
+                hunks = body.pop("hunks")
+                super().emit({"diff": body})
+                for hunk in hunks:
+                    super().emit({"hunk": hunk})
+            except Exception as e:
+                log.exception("Error calculando diff")
+                super().emit({"error": f"diff: {e}"})
+                super().emit({"content": text})
+        super().emit(event)
+
+def diff_target(data: dict):
+    """(conversation_id, artifact, extract, base_version) si el body pide diff; None si no."""
+    opts = data.pop("diff", None)
+    if not opts:
+        return None
+    if isinstance(opts, str):
+        opts = {"artifact": opts}
+    if not isinstance(opts, dict):
+        raise BodyError("diff debe ser un objeto o el nombre del artefacto")
+    conversation = data.get("conversation_id")
+    if not conversation or not opts.get("artifact"):
+        raise BodyError("diff requiere conversation_id y diff.artifact")
+    return (str(conversation), str(opts["artifact"]), opts.get("extract", "code") == "code",
+            _base_version(opts.get("base_version")))
+
+@app.route("/api/diff", methods=["POST"])
+def artifact_diff():
+    """{"conversation_id", "artifact", "content", "base_version"?, "context"?}
+    Guarda la versión y responde con los hunks (JSON, SSE con "stream": true,
+    o texto unified con ?format=unified)."""
+    data = json_body()
+    api_key = caller_key(data)
     if not validate_key(api_key):
         return jsonify({"error": "API key no configurada"}), 401
-    if not content.strip():
-        return jsonify({"error": "Contenido vacío"}), 400
+    conversation, artifact = data.get("conversation_id"), data.get("artifact")
+    content = data.get("content")
+    if not conversation or not artifact or not isinstance(content, str):
+        return jsonify({"error": "Faltan conversation_id, artifact o content"}), 400
+    try:
+        context = max(int(data.get("context", DIFF_CONTEXT)), 0)
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({"error": "context inválido"}), 400
+    base_version = _base_version(data.get("base_version"))
+    with span("diff.compute", chars=len(content)):
+        body = diff_artifact(key_id(api_key), str(conversation), str(artifact), content,
+                             base_version, context)
+    if request.args.get("format") == "unified":
+        return Response(unified(body["hunks"], str(artifact)), content_type="text/x-diff; charset=utf-8")
+    if not data.get("stream"):
+        return jsonify(body)
+
+    def gen():
+        hunks = body.pop("hunks")
+        yield f"data: {json.dumps({'diff': body}, ensure_ascii=False)}\n\n"
+        for hunk in hunks:
+            yield f"data: {json.dumps({'hunk': hunk}, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+    return Response(gen(), content_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/api/artifacts")
+def get_artifact():
+    """Contenido de una versión (?conversation_id=&artifact=&version=) para resincronizar.
+    La API key va en `X-API-Key`; sólo se ven los artefactos propios."""
+    api_key = caller_key()
+    if not validate_key(api_key):
+        return jsonify({"error": "API key no configurada"}), 401
+    conversation, artifact = request.args.get("conversation_id"), request.args.get("artifact")
+    if not conversation or not artifact:
+        return jsonify({"error": "Faltan conversation_id o artifact"}), 400
+    version, text = load_artifact(key_id(api_key), conversation, artifact,
+                                  request.args.get("version", type=int))
+    if text is None:
+        return jsonify({"error": "Artefacto o versión no encontrados"}), 404
+    return jsonify({"artifact": artifact, "version": version, "content": text})
 
-    system = """Eres un revisor de código experto. Analiza el siguiente output y responde SOLO con JSON:
+# ── AI Self-Review ────────────────────────────────────────────────
+REVIEW_SYSTEM = """Eres un revisor de código experto. Analiza el siguiente output y responde SOLO con JSON:
 {
   "scores": {
     "completeness": 0-100,
@@ -364,30 +4618,958 @@ def self_review():
   "summary": "resumen breve",
   "autofix": "sugerencia de mejora principal"
 }"""
+
+class ReviewParser:
+    """Parser JSON incremental y tolerante para la salida de la review.
+
+    feed(texto) devuelve los eventos que ya están completos — cada score,
+    cada issue, summary y autofix — sin esperar al final del JSON. Ignora
+    fences markdown o texto antes del primer `{`. finish() devuelve la review
+    (la completa, o la parcial si la salida quedó truncada o mal formada).
+    """
+    _FIELDS = ("summary", "autofix")
+
+    def __init__(self):
+        self.buf      = ""
+        self.pos      = 0
+        self.start    = None          # posición del `{` raíz
+        self.stack    = []            # [tipo, clave|índice, espera_clave, inicio]
+        self.in_str   = False
+        self.escaped  = False
+        self.str_at   = 0
+        self.prim_at  = None
+        self.complete = None          # dict raíz una vez cerrado
+        self.review   = {"scores": {}, "issues": [], "summary": "", "autofix": ""}
+
+    def _path(self) -> tuple:
+        return tuple(f[1] for f in self.stack)
+
+    def _value(self, raw: str, events: list):
+        path = self._path()
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            return
+        if len(path) == 2 and path[0] == "scores" and isinstance(value, (int, float)):
+            self.review["scores"][path[1]] = value
+            events.append({"score": {"name": path[1], "value": value}})
+        elif len(path) == 2 and path[0] == "issues" and isinstance(value, dict):
+            self.review["issues"].append(value)
+            events.append({"issue": value})
+        elif len(path) == 1 and path[0] in self._FIELDS and isinstance(value, str):
+            self.review[path[0]] = value
+            events.append({path[0]: value})
+
+    def _end_primitive(self, events: list):
+        if self.prim_at is not None:
+            self._value(self.buf[self.prim_at:self.pos], events)
+            self.prim_at = None
+
+    def feed(self, text: str) -> list:
+        events = []
+        self.buf += text
+        if self.start is None:
+            i = self.buf.find("{", self.pos)
+            if i < 0:
+                self.pos = len(self.buf)
+                return events
+            self.start = self.pos = i
+        while self.pos < len(self.buf) and self.complete is None:
+            c = self.buf[self.pos]
+            if self.in_str:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == '"':
+                    self.in_str = False
+                    raw, top = self.buf[self.str_at:self.pos + 1], self.stack[-1]
+                    if top[0] == "{" and top[2]:
+                        top[1], top[2] = json.loads(raw), False
+                    else:
+                        self._value(raw, events)
+            elif c == '"':
+                self.in_str, self.str_at = True, self.pos
+            elif c in "{[":
+                self.stack.append([c, None if c == "{" else 0, c == "{", self.pos])
+            elif c in "}]":
+                self._end_primitive(events)
+                if self.stack:
+                    frame = self.stack.pop()
+                    raw   = self.buf[frame[3]:self.pos + 1]
+                    if self.stack:
+                        self._value(raw, events)
+                    else:
+                        try:
+                            self.complete = json.loads(raw)
+                        except json.JSONDecodeError:
+                            self.complete = {}
+            elif c == ",":
+                self._end_primitive(events)
+                if self.stack:
+                    top = self.stack[-1]
+                    if top[0] == "{":
+                        top[1], top[2] = None, True
+                    else:
+                        top[1] += 1
+            elif c in " \t\r\n:":
+                self._end_primitive(events)
+            elif self.prim_at is None:
+                self.prim_at = self.pos
+            self.pos += 1
+        return events
+
+    def finish(self) -> tuple[dict, bool]:
+        """(review, parcial). Un summary/autofix cortado a medias se conserva."""
+        if isinstance(self.complete, dict) and self.complete:
+            return self.complete, False
+        if self.in_str and self._path() in (("summary",), ("autofix",)):
+            try:
+                self.review[self._path()[0]] = json.loads(self.buf[self.str_at:].rstrip("\\") + '"')
+            except json.JSONDecodeError:
+                pass
+        if self.start is None:
+            raise json.JSONDecodeError("No hay JSON en la review", self.buf, 0)
+        return self.review, True
+
+def parse_review(raw: str) -> dict:
+    """Review completa o, si el JSON vino truncado, la parte recuperable con `partial`."""
+    parser = ReviewParser()
+    parser.feed(raw)
+    review, partial = parser.finish()
+    return {**review, "partial": True} if partial else review
+
+class ReviewStreamHandle(StreamHandle):
+    """Stream de review: los tokens pasan por ReviewParser y salen como eventos
+    score/issue/summary/autofix; al final, la review entera (o parcial)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parser = ReviewParser()
+        self.failed = False
+
+    def emit(self, event: dict | str):
+        if isinstance(event, dict) and "token" in event:
+            for ev in self.parser.feed(event["token"]):
+                super().emit(ev)
+            return
+        if isinstance(event, dict) and "error" in event:
+            self.failed = True
+        if event == "[DONE]" and not (self.cancelled or self.failed):
+            try:
+                review, partial = self.parser.finish()
+                super().emit({"review": review, "partial": partial})
+            except json.JSONDecodeError:
+                super().emit({"review": {"summary": self.parser.buf, "scores": {}, "issues": []},
+                              "partial": True})
+        super().emit(event)
+
+# Revisión por fragmentos (map-reduce): el contenido grande se parte en
+# fronteras de fichero o función, los fragmentos se revisan en paralelo y
+# las puntuaciones se combinan ponderadas por tamaño. Cada resultado se
+# cachea por hash del fragmento: tras una edición pequeña sólo se vuelven
+# a revisar los fragmentos que cambiaron. Para eso los cortes dependen del
+# contenido y no de la posición: se corta antes de las secciones "ancla"
+# (hash de su primera línea), así una sección que crece o encoge sólo mueve
+# las fronteras de su alrededor y el resto de fragmentos sigue igual.
+_FILE_BOUNDARY = re.compile(
+    r"^(diff --git |\+\+\+ |={3,} .+ ={3,}$|(#|//|--) ?(file|archivo|fichero):)", re.I)
+_FUNC_BOUNDARY = re.compile(
+    r"^(async def |def |class |function |export |func |fn |pub fn |impl |"
+    r"(public|private|protected|static) |const \w+ = (async )?\()")
+_SEVERITY_RANK = {"critical": 0, "warning": 1, "info": 2}
+_CHUNK_ANCHOR  = 3      # ~1 de cada N secciones es ancla de corte
+
+def _is_anchor(lines: list) -> bool:
+    return zlib.crc32(lines[0].strip().encode()) % _CHUNK_ANCHOR == 0
+
+def split_review_chunks(content: str, limit: int) -> list[dict]:
+    """Trozos de ≤ limit caracteres cortados en fronteras de fichero o función.
+
+    Devuelve [{"text", "label"}]; label es la primera línea significativa."""
+    sections, current, fenced = [], [], False
+    for line in content.splitlines(keepends=True):
+        if line.startswith("```"):
+            # Sólo la apertura de un bloque de código marca frontera, no el cierre
+            boundary = fenced = not fenced
+        else:
+            boundary = bool(_FILE_BOUNDARY.match(line))
+        if current and (boundary or _FUNC_BOUNDARY.match(line)):
+            sections.append(current)
+            current = []
+        current.append(line)
+    if current:
+        sections.append(current)
+
+    def label_of(lines: list) -> str:
+        for line in lines:
+            if line.strip() and not line.startswith("```"):
+                return line.strip()[:80]
+        return lines[0].strip()[:80]
+
+    chunks, buf, size = [], [], 0
+
+    def flush():
+        nonlocal buf, size
+        if buf:
+            text = "".join(buf)
+            chunks.append({"text": text, "label": label_of(text.splitlines())})
+        buf, size = [], 0
+
+    for lines in sections:
+        text = "".join(lines)
+        if len(text) > limit:
+            # Sección mayor que el límite: va sola, cortada por líneas desde su inicio
+            flush()
+            for line in lines:
+                if buf and size + len(line) > limit:
+                    flush()
+                buf.append(line)
+                size += len(line)
+            flush()
+            continue
+        # Pasado un mínimo, se corta antes de un fichero nuevo o de una sección ancla
+        starts_file = lines[0].startswith("```") or bool(_FILE_BOUNDARY.match(lines[0]))
+        if buf and (size + len(text) > limit or (size >= limit // 3 and (starts_file or _is_anchor(lines)))):
+            flush()
+        buf.append(text)
+        size += len(text)
+    flush()
+    return chunks
+
+REVIEW_CACHE = make_cache("review:", REVIEW_CACHE_SIZE, STATE_CACHE_TTL)
+
+def _review_chunk(chunk: dict, index: int, total: int, model: str, max_tokens: int,
+                  api_key: str, trace, started: float, priority: str = "background") -> dict:
+    key = hashlib.sha256(f"{model}\0{chunk['text']}".encode()).hexdigest()
+    out = {"index": index, "label": chunk["label"], "chars": len(chunk["text"]), "cached": False}
+    cached = REVIEW_CACHE.get(key)
+    if cached is not None:
+        out.update(review=cached, cached=True, usage={})
+        return out
+    payload = {
+        "model":      model,
+        "max_tokens": max_tokens,
+        "system":     REVIEW_SYSTEM + f"\n\nEs el fragmento {index + 1} de {total} de un output mayor; "
+                                      "revisa sólo este fragmento.",
+        "messages":   [{"role": "user", "content": chunk["text"]}],
+    }
     try:
-        payload = {
-            "model":      data.get("model", DEFAULT_MODEL),
-            "max_tokens": 1024,
-            "system":     system,
-            "messages":   [{"role": "user", "content": content}],
-        }
-        resp   = requests.post(ANTHROPIC_URL, headers=anthropic_headers(api_key), json=payload, timeout=60)
+        with trace.span("review.chunk", kind="client", model=model, index=index):
+            resp = upstream_post(ANTHROPIC_URL, headers=anthropic_headers(api_key), json=payload, timeout=60,
+                                 priority=priority)
+        result = resp.json()
+        out["usage"] = result.get("usage", {})
+        if not resp.ok:
+            out["error"] = result.get("error", {}).get("message", f"API error {resp.status_code}")
+            return out
+        log_usage("review", model, out["usage"], started, api_key)
+        raw = "".join(b["text"] for b in result.get("content", []) if b.get("type") == "text")
+        out["review"] = parse_review(raw)
+        if not out["review"].get("partial"):
+            REVIEW_CACHE.put(key, out["review"])
+    except json.JSONDecodeError:
+        out["error"] = "JSON inválido en la review del fragmento"
+    except Exception as e:
+        out["error"] = str(e)
+    return out
+
+def merge_reviews(results: list[dict]) -> dict:
+    """Combina reviews de fragmentos en el esquema de una review normal."""
+    ok      = [r for r in results if "review" in r]
+    weights = {}
+    totals  = {}
+    issues, seen = [], set()
+    for r in ok:
+        for name, value in (r["review"].get("scores") or {}).items():
+            if isinstance(value, (int, float)):
+                totals[name]  = totals.get(name, 0) + value * r["chars"]
+                weights[name] = weights.get(name, 0) + r["chars"]
+        for issue in r["review"].get("issues") or []:
+            if not isinstance(issue, dict):
+                continue
+            sig = (issue.get("severity"), issue.get("message"))
+            if sig in seen:
+                continue
+            seen.add(sig)
+            issues.append({**issue, "chunk": r["index"], "location": r["label"]})
+    issues.sort(key=lambda i: _SEVERITY_RANK.get(i.get("severity"), 3))
+
+    def avg_score(r):
+        s = [v for v in (r["review"].get("scores") or {}).values() if isinstance(v, (int, float))]
+        return sum(s) / len(s) if s else 100
+    worst = min(ok, key=avg_score) if ok else None
+    return {
+        "scores":  {name: round(totals[name] / weights[name]) for name in totals},
+        "issues":  issues,
+        "summary": " ".join(f"[{r['index'] + 1}/{len(results)}] {r['review'].get('summary', '')}".strip()
+                            for r in ok),
+        "autofix": worst["review"].get("autofix", "") if worst else "",
+    }
+
+def chunked_review(data: dict, content: str, api_key: str, started: float):
+    chunks = split_review_chunks(content, REVIEW_CHUNK_CHARS)
+    payload = {
+        "model":      data.get("model", DEFAULT_MODEL),
+        "max_tokens": REVIEW_CHUNK_MAX_TOKENS * len(chunks),
+        "messages":   [{"role": "user", "content": content}],
+    }
+    try:
+        reservation = reserve_payload(payload, data, api_key)
+    except BudgetExceeded as e:
+        return jsonify(e.to_dict()), 402
+    per_chunk = max(1, payload["max_tokens"] // len(chunks))
+    trace = current_trace()
+    usage = {}
+    try:
+        with trace.span("review.map", chunks=len(chunks)), \
+             ThreadPoolExecutor(max_workers=min(REVIEW_CONCURRENCY, len(chunks)),
+                                thread_name_prefix="review") as pool:
+            results = list(pool.map(
+                lambda ic: _review_chunk(ic[1], ic[0], len(chunks), payload["model"],
+                                         per_chunk, api_key, trace, started,
+                                         request_priority(data, "background")),
+                enumerate(chunks)))
+        for r in results:
+            for k, v in (r.get("usage") or {}).items():
+                if isinstance(v, int):
+                    usage[k] = usage.get(k, 0) + v
+        if not any("review" in r for r in results):
+            return jsonify({"error": results[0].get("error", "Review fallida")}), 502
+        with span("review.reduce"):
+            review = merge_reviews(results)
+        return jsonify({
+            "review": review,
+            "usage":  usage,
+            "chunks": [{k: r.get(k) for k in ("index", "label", "chars", "cached", "error") if r.get(k) is not None}
+                       for r in results],
+        })
+    finally:
+        BUDGETS.settle(reservation, usage)
+
+@app.route("/api/review", methods=["POST"])
+def self_review():
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
+    api_key = extract_key(data)
+    content = data.get("content", "")
+
+    if not validate_key(api_key):
+        return jsonify({"error": "API key no configurada"}), 401
+    if not content.strip():
+        return jsonify({"error": "Contenido vacío"}), 400
+
+    # chunked: true/false fuerza el modo; por defecto sólo si el contenido es grande
+    if data.get("chunked", len(content) > REVIEW_CHUNK_CHARS):
+        if data.get("model") == "auto":
+            data["model"] = ROUTER.route({"messages": [{"role": "user", "content": content[:REVIEW_CHUNK_CHARS]}],
+                                         "max_tokens": REVIEW_CHUNK_MAX_TOKENS}, "review")["model"]
+        return chunked_review(data, content, api_key, started)
+
+    payload = {
+        "model":      data.get("model", DEFAULT_MODEL),
+        "max_tokens": 1024,
+        "system":     REVIEW_SYSTEM,
+        "messages":   [{"role": "user", "content": content}],
+    }
+    resolve_model(payload, "review")
+    try:
+        reservation = reserve_payload(payload, data, api_key)
+    except BudgetExceeded as e:
+        return jsonify(e.to_dict()), 402
+    usage = {}
+    try:
+        with span("upstream.request", kind="client", model=payload["model"]):
+            resp   = upstream_post(ANTHROPIC_URL, headers=anthropic_headers(api_key), json=payload, timeout=60,
+                                   priority=request_priority(data, "background"))
         result = resp.json()
         raw    = "".join(b["text"] for b in result.get("content", []) if b.get("type") == "text")
-        # Limpiar posibles markdown fences
-        clean  = raw.strip().lstrip("```json").lstrip("```").rstrip("```").strip()
-        review = json.loads(clean)
-        return jsonify({"review": review, "usage": result.get("usage", {})})
+        usage  = result.get("usage", {})
+        log_usage("review", payload["model"], usage, started, api_key)
+        review = parse_review(raw)
+        ROUTER.observe("review", None, payload["model"], (time.perf_counter() - started) * 1000,
+                       0.5 if review.get("partial") else outcome_quality(result.get("stop_reason"), not resp.ok))
+        return jsonify({"review": review, "usage": usage})
     except json.JSONDecodeError:
         return jsonify({"review": {"summary": raw, "scores": {}, "issues": []}, "raw": raw})
+    except SchedulerTimeout as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    finally:
+        BUDGETS.settle(reservation, usage)
+
+@app.route("/api/review/stream", methods=["POST"])
+def review_stream():
+    """Review por SSE: cada score/issue se emite en cuanto su JSON está completo."""
+    started = time.perf_counter()
+    with span("request.parse"):
+        data = json_body()
+    api_key = extract_key(data)
+    content = data.get("content", "")
+
+    if not validate_key(api_key):
+        return sse_error("API key no configurada")
+    if not content.strip():
+        return sse_error("Contenido vacío")
+    if STREAMS.taken(data.get("stream_id")):
+        return sse_error("stream_id ya en uso", stream_id=data["stream_id"])
+
+    req = {
+        "model":           data.get("model", DEFAULT_MODEL),
+        "max_tokens":      1024,
+        "system":          REVIEW_SYSTEM,
+        "messages":        [{"role": "user", "content": content}],
+        "temperature":     data.get("temperature", 0.7),
+        "conversation_id": data.get("conversation_id"),
+        "priority":        request_priority(data, "background"),
+    }
+    resolve_model(req, "review")
+    try:
+        reservation = BUDGETS.reserve(req, api_key)
+    except BudgetExceeded as e:
+        return sse_error(**e.to_dict())
+
+    model  = req["model"]
+    handle = STREAMS.open(data.get("stream_id"), client_socket(),
+                          resumable=bool(data.get("resumable", SSE_RESUMABLE)), cls=ReviewStreamHandle,
+                          owner=key_id(api_key))
+    handle.emit({"stream_id": handle.id})
+    threading.Thread(
+        target=pump_anthropic_stream,
+        args=(handle, req, api_key, model, reservation, current_trace(), started, "review"),
+        name=f"review-{handle.id}", daemon=True,
+    ).start()
+    return sse_response(sse_frames(handle), handle)
+
+# ── Presupuesto ───────────────────────────────────────────────────
+@app.route("/api/budget")
+def budget_status():
+    """Gasto y saldo de la ventana actual: ?conversation_id=… (key por X-Api-Key o .env)."""
+    api_key = request.headers.get("X-Api-Key") or API_KEY
+    return jsonify(BUDGETS.status(api_key, request.args.get("conversation_id")))
+
+# ── Analytics ─────────────────────────────────────────────────────
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def _parse_time(value: str | None, default: float) -> float:
+    """Acepta epoch en segundos o duraciones relativas: 30m, 24h, 90d."""
+    if not value:
+        return default
+    if value[-1] in _DURATION_UNITS:
+        return time.time() - float(value[:-1]) * _DURATION_UNITS[value[-1]]
+    return float(value)
+
+@app.route("/api/analytics")
+def analytics():
+    """Rollups de uso: ?since=24h&until=&bucket=minute|hour|day&group_by=model,endpoint,key_id,bucket"""
+    try:
+        until = _parse_time(request.args.get("until"), time.time())
+        since = _parse_time(request.args.get("since"), until - 86400)
+    except ValueError:
+        return jsonify({"error": "Parámetros since/until inválidos"}), 400
+    group_by = tuple(c.strip() for c in request.args.get("group_by", "model").split(",") if c.strip())
+    filters  = {c: request.args.get(c) for c in ("model", "endpoint", "key_id")}
+    with span("analytics.query"):
+        result = USAGE.query(since, until, request.args.get("bucket"), group_by, filters)
+    return jsonify(result)
+
+# ── Router ────────────────────────────────────────────────────────
+@app.route("/api/router")
+def router_status():
+    """Tiers, umbrales y EWMAs de latencia/calidad por ruta y modelo."""
+    return jsonify(ROUTER.snapshot())
+
+@app.route("/api/router/feedback", methods=["POST"])
+def router_feedback():
+    """Señal de calidad explícita: {"endpoint", "agent", "model", "quality": 0-1}.
+
+    Por ejemplo, la media de los scores de /api/review sobre la salida de un agente.
+    """
+    data = json_body()
+    if not validate_key(extract_key(data)):
+        return jsonify({"error": "API key no configurada"}), 401
+    try:
+        quality = min(max(float(data["quality"]), 0.0), 1.0)
+        model   = str(data["model"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Se requieren 'model' y 'quality' (0-1)"}), 400
+    endpoint = str(data.get("endpoint", "stream"))
+    if endpoint not in ROUTER_ENDPOINTS or model not in ROUTER.tiers:
+        return jsonify({"error": "'endpoint' o 'model' fuera del router",
+                        "endpoints": ROUTER_ENDPOINTS, "tiers": ROUTER.tiers}), 400
+    ROUTER.observe(endpoint, data.get("agent"), model, None, quality)
+    return jsonify({"ok": True})
+
+# ── Métricas ──────────────────────────────────────────────────────
+@app.route("/api/metrics")
+def metrics():
+    """Colas del scheduler y de admisión por clase (JSON, o Prometheus con ?format=prometheus)."""
+    snap = {name: sch.metrics() for name, sch in SCHEDULERS.items()}
+    admission = {cls: pool.metrics() for cls, pool in ADMISSION.items()}
+    if request.args.get("format") != "prometheus":
+        return jsonify({"schedulers": snap, "admission": admission,
+                        "server_rejected": SERVER.rejected if SERVER else 0})
+    lines = []
+    for metric, help_text in (("queue_depth", "Peticiones esperando slot upstream"),
+                              ("admitted", "Peticiones admitidas"),
+                              ("expired", "Peticiones que superaron su deadline en cola"),
+                              ("wait_ms_avg", "Espera media en cola (ms)"),
+                              ("wait_ms_p95", "Espera p95 en cola (ms)")):
+        lines.append(f"# HELP agent_studio_sched_{metric} {help_text}")
+        lines.append(f"# TYPE agent_studio_sched_{metric} {'counter' if metric in ('admitted', 'expired') else 'gauge'}")
+        for name, m in snap.items():
+            for cls, c in m["classes"].items():
+                lines.append(f'agent_studio_sched_{metric}{{upstream="{name}",class="{cls}"}} {c[metric]}')
+    lines.append("# TYPE agent_studio_sched_in_flight gauge")
+    for name, m in snap.items():
+        lines.append(f'agent_studio_sched_in_flight{{upstream="{name}"}} {m["in_flight"]}')
+    for metric, kind in (("in_flight", "gauge"), ("queue_depth", "gauge"), ("admitted", "counter"),
+                         ("shed", "counter"), ("wait_ms_p95", "gauge")):
+        lines.append(f"# TYPE agent_studio_admission_{metric} {kind}")
+        for cls, a in admission.items():
+            lines.append(f'agent_studio_admission_{metric}{{class="{cls}"}} {a[metric]}')
+    lines.append("# TYPE agent_studio_server_rejected counter")
+    lines.append(f"agent_studio_server_rejected {SERVER.rejected if SERVER else 0}")
+    return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4")
+
+# ── Trazas ────────────────────────────────────────────────────────
+@app.route("/api/traces")
+def get_traces():
+    """Consulta el ring buffer: ?slow=<ms>&name=<ruta>&limit=<n>&format=otlp"""
+    try:
+        slow  = float(request.args.get("slow", 0))
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return jsonify({"error": "Parámetros slow/limit inválidos"}), 400
+    traces = TRACES.query(slow_ms=slow, name=request.args.get("name"), limit=limit)
+    if request.args.get("format") == "otlp":
+        return jsonify(traces_to_otlp(traces))
+    return jsonify({"traces": [t.to_dict() for t in traces], "count": len(traces)})
+
+@app.route("/api/traces/<trace_id>")
+def get_trace(trace_id):
+    trace = TRACES.get(trace_id)
+    if trace is None:
+        return jsonify({"error": "Traza no encontrada"}), 404
+    if request.args.get("format") == "otlp":
+        return jsonify(traces_to_otlp([trace]))
+    return jsonify(trace.to_dict())
+
+# ── Profiler (admin) ──────────────────────────────────────────────
+# Profiler de muestreo bajo demanda: un hilo lee sys._current_frames() cada
+# PROFILE_INTERVAL_MS y agrega las pilas de todos los hilos (incluidos los
+# bucles generate() de SSE y los productores) durante N segundos o N
+# peticiones. La CPU por endpoint sale de /proc/self/task/<tid>/stat, que
+# mide tiempo real de CPU por hilo (Linux). Sólo con X-Admin-Token.
+_THREAD_ENDPOINT = {}     # ident del hilo → "MÉTODO /ruta" mientras sirve una petición
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+def admin_required(fn):
+    """Exige ADMIN_TOKEN en X-Admin-Token o Authorization: Bearer; sin token configurado, 404."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "No encontrado"}), 404
+        given = request.headers.get("X-Admin-Token") or \
+            request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(given.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"error": "Token de administración inválido"}), 401
+        return fn(*args, **kwargs)
+    return wrapper
+
+def _thread_label(thread: threading.Thread | None, ident: int) -> str:
+    endpoint = _THREAD_ENDPOINT.get(ident)
+    if endpoint:
+        return endpoint
+    name = thread.name if thread else f"thread-{ident}"
+    # stream-9d0982…, agent-…, tool_3, "Thread-7 (process_request_thread)" → stream, agent, tool, process_request_thread
+    name = re.sub(r"^Thread-\d+ \((.+)\)$", r"\1", name)
+    return re.sub(r"([-_][0-9a-f]{6,}|_\d+|-\d+)$", "", name)
+
+def _thread_cpu(native_id: int | None) -> float | None:
+    """Segundos de CPU (user+sys) de un hilo, o None fuera de Linux."""
+    if native_id is None:
+        return None
+    try:
+        with open(f"/proc/self/task/{native_id}/stat", "rb") as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLK_TCK
+    except (OSError, IndexError, ValueError):
+        return None
+
+_FRAME_NAMES = {}
+
+def _frame_name(frame) -> str:
+    key  = (frame.f_code, frame.f_lineno)
+    name = _FRAME_NAMES.get(key)
+    if name is None:
+        code = frame.f_code
+        name = _FRAME_NAMES[key] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+    return name
+
+class Profiler:
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self.running = False
+        self.result  = None
+
+    def start(self, seconds: float, requests_limit: int | None, interval_ms: float) -> bool:
+        with self._lock:
+            if self.running:
+                return False
+            self.running  = True
+            self.result   = None
+            self.requests = 0
+            self.limit    = requests_limit
+            self.seconds  = seconds
+            self.interval = interval_ms / 1000
+            self._stop    = threading.Event()
+        threading.Thread(target=self._run, name="profiler", daemon=True).start()
+        return True
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+
+    def request_done(self):
+        if self.running and self.limit:
+            self.requests += 1
+            if self.requests >= self.limit:
+                self._stop.set()
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.running and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self.running
+
+    def _run(self):
+        me       = threading.get_ident()
+        stacks   = {}
+        samples  = 0
+        cpu      = {}                 # etiqueta → s de CPU
+        cpu_prev = {}                 # ident → (etiqueta, cpu acumulada)
+        started  = time.perf_counter()
+        overhead = 0.0
+        cpu_every = max(1, round(0.1 / self.interval))   # CPU por hilo cada ~100 ms
+
+        def sample_cpu(threads):
+            for ident, t in threads.items():
+                if ident == me:
+                    continue
+                now = _thread_cpu(t.native_id)
+                if now is None:
+                    continue
+                label, before = cpu_prev.get(ident, (None, None))
+                if before is not None:
+                    cpu[label] = cpu.get(label, 0.0) + max(now - before, 0.0)
+                cpu_prev[ident] = (_thread_label(t, ident), now)
+
+        try:
+            while not self._stop.is_set() and time.perf_counter() - started < self.seconds:
+                t0      = time.perf_counter()
+                threads = {t.ident: t for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_name(frame))
+                        frame = frame.f_back
+                    names.append(_thread_label(threads.get(ident), ident))
+                    key = ";".join(reversed(names))
+                    stacks[key] = stacks.get(key, 0) + 1
+                if samples % cpu_every == 0:
+                    sample_cpu(threads)
+                samples  += 1
+                overhead += time.perf_counter() - t0
+                self._stop.wait(max(self.interval - (time.perf_counter() - t0), 0))
+            sample_cpu({t.ident: t for t in threading.enumerate()})
+        finally:
+            elapsed = time.perf_counter() - started
+            self.result = {
+                "samples":      samples,
+                "seconds":      round(elapsed, 3),
+                "requests":     self.requests,
+                "interval_ms":  self.interval * 1000,
+                "overhead_pct": round(overhead / elapsed * 100, 2) if elapsed else 0.0,
+                "stacks":       stacks,
+                "cpu": sorted(({"endpoint": k, "cpu_s": round(v, 3),
+                                "cpu_pct": round(v / elapsed * 100, 1) if elapsed else 0.0}
+                               for k, v in cpu.items() if k), key=lambda r: -r["cpu_s"]),
+            }
+            self.running = False
+            _FRAME_NAMES.clear()
+
+    @staticmethod
+    def collapsed(stacks: dict) -> str:
+        """Formato de flamegraph.pl / speedscope: "raíz;…;hoja cuenta"."""
+        return "".join(f"{k} {v}\n" for k, v in sorted(stacks.items()))
+
+    @staticmethod
+    def flamegraph(stacks: dict) -> dict:
+        """Árbol {name, value, children} (d3-flame-graph)."""
+        root = {"name": "all", "value": 0, "children": {}}
+        for key, count in stacks.items():
+            node = root
+            node["value"] += count
+            for name in key.split(";"):
+                node = node["children"].setdefault(name, {"name": name, "value": 0, "children": {}})
+                node["value"] += count
+
+        def finish(node):
+            node["children"] = [finish(c) for c in node["children"].values()]
+            return node
+        return finish(root)
+
+PROFILER = Profiler()
+
+@app.before_request
+def _profile_mark():
+    rule = request.url_rule.rule if request.url_rule else request.path
+    _THREAD_ENDPOINT[threading.get_ident()] = f"{request.method} {rule}"
+
+@app.after_request
+def _profile_unmark(response):
+    ident = threading.get_ident()
+
+    def _close():
+        _THREAD_ENDPOINT.pop(ident, None)
+        PROFILER.request_done()
+    # call_on_close corre al terminar de enviar el body, también en SSE
+    response.call_on_close(_close)
+    return response
+
+@app.route("/api/admin/profile", methods=["POST"])
+@admin_required
+def start_profile():
+    """{"seconds": 10} o {"requests": 200}; con "wait": true espera y devuelve el resultado."""
+    data = json_body() if request.content_length else {}
+    try:
+        seconds  = min(float(data.get("seconds", PROFILE_MAX_SECONDS)), PROFILE_MAX_SECONDS)
+        limit    = int(data["requests"]) if data.get("requests") else None
+        interval = max(float(data.get("interval_ms", PROFILE_INTERVAL_MS)), 1.0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Parámetros seconds/requests/interval_ms inválidos"}), 400
+    if not PROFILER.start(seconds, limit, interval):
+        return jsonify({"error": "Ya hay un perfilado en curso"}), 409
+    log.info(f"[profile] inicio seconds={seconds:g} requests={limit} interval={interval:g}ms")
+    if data.get("wait") and not limit:
+        PROFILER.wait(seconds + 5)
+        return profile_result()
+    return jsonify({"running": True, "seconds": seconds, "requests": limit, "interval_ms": interval}), 202
+
+@app.route("/api/admin/profile", methods=["GET"])
+@admin_required
+def profile_result():
+    """Resultado del último perfilado: JSON (flamegraph + CPU) o ?format=collapsed."""
+    if PROFILER.running:
+        return jsonify({"running": True, "requests": PROFILER.requests}), 202
+    res = PROFILER.result
+    if res is None:
+        return jsonify({"error": "Sin perfilado; lanza uno con POST"}), 404
+    if request.args.get("format") == "collapsed":
+        return Response(Profiler.collapsed(res["stacks"]), content_type="text/plain; charset=utf-8")
+    out = {k: v for k, v in res.items() if k != "stacks"}
+    out["flamegraph"] = Profiler.flamegraph(res["stacks"])
+    return jsonify(out)
+
+@app.route("/api/admin/profile", methods=["DELETE"])
+@admin_required
+def stop_profile():
+    PROFILER.stop()
+    PROFILER.wait(5)
+    return jsonify({"stopped": True})
+
+# ── Admisión y servidor ───────────────────────────────────────────
+# Con threaded=True werkzeug crea un hilo por conexión sin límite: con
+# sobrecarga la memoria sube y todo se ralentiza. Aquí cada clase de
+# endpoint tiene un pool acotado (workers + cola) y el servidor un máximo
+# de hilos. La cola sigue la variante CoDel de "adaptive timeout": si no
+# se ha vaciado en el último ADMISSION_INTERVAL_MS, la espera máxima baja
+# a ADMISSION_TARGET_MS, así que con sobrecarga sostenida el exceso se
+# rechaza enseguida con 503 + Retry-After en vez de hacer cola.
+def admission_class(path: str) -> str | None:
+    """Clase de admisión de una ruta; None = sin control (health, métricas, cancelación…)."""
+    if not path.startswith("/api/"):
+        return "static"
+    if path.endswith("/cancel") or path.startswith(("/api/admin", "/api/health", "/api/metrics")):
+        return None
+    if path.startswith(("/api/stream", "/api/ws", "/api/agent")) or path.endswith("/stream"):
+        return "stream"
+    if path.startswith("/api/chat"):
+        return "chat"
+    if path.startswith(("/api/enhance", "/api/review")):
+        return "assist"
+    if path.startswith("/api/blobs"):
+        return "blobs"
+    return None
+
+class AdmissionPool:
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name       = name
+        self.workers    = workers
+        self.queue_size = queue_size
+        self.in_flight  = 0
+        self.admitted   = 0
+        self.shed       = 0
+        self.waits      = deque(maxlen=512)          # ms en cola de las últimas admisiones
+        self.last_empty = time.monotonic()
+        self._waiters   = deque()
+        self._lock      = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if not self._waiters:
+                self.last_empty = now
+                if self.in_flight < self.workers:
+                    self.in_flight += 1
+                    self.admitted  += 1
+                    self.waits.append(0.0)
+                    return True
+            if len(self._waiters) >= self.queue_size:
+                self.shed += 1
+                return False
+            overloaded = now - self.last_empty > ADMISSION_INTERVAL_MS / 1000
+            timeout    = (ADMISSION_TARGET_MS if overloaded else ADMISSION_MAX_WAIT_MS) / 1000
+            ev = threading.Event()
+            self._waiters.append(ev)
+        ev.wait(timeout)
+        with self._lock:
+            if not ev.is_set():
+                self._waiters.remove(ev)
+                if not self._waiters:
+                    self.last_empty = time.monotonic()
+                self.shed += 1
+                return False
+            # release() nos ha cedido su slot: in_flight ya nos cuenta
+            self.admitted += 1
+            self.waits.append((time.monotonic() - now) * 1000)
+            return True
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+                if not self._waiters:
+                    self.last_empty = time.monotonic()
+            else:
+                self.in_flight -= 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            waits = sorted(self.waits)
+            return {
+                "workers":     self.workers,
+                "in_flight":   self.in_flight,
+                "queue_depth": len(self._waiters),
+                "queue_size":  self.queue_size,
+                "admitted":    self.admitted,
+                "shed":        self.shed,
+                "overloaded":  bool(self._waiters) and
+                               time.monotonic() - self.last_empty > ADMISSION_INTERVAL_MS / 1000,
+                "wait_ms_p95": round(waits[max(math.ceil(len(waits) * 0.95) - 1, 0)], 1) if waits else 0.0,
+            }
+
+def _pool_limits(cls: str, default: str) -> tuple[int, int]:
+    workers, queue_size = os.getenv(f"ADMISSION_{cls.upper()}", default).split(",")
+    return int(workers), int(queue_size)
+
+ADMISSION = {cls: AdmissionPool(cls, *_pool_limits(cls, default)) for cls, default in
+             (("stream", "64,32"), ("chat", "32,32"), ("assist", "16,16"), ("blobs", "8,16"),
+              ("static", "32,32"))}
+
+def _retry_after() -> str:
+    return str(max(1, math.ceil(ADMISSION_INTERVAL_MS / 1000)))
+
+class AdmissionMiddleware:
+    """WSGI: reserva un slot de la clase de la ruta hasta cerrar la respuesta (SSE incluido)."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        cls  = admission_class(environ.get("PATH_INFO", ""))
+        pool = ADMISSION.get(cls) if ADMISSION_ENABLED else None
+        if pool is None:
+            return self.wsgi_app(environ, start_response)
+        if not pool.acquire():
+            log.warning(f"[admission] 503 {cls} {environ.get('PATH_INFO')}")
+            body = json.dumps({"error": "Servidor saturado, reintenta más tarde", "class": cls}).encode()
+            start_response("503 SERVICE UNAVAILABLE", [
+                ("Content-Type", "application/json"), ("Content-Length", str(len(body))),
+                ("Retry-After", _retry_after())])
+            return [body]
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except BaseException:
+            pool.release()
+            raise
+        return ClosingIterator(result, pool.release)
+
+app.wsgi_app = AdmissionMiddleware(app.wsgi_app)
+
+class BoundedWSGIServer(ThreadedWSGIServer):
+    """ThreadedWSGIServer con un máximo de hilos: sin hueco, 503 directo sobre el socket."""
+    daemon_threads = True
+
+    def __init__(self, *args, max_threads: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slots    = threading.BoundedSemaphore(max_threads)
+        self.rejected = 0
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: " + _retry_after().encode()
+                                + b"\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        threading.Thread(target=self._handle, args=(request, client_address),
+                         name="http", daemon=True).start()
+
+    def _handle(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            self.slots.release()
+
+SERVER = None
+
+def run_server():
+    """Sirve la app con hilos acotados (SERVER_MAX_THREADS=0 → app.run clásico)."""
+    global SERVER
+    if SERVER_MAX_THREADS <= 0:
+        app.run(host=HOST, port=PORT, debug=DEBUG, threaded=True, use_reloader=False)
+        return
+    app.debug = DEBUG
+    SERVER = BoundedWSGIServer(HOST, PORT, app, max_threads=SERVER_MAX_THREADS)
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        SERVER.server_close()
 
 # ── Error handlers ────────────────────────────────────────────────
 @app.errorhandler(404)
 def not_found(e):
     return jsonify({"error": "Ruta no encontrada"}), 404
 
+@app.errorhandler(413)
+def too_large(e):
+    return jsonify({"error": f"Body mayor de {MAX_BODY_BYTES} bytes"}), 413
+
+@app.errorhandler(BodyError)
+def body_error(e):
+    return jsonify({"error": str(e)}), e.status
+
 @app.errorhandler(405)
 def method_not_allowed(e):
     return jsonify({"error": "Método no permitido"}), 405
@@ -407,7 +5589,8 @@ def print_banner():
 
 \033[96m  URL        →  http://{HOST}:{PORT}\033[0m
 \033[93m  API Key    →  {key_status}\033[0m
-\033[2m  Logs       →  logs/agent_studio.log
+\033[93m  Upstream   →  {UPSTREAM_MODE}{f" ({CASSETTE_DIR}, {len(CASSETTE)} grabaciones)" if CASSETTE else ""}\033[0m
+\033[2m  Logs       →  logs/agent_studio.log ({LOG_FORMAT}, rotación {LOG_MAX_BYTES // 1048576} MB / {LOG_ROTATE_HOURS:g} h)
   Debug      →  {"ON" if DEBUG else "OFF"}
   Fecha      →  {datetime.now().strftime("%Y-%m-%d %H:%M")}\033[0m
 
@@ -415,11 +5598,28 @@ def print_banner():
 \033[2m  GET  /               → index.html
   POST /api/chat         → Chat estándar
   POST /api/stream       → SSE streaming
+  POST /api/stream/multi → Varios agentes en un SSE
+  GET  /api/ws           → WebSocket (sesión persistente)
+  GET  /api/stream/<id>  → Reanudar stream (Last-Event-ID)
+  POST /api/stream/<id>/cancel → Cancelar stream
+  POST /api/agent        → Agente con herramientas (SSE)
+  GET  /api/tools        → Herramientas del servidor
   POST /api/enhance      → Mejorar prompt
+  POST /api/enhance/stream → Mejorar prompt por SSE (debounce)
   POST /api/review       → Auto-review
+  POST /api/review/stream → Auto-review por SSE (incremental)
+  POST /api/blobs        → Subir adjunto (sha256)
+  POST /api/diff         → Diff contra la versión anterior de un artefacto
   GET  /api/models       → Modelos disponibles
   GET  /api/health       → Health check
-  GET  /api/config       → Configuración\033[0m
+  GET  /api/config       → Configuración
+  GET  /api/assets       → Manifiesto de assets con hash
+  GET  /api/budget       → Presupuesto restante
+  GET  /api/analytics    → Uso agregado (tokens, latencia)
+  GET  /api/metrics      → Colas del scheduler upstream
+  GET  /api/router       → Router de modelos (model: "auto")
+  GET  /api/traces       → Trazas por petición
+  POST /api/admin/profile→ Profiler de muestreo (ADMIN_TOKEN)\033[0m
 
 \033[93m  Ctrl+C para detener\033[0m
 """)
@@ -432,10 +5632,4 @@ if __name__ == "__main__":
         print("\033[93m  ⚠  Crea el archivo .env con:\033[0m")
         print("\033[2m      ANTHROPIC_API_KEY=sk-ant-api03-...\033[0m\n")
 
-    app.run(
-        host=HOST,
-        port=PORT,
-        debug=DEBUG,
-        threaded=True,
-        use_reloader=False,
-    )
+    run_server()
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+╔══════════════════════════════════════════════════════════════════╗
+║          AGENT STUDIO v2.0 — Benchmark de carga del proxy        ║
+║    Mock local de Anthropic /v1/messages + Ollama /api/chat       ║
+╚══════════════════════════════════════════════════════════════════╝
+
+Arranca un mock de la API de Anthropic (JSON y SSE) y de Ollama con
+latencia y ritmo de tokens configurables, lanza Agente-web.py apuntando
+a ellos (ANTHROPIC_URL / OLLAMA_HOST) y mide, con N clientes concurrentes,
+lo que añade el propio proxy: throughput, latencia p50/p99 añadida,
+sobrecoste de TTFT y CPU/RSS del servidor por stream.
+
+Uso:
+    python bench_agent_studio.py                          → escenarios por defecto
+    python bench_agent_studio.py -c 32 -n 20 --tokens 200 → más carga
+    python bench_agent_studio.py --out base.json          → guardar informe
+    python bench_agent_studio.py --compare base.json      → comparar (exit 1 si empeora)
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import textwrap
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# ─── Colores ANSI ────────────────────────────────────────────────
+class C:
+    G  = "\033[92m"
+    Y  = "\033[93m"
+    R  = "\033[91m"
+    CY = "\033[96m"
+    P  = "\033[95m"
+    DIM= "\033[2m"
+    RST= "\033[0m"
+    BOLD="\033[1m"
+
+def ok(msg):   print(f"{C.G}  ✓  {msg}{C.RST}")
+def warn(msg): print(f"{C.Y}  ⚠  {msg}{C.RST}")
+def err(msg):  print(f"{C.R}  ✗  {msg}{C.RST}")
+def info(msg): print(f"{C.CY}  →  {msg}{C.RST}")
+def hdr(msg):  print(f"\n{C.P}{C.BOLD}{'─'*60}\n  {msg}\n{'─'*60}{C.RST}")
+
+BASE_DIR = Path(__file__).parent
+SERVER   = BASE_DIR / "Agente-web.py"
+API_KEY  = "sk-ant-bench-0000"
+
+# ─── Mock upstream ───────────────────────────────────────────────
+class MockConfig:
+    latency_ms = 50.0    # espera antes de la primera respuesta/byte
+    token_rate = 200.0   # tokens/s en streaming (0 = sin pausa)
+    tokens     = 64      # tokens por respuesta
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Mock de Anthropic (/v1/messages) y Ollama (/api/tags, /api/chat, /api/generate, /api/ps)."""
+    protocol_version = "HTTP/1.1"
+    cfg = MockConfig
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> dict:
+        n = int(self.headers.get("Content-Length", 0) or 0)
+        return json.loads(self.rfile.read(n) or b"{}") if n else {}
+
+    def _json(self, obj: dict, status: int = 200):
+        raw = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _start_stream(self, ctype: str):
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def _pace(self):
+        if self.cfg.token_rate > 0:
+            time.sleep(1.0 / self.cfg.token_rate)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._json({"models": [{"name": "llama3.2", "size": 2_000_000_000},
+                                   {"name": "qwen2.5-coder", "size": 4_700_000_000}]})
+        elif self.path == "/api/ps":
+            self._json({"models": []})
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self._body()
+        time.sleep(self.cfg.latency_ms / 1000)
+        n = self.cfg.tokens
+        if self.path == "/v1/messages":
+            self._anthropic(body, n)
+        elif self.path == "/api/chat":
+            self._ollama(body, n)
+        elif self.path == "/api/generate":
+            self._json({"model": body.get("model"), "response": "", "done": True})
+        else:
+            self._json({"error": "not found"}, 404)
+
+    def _anthropic(self, body: dict, n: int):
+        model = body.get("model", "mock")
+        if not body.get("stream"):
+            self._json({
+                "id": "msg_mock", "type": "message", "role": "assistant", "model": model,
+                "content": [{"type": "text", "text": " ".join(f"tok{i}" for i in range(n))}],
+                "stop_reason": "end_turn",
+                "usage": {"input_tokens": 10, "output_tokens": n},
+            })
+            return
+        self._start_stream("text/event-stream")
+        events = [{"type": "message_start", "message": {"model": model, "usage": {"input_tokens": 10, "output_tokens": 1}}},
+                  {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}]
+        for ev in events:
+            self._sse(ev)
+        for i in range(n):
+            self._sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": f"tok{i} "}})
+            self._pace()
+        for ev in ({"type": "content_block_stop", "index": 0},
+                   {"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": n}},
+                   {"type": "message_stop"}):
+            self._sse(ev)
+
+    def _sse(self, event: dict):
+        self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+        self.wfile.flush()
+
+    def _ollama(self, body: dict, n: int):
+        model = body.get("model", "llama3.2")
+        if not body.get("stream", True):
+            self._json({"model": model, "message": {"role": "assistant", "content": " ".join(f"tok{i}" for i in range(n))},
+                        "done": True, "prompt_eval_count": 10, "eval_count": n})
+            return
+        self._start_stream("application/x-ndjson")
+        for i in range(n):
+            self.wfile.write((json.dumps({"model": model, "message": {"content": f"tok{i} "}, "done": False}) + "\n").encode())
+            self.wfile.flush()
+            self._pace()
+        self.wfile.write((json.dumps({"model": model, "done": True, "prompt_eval_count": 10, "eval_count": n}) + "\n").encode())
+
+def start_mock() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-upstream", daemon=True).start()
+    return server
+
+# ─── Servidor bajo prueba ────────────────────────────────────────
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def drain(stream):
+    for _ in stream:
+        pass
+
+def start_server(mock_url: str, port: int, extra_env: dict) -> subprocess.Popen:
+    fixed = {"HOST": "127.0.0.1", "PORT": str(port), "DEBUG": "false",
+             "ANTHROPIC_API_KEY": API_KEY,
+             "ANTHROPIC_URL": f"{mock_url}/v1/messages",
+             "OLLAMA_HOST": mock_url,
+             "LOG_LEVEL": "WARNING"}
+    # --env pisa los valores por defecto (p.ej. LOG_LEVEL=INFO)
+    env = {**os.environ, **fixed, **extra_env}
+    proc = subprocess.Popen([sys.executable, str(SERVER)], env=env, cwd=str(BASE_DIR),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    url = f"http://127.0.0.1:{port}/api/health"
+    deadline = time.time() + 20
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"El servidor terminó al arrancar:\n{proc.stderr.read().decode()[-2000:]}")
+        try:
+            if requests.get(url, timeout=1).ok:
+                # Vaciar stderr en segundo plano: con LOG_LEVEL bajo la tubería se
+                # llenaría y el servidor se bloquearía al escribir logs
+                threading.Thread(target=drain, args=(proc.stderr,), name="server-stderr",
+                                 daemon=True).start()
+                return proc
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("El servidor no respondió a /api/health en 20 s")
+
+class ProcessSampler:
+    """CPU (utime+stime) y RSS del proceso servidor: psutil o /proc (Linux)."""
+
+    def __init__(self, pid: int):
+        self.pid  = pid
+        self.proc = psutil.Process(pid) if psutil else None
+        self.peak_rss = 0
+        self._stop = threading.Event()
+
+    @property
+    def available(self) -> bool:
+        return self.proc is not None or Path(f"/proc/{self.pid}/stat").exists()
+
+    def cpu_seconds(self) -> float | None:
+        if self.proc is not None:
+            t = self.proc.cpu_times()
+            return t.user + t.system
+        try:
+            fields = Path(f"/proc/{self.pid}/stat").read_text().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_bytes(self) -> int | None:
+        if self.proc is not None:
+            return self.proc.memory_info().rss
+        try:
+            for line in Path(f"/proc/{self.pid}/status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def __enter__(self):
+        self._stop.clear()
+        self.peak_rss = self.rss_bytes() or 0
+        threading.Thread(target=self._loop, daemon=True).start()
+        return self
+
+    def _loop(self):
+        while not self._stop.wait(0.05):
+            self.peak_rss = max(self.peak_rss, self.rss_bytes() or 0)
+
+    def __exit__(self, *exc):
+        self._stop.set()
+
+# ─── Clientes ────────────────────────────────────────────────────
+def chat_once(url: str, body: dict) -> dict:
+    t0 = time.perf_counter()
+    r  = requests.post(url, json=body, timeout=120)
+    return {"ok": r.ok and "error" not in r.json(), "total": time.perf_counter() - t0}
+
+def stream_once(url: str, body: dict, token_field: str) -> dict:
+    """Lee un stream (SSE del proxy/Anthropic o NDJSON de Ollama) y mide TTFT."""
+    t0, ttft, ok = time.perf_counter(), None, False
+    with requests.post(url, json=body, stream=True, timeout=120) as r:
+        for line in r.iter_lines():
+            if not line:
+                continue
+            line = line.decode()
+            if line.startswith("data: "):
+                line = line[6:]
+            if line == "[DONE]":
+                ok = True
+                break
+            if ttft is None and token_field in line:
+                ttft = time.perf_counter() - t0
+            if '"error"' in line:
+                break
+            if '"message_stop"' in line or '"done": true' in line:
+                ok = True
+                break
+    return {"ok": ok and ttft is not None, "total": time.perf_counter() - t0, "ttft": ttft}
+
+def percentile(values: list, p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+def run_load(fn, concurrency: int, per_client: int) -> dict:
+    samples = []
+    lock    = threading.Lock()
+
+    def client():
+        for _ in range(per_client):
+            try:
+                s = fn()
+            except requests.RequestException:
+                s = {"ok": False, "total": 0.0}
+            with lock:
+                samples.append(s)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for f in [pool.submit(client) for _ in range(concurrency)]:
+            f.result()
+    wall = time.perf_counter() - t0
+    good = [s for s in samples if s["ok"]]
+    return {
+        "wall":    wall,
+        "count":   len(samples),
+        "errors":  len(samples) - len(good),
+        "total":   [s["total"] for s in good],
+        "ttft":    [s["ttft"] for s in good if s.get("ttft") is not None],
+    }
+
+def ms(v):
+    return None if v is None else round(v * 1000, 2)
+
+# ─── Escenarios ──────────────────────────────────────────────────
+MESSAGES = [{"role": "user", "content": "Escribe una función que sume dos números. " * 8}]
+
+def scenarios(proxy: str, mock: str) -> dict:
+    """nombre → (llamada directa al mock, llamada vía proxy, ¿streaming?)."""
+    anth_body = {"model": "claude-sonnet-4-20250514", "max_tokens": 512, "messages": MESSAGES}
+    olla_body = {"model": "llama3.2", "messages": MESSAGES}
+    return {
+        "chat": (
+            lambda: chat_once(f"{mock}/v1/messages", anth_body),
+            lambda: chat_once(f"{proxy}/api/chat", anth_body),
+            False,
+        ),
+        "stream": (
+            lambda: stream_once(f"{mock}/v1/messages", {**anth_body, "stream": True}, "text_delta"),
+            lambda: stream_once(f"{proxy}/api/stream", anth_body, '"token"'),
+            True,
+        ),
+        "ollama_chat": (
+            lambda: chat_once(f"{mock}/api/chat", {**olla_body, "stream": False}),
+            lambda: chat_once(f"{proxy}/api/chat", {**olla_body, "provider": "ollama"}),
+            False,
+        ),
+    }
+
+def run_scenario(name: str, direct, proxied, streaming: bool, args, sampler: ProcessSampler) -> dict:
+    info(f"{name}: {args.concurrency} clientes × {args.requests} peticiones")
+    run_load(proxied, min(4, args.concurrency), 2)          # calentamiento
+    base = run_load(direct, args.concurrency, args.requests)
+    cpu0 = sampler.cpu_seconds()
+    with sampler:
+        prox = run_load(proxied, args.concurrency, args.requests)
+    cpu1 = sampler.cpu_seconds()
+
+    def added(p):
+        a, b = percentile(prox["total"], p), percentile(base["total"], p)
+        return None if a is None or b is None else a - b
+
+    report = {
+        "requests":        prox["count"],
+        "errors":          prox["errors"],
+        "throughput_rps":  round(prox["count"] / prox["wall"], 2) if prox["wall"] else None,
+        "latency_ms":      {"p50": ms(percentile(prox["total"], 50)), "p99": ms(percentile(prox["total"], 99))},
+        "direct_ms":       {"p50": ms(percentile(base["total"], 50)), "p99": ms(percentile(base["total"], 99))},
+        "added_ms":        {"p50": ms(added(50)), "p99": ms(added(99))},
+        "cpu_ms_per_req":  None,
+        "rss_peak_mb":     round(sampler.peak_rss / 1048576, 1) if sampler.peak_rss else None,
+    }
+    if cpu0 is not None and cpu1 is not None and prox["count"]:
+        report["cpu_ms_per_req"] = round((cpu1 - cpu0) * 1000 / prox["count"], 3)
+    if streaming:
+        t_p, t_d = prox["ttft"], base["ttft"]
+        report["ttft_ms"]          = {"p50": ms(percentile(t_p, 50)), "p99": ms(percentile(t_p, 99))}
+        report["ttft_overhead_ms"] = {
+            "p50": ms(percentile(t_p, 50) - percentile(t_d, 50)) if t_p and t_d else None,
+            "p99": ms(percentile(t_p, 99) - percentile(t_d, 99)) if t_p and t_d else None,
+        }
+        idle = args.idle_rss
+        if idle and sampler.peak_rss:
+            report["rss_kb_per_stream"] = round((sampler.peak_rss - idle) / 1024 / args.concurrency, 1)
+    errs = f"{C.R}{prox['errors']} errores{C.RST}" if prox["errors"] else "0 errores"
+    ok(f"{name}: {report['throughput_rps']} req/s · +{report['added_ms']['p50']} ms p50 · "
+       f"+{report['added_ms']['p99']} ms p99 · {report['cpu_ms_per_req']} ms CPU/req · {errs}")
+    return report
+
+# ─── Comparación ─────────────────────────────────────────────────
+_LOWER_IS_BETTER = [("added_ms", "p50"), ("added_ms", "p99"), ("ttft_overhead_ms", "p50"), ("cpu_ms_per_req", None)]
+
+def compare(current: dict, baseline: dict, tolerance: float, floor_ms: float) -> list:
+    """Regresiones: métricas que empeoran más de `tolerance` (relativo) y `floor_ms` (absoluto)."""
+    regressions = []
+    for name, cur in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric, sub in _LOWER_IS_BETTER:
+            a = cur.get(metric) if sub is None else (cur.get(metric) or {}).get(sub)
+            b = base.get(metric) if sub is None else (base.get(metric) or {}).get(sub)
+            if a is None or b is None:
+                continue
+            if a - b > floor_ms and a > b * (1 + tolerance):
+                regressions.append(f"{name}.{metric}{'.' + sub if sub else ''}: {b} → {a}")
+        b_rps, a_rps = base.get("throughput_rps"), cur.get("throughput_rps")
+        if a_rps and b_rps and a_rps < b_rps * (1 - tolerance):
+            regressions.append(f"{name}.throughput_rps: {b_rps} → {a_rps}")
+    return regressions
+
+# ─── Main ────────────────────────────────────────────────────────
+def main():
+    parser = argparse.ArgumentParser(
+        description="Agent Studio v2.0 — Benchmark del proxy",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=textwrap.dedent("""
+            Ejemplos:
+              python bench_agent_studio.py -c 16 -n 10
+              python bench_agent_studio.py --scenario stream --token-rate 0
+              python bench_agent_studio.py --out base.json && python bench_agent_studio.py --compare base.json
+        """)
+    )
+    parser.add_argument("-c", "--concurrency", type=int, default=8, help="Clientes concurrentes")
+    parser.add_argument("-n", "--requests", type=int, default=10, help="Peticiones por cliente")
+    parser.add_argument("--latency", type=float, default=50, help="Latencia del mock (ms) antes de responder")
+    parser.add_argument("--token-rate", type=float, default=200, help="Tokens/s del mock en streaming (0 = sin pausa)")
+    parser.add_argument("--tokens", type=int, default=64, help="Tokens por respuesta")
+    parser.add_argument("--scenario", action="append", help="chat | stream | ollama_chat (repetible)")
+    parser.add_argument("--env", action="append", default=[], help="VAR=valor extra para el servidor")
+    parser.add_argument("--out", default="bench_results.json", help="Fichero JSON del informe")
+    parser.add_argument("--compare", help="Informe base para detectar regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Empeoramiento relativo tolerado (0.2 = 20%%)")
+    parser.add_argument("--floor-ms", type=float, default=1.0, help="Empeoramiento absoluto ignorado (ms)")
+    args = parser.parse_args()
+
+    MockConfig.latency_ms = args.latency
+    MockConfig.token_rate = args.token_rate
+    MockConfig.tokens     = args.tokens
+
+    hdr("Arrancando mock upstream y servidor")
+    mock     = start_mock()
+    mock_url = f"http://127.0.0.1:{mock.server_port}"
+    port     = free_port()
+    extra    = dict(kv.split("=", 1) for kv in args.env)
+    proc     = start_server(mock_url, port, extra)
+    proxy    = f"http://127.0.0.1:{port}"
+    ok(f"mock → {mock_url} · servidor → {proxy} (pid {proc.pid})")
+
+    sampler = ProcessSampler(proc.pid)
+    if not sampler.available:
+        warn("Sin psutil ni /proc: CPU y RSS no se medirán")
+    args.idle_rss = sampler.rss_bytes()
+
+    report = {
+        "meta": {
+            "date":        datetime.now().isoformat(timespec="seconds"),
+            "python":      platform.python_version(),
+            "platform":    platform.platform(),
+            "concurrency": args.concurrency,
+            "requests":    args.requests,
+            "mock":        {"latency_ms": args.latency, "token_rate": args.token_rate, "tokens": args.tokens},
+            "env":         extra,
+            "idle_rss_mb": round(args.idle_rss / 1048576, 1) if args.idle_rss else None,
+        },
+        "scenarios": {},
+    }
+    try:
+        hdr("Ejecutando escenarios")
+        for name, (direct, proxied, streaming) in scenarios(proxy, mock_url).items():
+            if args.scenario and name not in args.scenario:
+                continue
+            report["scenarios"][name] = run_scenario(name, direct, proxied, streaming, args, sampler)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        mock.shutdown()
+
+    Path(args.out).write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+    ok(f"Informe guardado en {args.out}")
+
+    if args.compare:
+        hdr(f"Comparando con {args.compare}")
+        baseline    = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, args.tolerance, args.floor_ms)
+        for r in regressions:
+            err(r)
+        if regressions:
+            sys.exit(1)
+        ok("Sin regresiones")
+
+if __name__ == "__main__":
+    main()